@@ -1 +1,16 @@
+import importlib
+
 from .main import *
+
+__all__ = ['CFShare', 'CipherMode', 'ContainerFormat', 'Layout', 'ShareScheme', 'get_cipher_mode', 'getparser', 'main',
+           'usage']
+
+# Imported on first access, so that the CLI starts without loading the ciphers
+_LAZY = {'CFShare': 'cfshare.cfshare', 'ShareScheme': 'cfshare.cfshare', 'Layout': 'cfshare.cfshare',
+         'ContainerFormat': 'cfshare.cfshare'}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module(_LAZY[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
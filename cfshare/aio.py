@@ -0,0 +1,389 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+from cfshare.cfshare import CFShare
+from cfshare.streams import DEFAULT_CHUNK
+
+DEFAULT_DEPTH = 8
+
+
+async def split_async(reader, writers, min_shares, share_writers=None, depth=DEFAULT_DEPTH, max_chunk=DEFAULT_CHUNK,
+                      **kwargs):
+    """Split the async ``reader`` into the async ``writers`` while encryption runs on a worker thread.
+
+    ``reader`` has an ``async read(n)`` method or is an async iterable of bytes, and every writer has ``async
+    write(data)`` and ``async patch(offset, data)`` methods (see ``LocalDirSink`` and ``MemoryObjectStore``). The
+    reader is read ahead and every writer is fed from its own queue of ``depth`` chunks, so all the outputs are
+    written concurrently with the encryption and a slow writer holds the encryption back. The remaining arguments
+    are passed to ``CFShare.split_stream``, the writers are left open. Returns the shares.
+
+    The errors ``CFShare.split_stream`` prints before exiting are raised as ``ValueError`` instead, so that they
+    don't stop the event loop.
+    """
+    bridge = _Bridge(asyncio.get_running_loop())
+    targets = writers + (share_writers or [])
+    outputs = [_ThreadWriter(bridge, depth) for _ in targets]
+    drains = [asyncio.ensure_future(_drain(output.queue, writer, bridge)) for output, writer in zip(outputs, targets)]
+    source = _ThreadReader(bridge, reader, depth, max_chunk)
+    share_outputs = None if share_writers is None else outputs[len(writers):]
+    shares = None
+    try:
+        shares = await asyncio.to_thread(_no_exit(CFShare.split_stream, "The split failed"), source,
+                                         outputs[:len(writers)], min_shares, share_writers=share_outputs,
+                                         max_chunk=max_chunk, **kwargs)
+    except _Closed:
+        # A writer failed, its error is raised below
+        pass
+    finally:
+        source.cancel()
+        for output, drain in zip(outputs, drains):
+            if not drain.done():
+                await output.queue.put(None)
+        await asyncio.gather(*drains)
+    return shares
+
+
+async def split_to(sink, name, reader, min_shares, total_shares, sharesonly=False, **kwargs):
+    """Split the async ``reader`` into objects of ``sink`` named like the outputs of ``CFShare.split_file``.
+
+    The objects are closed once complete and aborted if the split fails. Returns the shares.
+    """
+    names = [name + "{}_{}".format(i + 1, total_shares) for i in range(total_shares)]
+    share_writers = None
+    if sharesonly:
+        share_writers = await asyncio.gather(*[sink.open(item + '.share') for item in names])
+        names = [name]
+    writers = list(await asyncio.gather(*[sink.open(item) for item in names]))
+    targets = writers + list(share_writers or [])
+    try:
+        shares = await split_async(reader, writers, min_shares, share_writers=share_writers, **kwargs)
+    except BaseException:
+        await asyncio.gather(*[writer.abort() for writer in targets])
+        raise
+    await asyncio.gather(*[writer.close() for writer in targets])
+    return shares
+
+
+async def reconstruct_async(readers, share_readers=None, depth=DEFAULT_DEPTH, max_chunk=DEFAULT_CHUNK, workers=None):
+    """Yield the plaintext reconstructed from the async ``readers`` (and ``share_readers`` for a shares only split).
+
+    Every reader is read ahead concurrently by its own task and decryption runs on a worker thread, see
+    ``CFShare.reconstruct_stream`` for when the output is authenticated. The readers are left open.
+
+    Shares that can't be combined raise ``ValueError`` and a payload that fails authentication ``InvalidSignature``.
+    """
+    bridge = _Bridge(asyncio.get_running_loop())
+    inputs = [_ThreadReader(bridge, reader, depth, max_chunk) for reader in readers]
+    share_inputs = None
+    if share_readers is not None:
+        share_inputs = [_ThreadReader(bridge, reader, depth, max_chunk) for reader in share_readers]
+    output = asyncio.Queue(depth)
+
+    def produce():
+        try:
+            for chunk in CFShare.reconstruct_stream(inputs, share_inputs, max_chunk, workers):
+                bridge.call(output.put(chunk))
+        finally:
+            bridge.call(output.put(_END))
+
+    producer = asyncio.ensure_future(asyncio.to_thread(_no_exit(produce, "The shares could not be combined")))
+
+    try:
+        while True:
+            chunk = await output.get()
+            if chunk is _END:
+                break
+            yield chunk
+        await producer
+    finally:
+        bridge.close()
+        for source in inputs + (share_inputs or []):
+            source.cancel()
+        await asyncio.wait([producer])
+        # The error of a producer abandoned by the consumer is not raised
+        producer.exception()
+
+
+class LocalDirSink:
+    """Store objects as files of the directory ``root``, the blocking file operations running on threads."""
+
+    def __init__(self, root):
+        self.root = root
+
+    async def open(self, name):
+        path = os.path.join(self.root, name)
+        return _LocalWriter(await asyncio.to_thread(open, path, 'wb'), path)
+
+    async def open_read(self, name):
+        return _LocalReader(await asyncio.to_thread(open, os.path.join(self.root, name), 'rb'))
+
+
+class _LocalWriter:
+
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+
+    async def write(self, data):
+        await asyncio.to_thread(self.f.write, data)
+
+    async def patch(self, offset, data):
+        def patch():
+            end = self.f.tell()
+            self.f.seek(offset)
+            self.f.write(data)
+            self.f.seek(end)
+        await asyncio.to_thread(patch)
+
+    async def close(self):
+        await asyncio.to_thread(self.f.close)
+
+    async def abort(self):
+        await self.close()
+        await asyncio.to_thread(os.remove, self.path)
+
+
+class _LocalReader:
+
+    def __init__(self, f):
+        self.f = f
+
+    async def read(self, n=-1):
+        return await asyncio.to_thread(self.f.read, n)
+
+    async def close(self):
+        await asyncio.to_thread(self.f.close)
+
+
+class MemoryObjectStore:
+    """In-process stand-in for an object store.
+
+    Objects are uploaded in parts of ``part_size`` bytes and only become visible once closed; patching bytes of an
+    uploaded part uploads it again, like a multipart upload. Every request waits ``latency`` seconds and is counted
+    in ``requests``.
+    """
+
+    def __init__(self, part_size=1 << 20, latency=0):
+        self.part_size = part_size
+        self.latency = latency
+        self.objects = {}
+        self.requests = 0
+
+    async def open(self, name):
+        return _MemoryUpload(self, name)
+
+    async def open_read(self, name):
+        if name not in self.objects:
+            raise FileNotFoundError(name)
+        return _MemoryDownload(self, self.objects[name])
+
+    def get(self, name):
+        return self.objects[name]
+
+    async def _request(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+
+class _MemoryUpload:
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.parts = []
+        self.buffer = bytearray()
+
+    async def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.store.part_size:
+            await self._upload(len(self.parts), bytes(self.buffer[:self.store.part_size]))
+            del self.buffer[:self.store.part_size]
+
+    async def patch(self, offset, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            index, skip = divmod(offset, self.store.part_size)
+            n = min(len(view), self.store.part_size - skip)
+            if index < len(self.parts):
+                part = bytearray(self.parts[index])
+                part[skip:skip + n] = view[:n]
+                await self._upload(index, bytes(part))
+            else:
+                start = offset - len(self.parts) * self.store.part_size
+                self.buffer[start:start + n] = view[:n]
+            offset += n
+            view = view[n:]
+
+    async def close(self):
+        if self.buffer:
+            await self._upload(len(self.parts), bytes(self.buffer))
+            self.buffer = bytearray()
+        await self.store._request()
+        self.store.objects[self.name] = b''.join(self.parts)
+
+    async def abort(self):
+        self.parts = []
+        self.buffer = bytearray()
+
+    async def _upload(self, index, part):
+        await self.store._request()
+        if index == len(self.parts):
+            self.parts.append(part)
+        else:
+            self.parts[index] = part
+
+
+class _MemoryDownload:
+
+    def __init__(self, store, data):
+        self.store = store
+        self.data = memoryview(data)
+
+    async def read(self, n=-1):
+        await self.store._request()
+        if n < 0:
+            n = len(self.data)
+        b = bytes(self.data[:n])
+        self.data = self.data[n:]
+        return b
+
+    async def close(self):
+        self.data = memoryview(b'')
+
+
+class _Closed(Exception):
+    pass
+
+
+def _no_exit(fn, message):
+    # SystemExit raised in a worker thread would be re-raised by the awaiting task and stop the event loop
+    def run(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except SystemExit as e:
+            raise ValueError(message) from e
+    return run
+
+
+class _Bridge:
+    """Blocking calls from a worker thread into the event loop, abandoned once ``close`` is called."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.closed = threading.Event()
+
+    def call(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.05)
+            except concurrent.futures.TimeoutError:
+                if self.closed.is_set():
+                    future.cancel()
+                    raise _Closed()
+
+    def close(self):
+        self.closed.set()
+
+
+class _ThreadWriter:
+    """Blocking writer handing its writes over to a queue drained by the event loop.
+
+    Writes made after seeking back are sent as patches of the bytes already written.
+    """
+
+    def __init__(self, bridge, depth):
+        self.bridge = bridge
+        self.queue = asyncio.Queue(depth)
+        self.position = 0
+        self.end = 0
+
+    def write(self, b):
+        data = bytes(b)
+        offset = None if self.position == self.end else self.position
+        self.position += len(data)
+        self.end = max(self.end, self.position)
+        self.bridge.call(self.queue.put((offset, data)))
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        self.position = offset
+        return offset
+
+
+async def _drain(queue, writer, bridge):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        offset, data = item
+        try:
+            if offset is None:
+                await writer.write(data)
+            else:
+                await writer.patch(offset, data)
+        except BaseException:
+            # Stop the producer, which may be blocked on this queue
+            bridge.close()
+            raise
+
+
+class _ThreadReader:
+    """Blocking file object over an async source, read ahead by a task of the event loop."""
+
+    def __init__(self, bridge, source, depth, chunk_size):
+        self.bridge = bridge
+        self.queue = asyncio.Queue(depth)
+        self.task = asyncio.ensure_future(_pump(source, self.queue, chunk_size))
+        self.pending = bytearray()
+        self.done = False
+
+    def read(self, n=-1):
+        while (n < 0 or len(self.pending) < n) and not self.done:
+            item = self.bridge.call(self.queue.get())
+            if item is _END:
+                self.done = True
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                self.pending += item
+        if n < 0:
+            n = len(self.pending)
+        b = bytes(self.pending[:n])
+        del self.pending[:n]
+        return b
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def cancel(self):
+        self.task.cancel()
+
+
+async def _pump(source, queue, chunk_size):
+    try:
+        if hasattr(source, 'read'):
+            while True:
+                b = await source.read(chunk_size)
+                if not b:
+                    break
+                await queue.put(b)
+        else:
+            async for b in source:
+                await queue.put(b)
+        await queue.put(_END)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+
+
+_END = object()
@@ -0,0 +1,131 @@
+import contextlib
+import json
+import os
+import sys
+
+from cfshare.cfshare import CFShare
+from cfshare.streams import DEFAULT_CHUNK, IterReader
+
+# An archive packs many files into the plaintext of a single split, whose shares are created once:
+#   [index length 8][index][member contents...]
+# The index is a JSON object listing the name, size and offset (from the end of the index) of every member. The
+# archive always uses the segmented container, so a member is extracted by decrypting only its segments.
+DEFAULT_ARCHIVE_SEGMENT_SIZE = 1 << 16
+INDEX_LEN_LEN = 8
+MAX_INDEX_LEN = 1 << 30
+
+
+def pack(files, fileout, min_shares, total_shares, segment_size=DEFAULT_ARCHIVE_SEGMENT_SIZE, max_chunk=DEFAULT_CHUNK,
+         **kwargs):
+    """Pack every ``(path, name)`` pair of ``files`` into a single archive split into the outputs named after
+    ``fileout``.
+
+    The remaining arguments are passed to ``CFShare.split_file``. Returns the shares.
+    """
+    members = []
+    offset = 0
+    for path, name in files:
+        size = os.stat(path).st_size
+        members.append({'name': name, 'size': size, 'offset': offset})
+        offset += size
+    if len({member['name'] for member in members}) != len(members):
+        print("The names of the members of an archive must be unique")
+        sys.exit(1)
+    index = json.dumps({'members': members}, separators=(',', ':')).encode('utf-8')
+    header = int.to_bytes(len(index), INDEX_LEN_LEN, 'little') + index
+    reader = IterReader(_read_members(header, [path for path, _ in files], members, max_chunk))
+    return CFShare.split_file(reader, fileout, min_shares, total_shares, segment_size=segment_size,
+                              max_chunk=max_chunk, length=len(header) + offset, **kwargs)
+
+
+def pack_tree(root, fileout, min_shares, total_shares, **kwargs):
+    """Pack every file under ``root``, named by its path relative to ``root``, see ``pack``."""
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                files.append((path, os.path.relpath(path, root).replace(os.sep, '/')))
+    return pack(sorted(files, key=lambda item: item[1]), fileout, min_shares, total_shares, **kwargs)
+
+
+def list_members(filein, fshares=None):
+    """Return the members of the archive reconstructed from ``filein`` (and ``fshares``), reading only its index.
+
+    Every member is a dict with its ``name``, ``size`` and ``offset``.
+    """
+    with _open_archive(filein, fshares) as (_, members, _):
+        return members
+
+
+def extract(filein, names, outroot, fshares=None, max_chunk=DEFAULT_CHUNK):
+    """Write the members ``names`` (all of them if ``None``) of an archive under ``outroot``.
+
+    Only the segments holding the requested members are read and decrypted. Returns the paths written.
+    """
+    written = []
+    with _open_archive(filein, fshares) as (reader, members, data_start):
+        by_name = {member['name']: member for member in members}
+        if names is None:
+            names = [member['name'] for member in members]
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            print("{} is not a member of the archive".format(', '.join(missing)))
+            sys.exit(1)
+        for name in names:
+            member = by_name[name]
+            fileout = _member_path(outroot, name)
+            os.makedirs(os.path.dirname(fileout), exist_ok=True)
+            reader.seek(data_start + member['offset'])
+            remaining = member['size']
+            with open(fileout, 'wb') as fo:
+                while remaining > 0:
+                    chunk = reader.read(min(max_chunk, remaining))
+                    if not chunk:
+                        print("The archive is truncated")
+                        sys.exit(1)
+                    fo.write(chunk)
+                    remaining -= len(chunk)
+            written.append(fileout)
+    return written
+
+
+@contextlib.contextmanager
+def _open_archive(filein, fshares):
+    reader = CFShare.open_reconstructed(filein, fshares)
+    if reader is None:
+        sys.exit(1)
+    try:
+        try:
+            index_len = int.from_bytes(reader.read(INDEX_LEN_LEN), 'little')
+            if index_len > min(MAX_INDEX_LEN, reader.length):
+                raise ValueError("Invalid index length")
+            members = json.loads(reader.read(index_len).decode('utf-8'))['members']
+        except (ValueError, KeyError, TypeError):
+            print("The file is not an archive")
+            sys.exit(1)
+        yield reader, members, INDEX_LEN_LEN + index_len
+    finally:
+        reader.close()
+
+
+def _read_members(header, paths, members, max_chunk):
+    yield header
+    for path, member in zip(paths, members):
+        remaining = member['size']
+        with open(path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(max_chunk, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if remaining or os.stat(path).st_size != member['size']:
+            raise ValueError("{} changed while it was packed".format(path))
+
+
+def _member_path(outroot, name):
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    if not parts:
+        raise ValueError("Invalid member name {}".format(name))
+    return os.path.join(outroot, *parts)
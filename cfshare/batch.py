@@ -0,0 +1,101 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from cfshare.cfshare import CFShare
+
+MANIFEST_NAME = 'cfshare_manifest.json'
+
+
+def split_tree(root, outroot, min_shares, total_shares, jobs=None, **kwargs):
+    """Split every file under ``root`` into shares mirrored under ``outroot``.
+
+    Files are scheduled on a pool of ``jobs`` processes, largest first, and the remaining arguments are passed to
+    ``CFShare.split_file``. A manifest listing the outputs of every file is written to ``outroot``; the relative paths
+    of the files that could not be split are returned.
+    """
+    files = sorted(_walk(root), key=lambda item: item[1], reverse=True)
+    tasks = []
+    for rel, size in files:
+        fileout = os.path.join(outroot, rel)
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        tasks.append((rel, size, (os.path.join(root, rel), fileout, min_shares, total_shares, kwargs)))
+    done, failed = _run(_split_one, tasks, jobs)
+    entries = [{'path': rel, 'size': size, 'outputs': _outputs(rel, total_shares, kwargs.get('sharesonly', False))}
+               for rel, size in done]
+    manifest = {'min_shares': min_shares, 'total_shares': total_shares,
+                'sharesonly': bool(kwargs.get('sharesonly', False)), 'files': entries}
+    with open(os.path.join(outroot, MANIFEST_NAME), 'w') as fo:
+        json.dump(manifest, fo, indent=1)
+    return failed
+
+
+def bind_tree(root, outroot, jobs=None, **kwargs):
+    """Reconstruct every file listed in the manifest of the share tree ``root`` under ``outroot``.
+
+    Only the outputs still present are used for each file. The remaining arguments are passed to
+    ``CFShare.reconstruct_file`` and the relative paths of the files that could not be reconstructed are returned.
+    """
+    with open(os.path.join(root, MANIFEST_NAME)) as fi:
+        manifest = json.load(fi)
+    if 'group' in manifest:
+        # Members of a key group share a single key, combined once in this process
+        from cfshare.keygroup import bind_group_tree
+        return bind_group_tree(root, outroot, **kwargs)
+    tasks = []
+    missing = []
+    for entry in sorted(manifest['files'], key=lambda item: item['size'], reverse=True):
+        outputs = [os.path.join(root, item) for item in entry['outputs']]
+        if manifest['sharesonly']:
+            # The first output is the encrypted file, the others its .share files
+            if not os.path.exists(outputs[0]):
+                print("{}: the encrypted file is missing".format(entry['path']))
+                missing.append(entry['path'])
+                continue
+            filein, fshares = outputs[:1], [path for path in outputs[1:] if os.path.exists(path)]
+        else:
+            filein, fshares = [path for path in outputs if os.path.exists(path)], []
+        fileout = os.path.join(outroot, entry['path'])
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        tasks.append((entry['path'], entry['size'], (filein, fileout, fshares, kwargs)))
+    return missing + _run(_bind_one, tasks, jobs)[1]
+
+
+def _walk(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            if rel != MANIFEST_NAME and os.path.isfile(path):
+                yield rel, os.stat(path).st_size
+
+
+def _outputs(rel, total_shares, sharesonly):
+    names = [rel + "{}_{}".format(i + 1, total_shares) for i in range(total_shares)]
+    if sharesonly:
+        return [rel] + [name + '.share' for name in names]
+    return names
+
+
+def _run(fn, tasks, jobs):
+    done = []
+    failed = []
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [(rel, size, executor.submit(fn, *args)) for rel, size, args in tasks]
+        for rel, size, future in futures:
+            try:
+                future.result()
+                done.append((rel, size))
+            except (SystemExit, Exception) as e:
+                # A file that can't be processed, whatever the reason, is reported and the others go on
+                print("{}: {}".format(rel, e if not isinstance(e, SystemExit) else 'failed'))
+                failed.append(rel)
+    return done, failed
+
+
+def _split_one(filein, fileout, min_shares, total_shares, kwargs):
+    CFShare.split_file(filein, fileout, min_shares, total_shares, **kwargs)
+
+
+def _bind_one(filein, fileout, fshares, kwargs):
+    CFShare.reconstruct_file(filein, fileout, fshares=fshares, **kwargs)
@@ -0,0 +1,180 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import cryptography
+
+from cfshare.cfshare import CFShare, CipherMode, ShareScheme
+from cfshare.streams import DEFAULT_CHUNK
+from secret_sharing.shamir import Shamir
+from secret_sharing.shamir_gf256 import ShamirGF256
+
+DEFAULT_SIZES = [1 << 10, 1 << 20, 64 << 20]
+DEFAULT_CHUNKS = [1 << 16, DEFAULT_CHUNK, 1 << 20, 4 << 20]
+LAYOUTS = ['copy', 'sharesonly', 'fragment', 'dispersed', 'segmented']
+DEFAULT_SHARES = [(2, 3), (3, 5), (5, 9)]
+DEFAULT_SHAMIR = [(2, 3, 32), (3, 5, 32), (10, 15, 32), (3, 5, 1024), (50, 100, 32)]
+
+
+def cases(sizes=None, modes=None, chunks=None, layouts=None, shares=None):
+    """Yield the split/bind cases of the suite, varying one dimension at a time around AES with copied 2-of-3 shares.
+
+    Every cipher is measured at every file size, while the chunk sizes, layouts and numbers of shares are measured
+    on the largest file only.
+    """
+    sizes = sizes or DEFAULT_SIZES
+    largest = max(sizes)
+    base = {'mode': CipherMode.AES.name, 'max_chunk': DEFAULT_CHUNK, 'layout': 'copy', 'min_shares': 2,
+            'total_shares': 3}
+    seen = []
+    candidates = [dict(base, mode=mode.name, size=size) for mode in modes or CipherMode for size in sizes]
+    candidates += [dict(base, max_chunk=chunk, size=largest) for chunk in chunks or DEFAULT_CHUNKS]
+    candidates += [dict(base, layout=layout, size=largest) for layout in layouts or LAYOUTS]
+    candidates += [dict(base, min_shares=m, total_shares=t, size=largest) for m, t in shares or DEFAULT_SHARES]
+    for case in candidates:
+        if case not in seen:
+            seen.append(case)
+            yield case
+
+
+def run(sizes=None, modes=None, chunks=None, layouts=None, shares=None, shamir=None, repeat=3, workdir=None,
+        progress=None):
+    """Run the suite and return its results as a JSON serializable dict.
+
+    Every case keeps its best time out of ``repeat`` runs. Inputs and outputs are written to a temporary directory
+    under ``workdir`` that is removed afterwards. ``progress`` is called with every result as soon as it is known.
+    """
+    results = []
+    tmp = tempfile.mkdtemp(prefix='cfshare_bench', dir=workdir)
+    try:
+        inputs = {}
+        for case in cases(sizes, modes, chunks, layouts, shares):
+            if case['size'] not in inputs:
+                inputs[case['size']] = _write_input(tmp, case['size'])
+            for result in _run_case(case, inputs[case['size']], tmp, repeat):
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    for m, t, secret_len in shamir or DEFAULT_SHAMIR:
+        for result in _run_shamir(m, t, secret_len, repeat):
+            results.append(result)
+            if progress is not None:
+                progress(result)
+    return {'python': platform.python_version(), 'cryptography': cryptography.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    """Return the results of ``current`` that are more than ``tolerance`` slower than the same case of ``baseline``."""
+    best = {_key(result): result['seconds'] for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = best.get(_key(result))
+        if before is not None and result['seconds'] > before * (1 + tolerance):
+            regressions.append(dict(result, baseline_seconds=before))
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as fo:
+        json.dump(results, fo, indent=1)
+
+
+def load(path):
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def parse_size(text):
+    """Parse a size such as ``4096``, ``64K``, ``16M`` or ``2G``."""
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in ('seconds', 'mb_s')))
+
+
+def _write_input(tmp, size):
+    path = os.path.join(tmp, 'input{}'.format(size))
+    with open(path, 'wb') as fo:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 1 << 24)
+            fo.write(os.urandom(n))
+            remaining -= n
+    return path
+
+
+def _run_case(case, path, tmp, repeat):
+    m, t = case['min_shares'], case['total_shares']
+    options = {'mode': CipherMode[case['mode']], 'max_chunk': case['max_chunk']}
+    if case['layout'] == 'fragment':
+        m = t
+    elif case['layout'] == 'sharesonly':
+        options['sharesonly'] = True
+    elif case['layout'] == 'dispersed':
+        options['dispersed'] = True
+    elif case['layout'] == 'segmented':
+        options['segment_size'] = 1 << 20
+    out = os.path.join(tmp, 'out')
+    names = [out + "{}_{}".format(i + 1, t) for i in range(t)]
+    if options.get('sharesonly'):
+        filein, fshares = [out], [name + '.share' for name in names[:m]]
+    else:
+        filein, fshares = names[:m], []
+    split = _best(lambda: CFShare.split_file(path, out, m, t, **options), repeat)
+    bind = _best(lambda: CFShare.reconstruct_file(filein, os.path.join(tmp, 'rec'), fshares=fshares,
+                                                  max_chunk=case['max_chunk']), repeat)
+    for name in os.listdir(tmp):
+        if name.startswith(('out', 'rec')):
+            os.remove(os.path.join(tmp, name))
+    for bench, seconds in [('split', split), ('bind', bind)]:
+        yield dict(case, bench=bench, min_shares=m, seconds=seconds, mb_s=_throughput(case['size'], seconds))
+
+
+def _run_shamir(m, t, secret_len, repeat):
+    # Combining the same shares again reuses the Lagrange coefficients cached by the prime field scheme: the cold
+    # combine clears the cache before every run, like a process combining these shares for the first time
+    secret = os.urandom(secret_len)
+    for scheme, shamir in [(ShareScheme.PRIME256, Shamir()), (ShareScheme.GF256, ShamirGF256())]:
+        shares = shamir.create(m, t, secret)
+        create = _best(lambda: shamir.create(m, t, secret), repeat)
+        cold = _best(lambda: shamir.combine(shares[:m]), repeat, setup=lambda: _clear_cache(shamir))
+        shamir.combine(shares[:m])
+        warm = _best(lambda: shamir.combine(shares[:m]), repeat)
+        case = {'scheme': scheme.name, 'min_shares': m, 'total_shares': t, 'secret_len': secret_len}
+        yield dict(case, bench='shamir_create', seconds=create)
+        yield dict(case, bench='shamir_combine_cold', seconds=cold)
+        yield dict(case, bench='shamir_combine_warm', seconds=warm)
+
+
+def _clear_cache(shamir):
+    util = getattr(shamir, 'util', None)
+    if util is not None:
+        with util.lagrange_lock:
+            util.lagrange_cache.clear()
+
+
+def _best(fn, repeat, setup=None):
+    best = None
+    for _ in range(max(1, repeat)):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _throughput(size, seconds):
+    return round(size / seconds / 1e6, 2) if seconds > 0 else None
@@ -1,259 +1,725 @@
 import binascii
+import contextlib
 import enum
 import os
 import secrets
+import stat
 import sys
-import tempfile
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, hmac
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+from cfshare.ciphers import CipherMode, get_cipher_spec
+from cfshare.compression import Codec, check_codec, compress_reader, decompress_chunks
+from cfshare.metrics import TimedReader, TimedWriter, span
+from cfshare.reader import SegmentedReader, StreamReader
+from cfshare.segments import DEFAULT_SEGMENT_SIZE, check_segment_size, make_segmenter, payload_length
+from cfshare.streams import (DEFAULT_CHUNK, ConcatReader, DiscardWriter, DispersalWriter, DispersedPayload,
+                             FanOutWriter, FragmentWriter, IterReader, PayloadFile, Pipeline, PrefetchReader,
+                             open_source)
 from secret_sharing.shamir import Shamir
+from secret_sharing.shamir_gf256 import ShamirGF256
 
 
-class CipherMode(enum.Enum):
-    AES = 1
-    ChaCha20 = 2
-    Camellia = 3
+class ContainerFormat(enum.Enum):
+    STREAM = 0
+    SEGMENTED = 1
+
+
+class ShareScheme(enum.Enum):
+    PRIME256 = 0
+    GF256 = 1
+
+
+class Layout(enum.Enum):
+    COPY = 0
+    FRAGMENT = 1
+    DISPERSED = 2
 
 
 class CFShare:
 
     @staticmethod
     def split_file(filein, fileout, min_shares, total_shares, key=None, mode=CipherMode.AES, sharesonly=False,
-                   max_chunk=2048):
+                   max_chunk=DEFAULT_CHUNK, segment_size=None, workers=None, dispersed=False, scheme=ShareScheme.PRIME256,
+                   shares=None, observer=None, length=None, compression=Codec.NONE):
+        """Split ``filein`` (a path or a readable file object) into the outputs named after ``fileout``.
+
+        ``observer`` (a ``cfshare.metrics.Observer``) receives the timings of every phase and the progress. ``length``
+        and ``compression`` are passed to ``split_stream``.
+        """
+        names = [fileout + "{}_{}".format(i + 1, total_shares) for i in range(total_shares)]
+        with contextlib.ExitStack() as stack:
+            f = stack.enter_context(open_source(filein))
+            if length is None:
+                length = CFShare._get_remaining_length(f)
+            # Checked before the outputs are opened, which truncates the outputs of a previous split
+            CFShare._check_split(min_shares, total_shares, sharesonly, dispersed, mode, segment_size, compression,
+                                 length)
+            share_writers = None
+            if sharesonly:
+                share_writers = [stack.enter_context(open(name + '.share', 'wb')) for name in names]
+                names = [fileout]
+            writers = [stack.enter_context(open(name, 'wb')) for name in names]
+            return CFShare.split_stream(f, writers, min_shares, key=key, mode=mode, max_chunk=max_chunk,
+                                        segment_size=segment_size, workers=workers, dispersed=dispersed,
+                                        scheme=scheme, shares=shares, share_writers=share_writers, observer=observer,
+                                        length=length, compression=compression)
+
+    @staticmethod
+    def split_stream(reader, writers, min_shares, key=None, mode=CipherMode.AES, max_chunk=DEFAULT_CHUNK,
+                     segment_size=None, workers=None, dispersed=False, scheme=ShareScheme.PRIME256, shares=None,
+                     share_writers=None, length=None, observer=None, compression=Codec.NONE):
+        """Split the content of ``reader`` into one share per writer of ``writers``.
+
+        ``reader`` is a readable file object or an iterable of bytes and is consumed with constant memory. The
+        writers must be seekable, since the tag is written back into the headers at the end. With ``share_writers``
+        the encrypted content goes to the single writer of ``writers`` and every share to its own share writer.
+        Fragments need the ``length`` of the content unless ``reader`` is a regular file. ``observer`` receives the
+        timings of every phase and the progress. With a ``compression`` codec the content is compressed in blocks
+        on ``workers`` threads before being encrypted, bind decompresses it transparently.
+        """
+        sharesonly = share_writers is not None
+        total_shares = len(share_writers) if sharesonly else len(writers)
+        if not hasattr(reader, 'readinto'):
+            reader = IterReader(reader)
+        if length is None:
+            length = CFShare._get_remaining_length(reader)
+        layout = CFShare._check_split(min_shares, total_shares, sharesonly, dispersed, mode, segment_size, compression,
+                                      length)
         schema_lens = CFShare._get_len_elements_from_mode(mode)
         if key is None:
             key = secrets.token_bytes(32)
         iv = secrets.token_bytes(schema_lens['iv'])
-        cipher = CFShare._get_cipher_from_mode(mode, key, iv)
-        encryptor = cipher.encryptor()
-        h = hmac.HMAC(key, hashes.SHA256(), default_backend())
+        segment_size = CFShare._get_segment_size(mode, segment_size)
+        if segment_size is None:
+            mode_field = CFShare._pack_mode(mode, scheme=scheme, threshold=min_shares, codec=compression)
+        else:
+            segmenter = make_segmenter(mode, key, iv, segment_size, observer)
+            mode_field = CFShare._pack_mode(mode, ContainerFormat.SEGMENTED, segment_size, scheme, min_shares,
+                                            compression)
 
-        shares = Shamir().create(min_shares, total_shares, key)
-        shares = [(shares.index(item), item.encode('utf-8')) for item in shares]
-        tmp = tempfile.NamedTemporaryFile(delete=False, prefix='cfshare_').name
-        with open(filein, "rb") as f:
-            with open(tmp, 'wb') as fo:
-                b = f.read(max_chunk)
-                while b:
-                    ret = encryptor.update(b)
-                    h.update(b)
-                    fo.write(ret)
-                    b = f.read(max_chunk)
-                fo.write(encryptor.finalize())
-        tag = h.finalize()
-        written_files = 0
+        if shares is None:
+            with span(observer, 'key_split', len(key)):
+                shares = CFShare._create_shares(scheme, min_shares, total_shares, key)
         if sharesonly:
-            with open(fileout, 'wb') as fo:
-                fo.write(iv + tag)
-                with open(tmp, "rb") as f:
-                    b = f.read(max_chunk)
-                    while b:
-                        fo.write(b)
-                        b = f.read(max_chunk)
-            while written_files < total_shares:
-                with open(fileout + "{}_{}".format(written_files + 1, total_shares) + '.share', 'wb') as fo_share:
-                    fo_share.write(int.to_bytes(mode.value, schema_lens['mode'], 'little'))
-                    fo_share.write(int.to_bytes(shares[written_files][0], schema_lens['share_index'], 'little'))
-                    fo_share.write(int.to_bytes(len(shares[written_files][1]), schema_lens['share_len'], 'little'))
-                    fo_share.write(shares[written_files][1])
-                    written_files += 1
+            for fo_share, share in zip(share_writers, shares):
+                CFShare._write_share(fo_share, mode_field, share, schema_lens)
+        tag_offsets = []
+        for index, fo in enumerate(writers):
+            if not sharesonly:
+                fo.write(int.to_bytes(layout.value, schema_lens['layout'], 'little'))
+                CFShare._write_share(fo, mode_field, shares[index], schema_lens)
+            # The tag is only known once the whole input has been read, it is back-patched at the end
+            tag_offsets.append(fo.tell() + schema_lens['iv'])
+            fo.write(iv + bytes(schema_lens['tag']))
+            if layout == Layout.DISPERSED:
+                fo.write(bytes(schema_lens['payload_len']))
+                fo.write(int.to_bytes(min_shares, schema_lens['threshold'], 'little'))
+        if layout == Layout.DISPERSED:
+            sink = DispersalWriter(writers, min_shares)
+        elif layout == Layout.FRAGMENT:
+            len_payload = length
+            if segment_size is not None:
+                len_payload = payload_length(len_payload, segment_size, segmenter.tag_len)
+            sink = FragmentWriter(writers, len_payload)
         else:
-            written_bytes_ct = 0
-            len_ct = os.stat(tmp).st_size
-            with open(tmp,'rb') as ftmp:
-                while written_files < total_shares:
-                    with open(fileout + "{}_{}".format(written_files + 1, total_shares), "wb") as fo:
-                        fo.write(int.to_bytes(int(total_shares == min_shares), schema_lens['incomplete'], 'little'))
-                        fo.write(int.to_bytes(mode.value, schema_lens['mode'], 'little'))
-                        fo.write(int.to_bytes(shares[written_files][0], schema_lens['share_index'], 'little'))
-                        fo.write(int.to_bytes(len(shares[written_files][1]), schema_lens['share_len'], 'little'))
-                        fo.write(shares[written_files][1])
-                        fo.write(iv + tag)
-                        if total_shares == min_shares:
-                            last_byte = written_bytes_ct + int(len_ct / total_shares)
-                            if last_byte > len_ct:
-                                last_byte = len_ct
-                            elif written_files == total_shares - 1:
-                                last_byte = len_ct
-                            b = ftmp.read(max_chunk)
-                            while b:
-                                written_bytes_ct += fo.write(b)
-                                if written_bytes_ct == last_byte:
-                                    break
-                                b = ftmp.read(max_chunk)
-                        else:
-                            b = ftmp.read(2048)
-                            while b:
-                                fo.write(b)
-                                b = ftmp.read(2048)
-                            ftmp.seek(0)
-                        written_files += 1
-            os.remove(tmp)
+            sink = FanOutWriter(writers)
+        if observer is not None:
+            phases = {Layout.COPY: 'fan_out_write', Layout.FRAGMENT: 'fragment_write', Layout.DISPERSED: 'disperse_write'}
+            sink = TimedWriter(sink, observer, phases[layout])
+            reader = TimedReader(reader, observer, 'read', length, progress=True)
+        if compression != Codec.NONE:
+            reader = compress_reader(reader, compression, workers=workers, observer=observer)
+        if segment_size is None:
+            tag = CFShare._encrypt_stream(mode, key, iv, reader, sink, max_chunk, observer)
+        else:
+            tag = segmenter.encrypt_stream(reader, sink, workers)
+        if layout == Layout.DISPERSED:
+            sink.flush()
+            tag += int.to_bytes(sink.position, schema_lens['payload_len'], 'little')
+        for fo, offset in zip(writers, tag_offsets):
+            end = fo.tell()
+            fo.seek(offset)
+            fo.write(tag)
+            fo.seek(end)
         return shares
 
     @staticmethod
-    def reconstruct_file(filein, fileout, fshares=None, max_chunk=2048):
+    def split_many(files, min_shares, total_shares, scheme=ShareScheme.PRIME256, **kwargs):
+        """Split every ``(filein, fileout)`` pair of ``files`` under its own random key.
+
+        All the keys are generated and split in one batch, the remaining arguments are passed to ``split_file``.
+        Returns the shares of every file.
+        """
+        keys = secrets.token_bytes(32 * len(files))
+        keys = [keys[i * 32:(i + 1) * 32] for i in range(len(files))]
+        all_shares = CFShare._create_many_shares(scheme, min_shares, total_shares, keys)
+        for (filein, fileout), key, shares in zip(files, keys, all_shares):
+            CFShare.split_file(filein, fileout, min_shares, total_shares, key=key, scheme=scheme, shares=shares,
+                               **kwargs)
+        return all_shares
+
+    @staticmethod
+    def split_tree(root, outroot, min_shares, total_shares, jobs=None, **kwargs):
+        """Split every file under ``root`` on a process pool, see ``cfshare.batch.split_tree``."""
+        from cfshare.batch import split_tree
+        return split_tree(root, outroot, min_shares, total_shares, jobs, **kwargs)
+
+    @staticmethod
+    def bind_tree(root, outroot, jobs=None, **kwargs):
+        """Reconstruct every file of a share tree on a process pool, see ``cfshare.batch.bind_tree``."""
+        from cfshare.batch import bind_tree
+        return bind_tree(root, outroot, jobs, **kwargs)
+
+    @staticmethod
+    def split_group(files, name, min_shares, total_shares, **kwargs):
+        """Encrypt many files under a single set of shares, see ``cfshare.keygroup.split_group``."""
+        from cfshare.keygroup import split_group
+        return split_group(files, name, min_shares, total_shares, **kwargs)
+
+    @staticmethod
+    def reconstruct_group(files, group_shares=None, **kwargs):
+        """Decrypt members of a key group combining its shares once, see ``cfshare.keygroup.reconstruct_members``."""
+        from cfshare.keygroup import reconstruct_members
+        reconstruct_members(files, group_shares, **kwargs)
+
+    @staticmethod
+    def pack(files, fileout, min_shares, total_shares, **kwargs):
+        """Pack many files into a single archive split once, see ``cfshare.archive.pack``."""
+        from cfshare.archive import pack
+        return pack(files, fileout, min_shares, total_shares, **kwargs)
+
+    @staticmethod
+    def list_archive(filein, fshares=None):
+        """Return the members of an archive, see ``cfshare.archive.list_members``."""
+        from cfshare.archive import list_members
+        return list_members(filein, fshares)
+
+    @staticmethod
+    def extract(filein, names, outroot, fshares=None, **kwargs):
+        """Extract members of an archive decrypting only their ranges, see ``cfshare.archive.extract``."""
+        from cfshare.archive import extract
+        return extract(filein, names, outroot, fshares, **kwargs)
+
+    @staticmethod
+    def repair(fileout, total_shares, **kwargs):
+        """Restore the missing outputs of a split without re-encrypting it, see ``cfshare.repair.repair``."""
+        from cfshare.repair import repair
+        return repair(fileout, total_shares, **kwargs)
+
+    @staticmethod
+    def split_resumable(filein, fileout, min_shares, total_shares, **kwargs):
+        """Split a file checkpointing its progress, resuming an interrupted split, see ``cfshare.resume.split_file``."""
+        from cfshare.resume import split_file
+        split_file(filein, fileout, min_shares, total_shares, **kwargs)
+
+    @staticmethod
+    def reconstruct_resumable(filein, fileout, fshares=None, **kwargs):
+        """Reconstruct a file checkpointing its progress, see ``cfshare.resume.reconstruct_file``."""
+        from cfshare.resume import reconstruct_file
+        reconstruct_file(filein, fileout, fshares, **kwargs)
+
+    @staticmethod
+    def split_incremental(filein, store, fileout, min_shares, total_shares, **kwargs):
+        """Store the new chunks of a file in a chunk store and split its manifest, see ``cfshare.dedup.split_version``."""
+        from cfshare.dedup import split_version
+        return split_version(filein, store, fileout, min_shares, total_shares, **kwargs)
+
+    @staticmethod
+    def reconstruct_incremental(filein, store, fileout, fshares=None, **kwargs):
+        """Reconstruct a version from a chunk store, see ``cfshare.dedup.reconstruct_version``."""
+        from cfshare.dedup import reconstruct_version
+        reconstruct_version(filein, store, fileout, fshares, **kwargs)
+
+    @staticmethod
+    def index_store(root, workers=None):
+        """Index the share headers found under ``root``, see ``cfshare.index.build_index``."""
+        from cfshare.index import build_index
+        return build_index(root, workers)
+
+    @staticmethod
+    def share_id(path):
+        """Return the identity of the encrypted file a share belongs to, or ``None`` if ``path`` is not a share."""
+        from cfshare.index import read_share_header
+        header = read_share_header(path)
+        return None if header is None else header['id']
+
+    @staticmethod
+    def reconstruct_from_store(file_id, root, fileout, **kwargs):
+        """Reconstruct ``file_id`` from a minimal set of the shares listed in the index of ``root``."""
+        from cfshare.index import select_shares
+        filein, fshares = select_shares(root, file_id)
+        CFShare.reconstruct_file(filein, fileout, fshares=fshares, **kwargs)
+
+    @staticmethod
+    def verify_store(root, file_ids=None, **kwargs):
+        """Verify the files of an indexed store, see ``cfshare.index.verify_store``."""
+        from cfshare.index import verify_store
+        return verify_store(root, file_ids, **kwargs)
+
+    @staticmethod
+    def split_async(reader, writers, min_shares, **kwargs):
+        """Split an async reader into async writers, see ``cfshare.aio.split_async``."""
+        from cfshare.aio import split_async
+        return split_async(reader, writers, min_shares, **kwargs)
+
+    @staticmethod
+    def reconstruct_async(readers, share_readers=None, **kwargs):
+        """Yield the plaintext reconstructed from async readers, see ``cfshare.aio.reconstruct_async``."""
+        from cfshare.aio import reconstruct_async
+        return reconstruct_async(readers, share_readers, **kwargs)
+
+    @staticmethod
+    def reconstruct_file(filein, fileout, fshares=None, max_chunk=DEFAULT_CHUNK, workers=None, observer=None):
+        loaded = CFShare._load_sources(filein, fshares, observer)
+        if loaded is None:
+            return
+        mode, key, iv, tag, sources = loaded
+        CFShare._decrypt_to_file(mode, key, iv, tag, sources, fileout, max_chunk, workers, observer)
+
+    @staticmethod
+    def reconstruct_stream(readers, share_readers=None, max_chunk=DEFAULT_CHUNK, workers=None, observer=None):
+        """Yield the plaintext reconstructed from ``readers`` (and ``share_readers`` for a shares only split).
+
+        The inputs are paths or readable file objects positioned at the start of the shares, read sequentially with
+        constant memory. ``InvalidSignature`` is raised as soon as a segment fails authentication; files using the
+        stream container are only authenticated after their last chunk, so a consumer must not trust the output
+        until the iteration completes.
+        """
+        loaded = CFShare._load_sources(readers, share_readers, observer)
+        if loaded is None:
+            return
+        mode, key, iv, tag, sources = loaded
+        params = CFShare._unpack_mode(mode)
+        try:
+            yield from CFShare._plaintext_chunks(params, key, iv, tag, sources, max_chunk, workers, observer)
+        finally:
+            if isinstance(sources, DispersedPayload):
+                sources.close()
+
+    @staticmethod
+    def verify(filein, fshares=None, max_chunk=DEFAULT_CHUNK, workers=None, observer=None):
+        """Check that a set of shares reconstructs an authentic file without writing any plaintext.
+
+        Segmented files are checked segment by segment, stopping at the first one that fails; segments of stream
+        ciphers are authenticated from their ciphertext without being decrypted. Files using the stream container are
+        decrypted into a discarding sink, since their tag covers the whole plaintext. Returns whether the file is
+        authentic.
+        """
+        loaded = CFShare._load_sources(filein, fshares, observer)
+        if loaded is None:
+            return False
+        mode, key, iv, tag, sources = loaded
+        params = CFShare._unpack_mode(mode)
+        try:
+            if params['container'] == ContainerFormat.SEGMENTED:
+                segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'], observer)
+                segmenter.verify_stream(CFShare._open_chunks(sources, max_chunk, observer), tag, workers)
+            else:
+                CFShare._decrypt_stream(params['cipher'], key, iv, tag, CFShare._open_reader(sources, observer),
+                                        DiscardWriter(), max_chunk, observer)
+        except InvalidSignature:
+            return False
+        finally:
+            if isinstance(sources, DispersedPayload):
+                sources.close()
+        return True
+
+    @staticmethod
+    def open_reconstructed(filein, fshares=None):
+        """Return a seekable read-only file object over the plaintext, decrypting only the ranges that are read.
+
+        Files split with a segment size are opened in constant time, every segment being authenticated when it is
+        read. Files using the stream container are authenticated by a full pass (without writing any plaintext)
+        before the object is returned.
+        """
+        loaded = CFShare._load_sources(filein, fshares)
+        if loaded is None:
+            return None
+        mode, key, iv, tag, sources = loaded
+        params = CFShare._unpack_mode(mode)
+        if params['codec'] != Codec.NONE:
+            print("Compressed files can't be read at random positions")
+            sys.exit(1)
+        payload = CFShare._open_payload(sources)
+        if params['container'] == ContainerFormat.SEGMENTED:
+            segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'])
+            return SegmentedReader(payload, segmenter, tag)
+        try:
+            CFShare._decrypt_stream(params['cipher'], key, iv, tag, CFShare._open_reader(sources), DiscardWriter())
+        except InvalidSignature:
+            payload.close()
+            print("The shares were incorrect", file=sys.stderr)
+            sys.exit(1)
+        return StreamReader(payload, params['cipher'], key, iv)
+
+    @staticmethod
+    def _load_sources(filein, fshares, observer=None):
+        """Combine the key and locate the payload of a set of shares.
+
+        ``filein`` and ``fshares`` hold paths or readable file objects positioned at the start of the shares. Returns
+        the mode field, the key, the IV, the tag and the sources of the payload: either the ``(path, offset)`` pairs
+        holding it or a ``DispersedPayload``.
+        """
         if fshares is None:
             fshares = []
         if len(filein) == 1 and len(fshares) == 0:
-            print("You can't reconstruct this file without passing the shares")
+            print("You can't reconstruct this file without passing the shares", file=sys.stderr)
             sys.exit(1)
         elif len(filein) == 1 and len(fshares) > 0:
             shares = []
             for share in fshares:
-                with open(share, 'rb') as fi:
+                with open_source(share) as fi:
                     mode = int.from_bytes(fi.read(8), 'little')
                     schema_lens = CFShare._get_len_elements_from_mode(mode)
                     index = int.from_bytes(fi.read(schema_lens['share_index']), 'little')
                     len_key = int.from_bytes(fi.read(schema_lens['share_len']), 'little')
-                    p_key = fi.read(len_key).decode("utf-8")
+                    p_key = fi.read(len_key)
                     shares.append((index, p_key))
             shares = [item[1] for item in shares]
             try:
-                key = Shamir().combine(shares)
-            except binascii.Error:
-                print("The shares were incorrect")
+                with span(observer, 'key_combine'):
+                    key = CFShare._combine_shares(mode, shares)
+            except (binascii.Error, ValueError):
+                print("The shares were incorrect", file=sys.stderr)
                 sys.exit(1)
-            with open(filein[0], 'rb') as fi:
+            with open_source(filein[0]) as fi:
                 iv, tag = [fi.read(x) for x in [schema_lens['iv'], schema_lens['tag']]]
-                cipher = CFShare._get_cipher_from_mode(mode, key, iv)
-                h = hmac.HMAC(key, hashes.SHA256(), default_backend())
-                decryptor = cipher.decryptor()
-                with open(fileout, 'wb') as fo:
-                    b = fi.read(max_chunk)
-                    while b:
-                        ret = decryptor.update(b)
-                        h.update(ret)
-                        fo.write(ret)
-                        b = fi.read(max_chunk)
-                    fo.write(decryptor.finalize())
-                try:
-                    h.verify(tag)
-                except InvalidSignature:
-                    print("The shares were incorrect")
-                    os.remove(fileout)
-                    sys.exit(1)
+            sources = [(filein[0], schema_lens['iv'] + schema_lens['tag'])]
+            return mode, key, iv, tag, sources
         elif len(filein) > 1 and len(fshares) == 0:
-            mode, iv, tag, incomplete, ordered_frags, shares, len_share = CFShare._get_info_from_frags(filein)
+            mode, iv, tag, layout, ordered_frags, shares, len_share, dispersal = CFShare._get_info_from_frags(filein)
             schema_lens = CFShare._get_len_elements_from_mode(mode)
-            try:
-                key = Shamir().combine(shares)
-            except binascii.Error:
-                print("The shares were incorrect")
+            if layout == Layout.DISPERSED and len(ordered_frags) < dispersal['threshold']:
+                print("At least {} shares are required".format(dispersal['threshold']), file=sys.stderr)
                 sys.exit(1)
-            cipher = CFShare._get_cipher_from_mode(mode, key, iv)
-            decryptor = cipher.decryptor()
-            h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
-            source = CFShare._get_complete_source(ordered_frags, incomplete, max_chunk, len_share, mode)
-            with open(source, 'rb') as fi:
-                with open(fileout, "wb") as fo:
-                    if not incomplete:
-                        [fi.read(x) for x in
-                         [schema_lens['incomplete'], schema_lens['mode'], schema_lens['share_index'],
-                          schema_lens['share_len'], len_share, schema_lens['iv'], schema_lens['tag']]]
-                    b = fi.read(max_chunk)
-                    while b:
-                        ret = decryptor.update(b)
-                        h.update(ret)
-                        fo.write(ret)
-                        b = fi.read(max_chunk)
-                    fo.write(decryptor.finalize())
             try:
-                if incomplete:
-                    os.remove(source)
-                h.verify(tag)
-            except InvalidSignature:
-                print("The shares were incorrect")
-                os.remove(fileout)
+                with span(observer, 'key_combine'):
+                    key = CFShare._combine_shares(mode, shares)
+            except (binascii.Error, ValueError):
+                print("The shares were incorrect", file=sys.stderr)
                 sys.exit(1)
+            # Fragments are streamed in order straight into the decryptor, skipping their headers in place
+            header_len = CFShare._get_header_len(layout, schema_lens, len_share)
+            if layout == Layout.DISPERSED:
+                threshold = dispersal['threshold']
+                sources = DispersedPayload([(frag, header_len) for frag in ordered_frags[:threshold]],
+                                           dispersal['indexes'][:threshold], threshold, dispersal['payload_len'])
+            elif layout == Layout.FRAGMENT:
+                sources = [(frag, header_len) for frag in ordered_frags]
+            else:
+                sources = [(ordered_frags[0], header_len)]
+            return mode, key, iv, tag, sources
+        else:
+            print('You cant mix input files and shares', file=sys.stderr)
+            return None
+
+    @staticmethod
+    def _encrypt_stream(mode, key, iv, f, sink, max_chunk=DEFAULT_CHUNK, observer=None):
+        encryptor = CFShare._get_cipher_from_mode(mode, key, iv).encryptor()
+        h = hmac.HMAC(key, hashes.SHA256(), default_backend())
+
+        def transform(view, out):
+            with span(observer, 'mac', len(view)):
+                h.update(view)
+            with span(observer, 'encrypt', len(view)):
+                return encryptor.update_into(view, out)
+
+        Pipeline(max_chunk).run(f.readinto, transform, sink.write)
+        sink.write(encryptor.finalize())
+        return h.finalize()
+
+    @staticmethod
+    def _decrypt_stream(mode, key, iv, tag, reader, sink, max_chunk=DEFAULT_CHUNK, observer=None):
+        decryptor = CFShare._get_cipher_from_mode(mode, key, iv).decryptor()
+        h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
+
+        def transform(view, out):
+            with span(observer, 'decrypt', len(view)):
+                n = decryptor.update_into(view, out)
+            with span(observer, 'mac', n):
+                h.update(memoryview(out)[:n])
+            return n
+
+        try:
+            Pipeline(max_chunk).run(reader.readinto, transform, sink.write)
+        finally:
+            reader.close()
+        ret = decryptor.finalize()
+        h.update(ret)
+        sink.write(ret)
+        h.verify(tag)
+
+    @staticmethod
+    def _decrypt_chunks(mode, key, iv, tag, chunks, observer=None):
+        decryptor = CFShare._get_cipher_from_mode(mode, key, iv).decryptor()
+        h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
+        for chunk in chunks:
+            with span(observer, 'decrypt', len(chunk)):
+                pt = decryptor.update(chunk)
+            with span(observer, 'mac', len(pt)):
+                h.update(pt)
+            yield pt
+        ret = decryptor.finalize()
+        h.update(ret)
+        if ret:
+            yield ret
+        h.verify(tag)
+
+    @staticmethod
+    def _decrypt_to_file(mode_field, key, iv, tag, sources, fileout, max_chunk, workers, observer=None):
+        params = CFShare._unpack_mode(mode_field)
+        try:
+            with open(fileout, "wb") as fo:
+                sink = fo if observer is None else TimedWriter(fo, observer, 'write')
+                if params['codec'] != Codec.NONE:
+                    for pt in CFShare._plaintext_chunks(params, key, iv, tag, sources, max_chunk, workers, observer):
+                        sink.write(pt)
+                elif params['container'] == ContainerFormat.SEGMENTED:
+                    segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'], observer)
+                    segmenter.decrypt_stream(CFShare._open_chunks(sources, max_chunk, observer), sink, tag, workers)
+                else:
+                    CFShare._decrypt_stream(params['cipher'], key, iv, tag, CFShare._open_reader(sources, observer),
+                                            sink, max_chunk, observer)
+        except InvalidSignature:
+            print("The shares were incorrect", file=sys.stderr)
+            os.remove(fileout)
+            sys.exit(1)
+        finally:
+            if isinstance(sources, DispersedPayload):
+                sources.close()
+
+    @staticmethod
+    def _plaintext_chunks(params, key, iv, tag, sources, max_chunk, workers, observer):
+        chunks = CFShare._open_chunks(sources, max_chunk, observer)
+        if params['container'] == ContainerFormat.SEGMENTED:
+            segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'], observer)
+            chunks = segmenter.decrypt_chunks(chunks, tag, workers)
+        else:
+            chunks = CFShare._decrypt_chunks(params['cipher'], key, iv, tag, chunks, observer)
+        if params['codec'] != Codec.NONE:
+            chunks = decompress_chunks(chunks, params['codec'], workers, observer)
+        return chunks
+
+    @staticmethod
+    def _open_chunks(sources, max_chunk=DEFAULT_CHUNK, observer=None):
+        if isinstance(sources, DispersedPayload):
+            chunks = sources.chunks()
         else:
-            print('You cant mix input files and shares')
+            chunks = PrefetchReader(sources, max_chunk)
+        if observer is not None:
+            return TimedReader(chunks, observer, 'read', CFShare._get_payload_size(sources), progress=True)
+        return chunks
+
+    @staticmethod
+    def _open_reader(sources, observer=None):
+        if isinstance(sources, DispersedPayload):
+            reader = IterReader(sources.chunks())
+        else:
+            reader = ConcatReader(sources)
+        if observer is not None:
+            return TimedReader(reader, observer, 'read', CFShare._get_payload_size(sources), progress=True)
+        return reader
+
+    @staticmethod
+    def _get_payload_size(sources):
+        if isinstance(sources, DispersedPayload):
+            return sources.size
+        try:
+            return sum(os.stat(path).st_size - offset for path, offset in sources)
+        except (TypeError, OSError):
+            # File objects
+            return None
+
+    @staticmethod
+    def _open_payload(sources):
+        if isinstance(sources, DispersedPayload):
+            return sources
+        return PayloadFile(sources)
 
     @staticmethod
     def _get_info_from_frags(frags):
         nonce = None
         tag = None
-        incomplete = None
+        layout = None
+        dispersal = None
         ordered_frags = []
         shares = []
         len_share = None
         mode = None
         for frag in frags:
-            with open(frag, 'rb') as f:
-                tmp_incomplete = bool.from_bytes(f.read(1), 'little')
+            with open_source(frag) as f:
+                tmp_layout = Layout(int.from_bytes(f.read(1), 'little'))
                 mode = int.from_bytes(f.read(8), 'little')
                 schema_lens = CFShare._get_len_elements_from_mode(mode)
                 index = int.from_bytes(f.read(schema_lens['share_index']), 'little')
                 len_share = int.from_bytes(f.read(schema_lens['share_len']), 'little')
-                p_key = f.read(len_share).decode("utf-8")
+                p_key = f.read(len_share)
                 shares.append((index, p_key))
                 found_nonce, found_tag = [f.read(x) for x in [schema_lens['iv'], schema_lens['tag']]]
                 if nonce is None:
                     nonce = found_nonce
                 elif nonce != found_nonce:
-                    print('Fragments have discrepancies, aborting...')
+                    print('Fragments have discrepancies, aborting...', file=sys.stderr)
                     sys.exit(1)
                 if tag is None:
                     tag = found_tag
                 elif tag != found_tag:
-                    print('Fragments have discrepancies, aborting...')
+                    print('Fragments have discrepancies, aborting...', file=sys.stderr)
                     sys.exit(1)
-                if incomplete is None:
-                    incomplete = tmp_incomplete
-                elif incomplete != tmp_incomplete:
-                    print('Fragments have have discrepancies, aborting...')
+                if layout is None:
+                    layout = tmp_layout
+                elif layout != tmp_layout:
+                    print('Fragments have have discrepancies, aborting...', file=sys.stderr)
                     sys.exit(1)
+                if layout == Layout.DISPERSED:
+                    found_dispersal = {'payload_len': int.from_bytes(f.read(schema_lens['payload_len']), 'little'),
+                                       'threshold': int.from_bytes(f.read(schema_lens['threshold']), 'little')}
+                    if dispersal is None:
+                        dispersal = found_dispersal
+                    elif dispersal != found_dispersal:
+                        print('Fragments have discrepancies, aborting...', file=sys.stderr)
+                        sys.exit(1)
                 ordered_frags.append((index, frag))
-                f.close()
         ordered_frags.sort(key=lambda tup: tup[0])
+        if dispersal is not None:
+            dispersal['indexes'] = [item[0] for item in ordered_frags]
         ordered_frags = [item[1] for item in ordered_frags]
         shares = [item[1] for item in shares]
-        return mode, nonce, tag, incomplete, ordered_frags, shares, len_share
+        return mode, nonce, tag, layout, ordered_frags, shares, len_share, dispersal
 
     @staticmethod
-    def _get_complete_source(ordered_frags, incomplete, max_chunk, len_share, mode):
-        source = ordered_frags[0]
-        schema_lens = CFShare._get_len_elements_from_mode(mode)
-        if incomplete:
-            source = tempfile.NamedTemporaryFile(delete=False, prefix='cfshare_').name
-            with open(source, "wb") as fo:
-                for frag in ordered_frags:
-                    with open(frag, 'rb') as fi:
-                        [fi.read(x) for x in
-                         [schema_lens['incomplete'], schema_lens['mode'], schema_lens['share_index'],
-                          schema_lens['share_len'], len_share, schema_lens['iv'], schema_lens['tag']]]
-                        b = fi.read(max_chunk)
-                        while b:
-                            fo.write(b)
-                            b = fi.read(max_chunk)
-        return source
+    def _check_split(min_shares, total_shares, sharesonly, dispersed, mode, segment_size, compression, length):
+        """Validate the options of a split before anything is written and return its layout.
+
+        Raises ``ValueError`` for an invalid segment size and ``ImportError`` if ``compression`` is not installed.
+        """
+        layout = CFShare._get_layout(min_shares, total_shares, sharesonly, dispersed)
+        if layout == Layout.FRAGMENT and length is None:
+            print("The length of the input is required to split it into fragments")
+            sys.exit(1)
+        if layout == Layout.FRAGMENT and compression != Codec.NONE:
+            print("Fragments can't be compressed, the length of their payload must be known in advance")
+            sys.exit(1)
+        check_codec(compression)
+        segment_size = CFShare._get_segment_size(mode, segment_size)
+        if segment_size is not None:
+            check_segment_size(segment_size)
+        return layout
 
     @staticmethod
-    def _get_cipher_from_mode(mode, key, iv):
-        if isinstance(mode, int):
-            mode = CipherMode(mode)
-        if mode == CipherMode.AES:
-            return Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
-        elif mode == CipherMode.ChaCha20:
-            return Cipher(algorithms.ChaCha20(key, iv), mode=None, backend=default_backend())
-        elif mode == CipherMode.Camellia:
-            return Cipher(algorithms.Camellia(key), modes.CTR(iv), backend=default_backend())
+    def _get_layout(min_shares, total_shares, sharesonly, dispersed):
+        if sharesonly and dispersed:
+            print("The encrypted content can't be dispersed when using shares only")
+            sys.exit(1)
+        if dispersed:
+            if total_shares > 255:
+                # A piece is the evaluation of the dispersal polynomial at x = index + 1 in GF(256)
+                print("At most 255 shares can be dispersed")
+                sys.exit(1)
+            return Layout.DISPERSED
+        elif not sharesonly and total_shares == min_shares:
+            return Layout.FRAGMENT
+        return Layout.COPY
+
+    @staticmethod
+    def _get_segment_size(mode, segment_size):
+        if segment_size is None and get_cipher_spec(mode).aead:
+            # AEAD ciphers seal one segment at a time
+            return DEFAULT_SEGMENT_SIZE
+        return segment_size
+
+    @staticmethod
+    def _get_remaining_length(reader):
+        try:
+            st = os.fstat(reader.fileno())
+            if stat.S_ISREG(st.st_mode):
+                return st.st_size - reader.tell()
+        except (AttributeError, OSError):
+            pass
+        return None
+
+    @staticmethod
+    def _get_header_len(layout, schema_lens, len_share):
+        fields = ['layout', 'mode', 'share_index', 'share_len', 'iv', 'tag']
+        if layout == Layout.DISPERSED:
+            fields += ['payload_len', 'threshold']
+        return sum(schema_lens[x] for x in fields) + len_share
+
+    @staticmethod
+    def _write_share(fo, mode_field, share, schema_lens):
+        fo.write(int.to_bytes(mode_field, schema_lens['mode'], 'little'))
+        fo.write(int.to_bytes(share[0], schema_lens['share_index'], 'little'))
+        fo.write(int.to_bytes(len(share[1]), schema_lens['share_len'], 'little'))
+        fo.write(share[1])
+
+    @staticmethod
+    def _create_shares(scheme, min_shares, total_shares, key):
+        if scheme == ShareScheme.GF256:
+            shares = ShamirGF256().create(min_shares, total_shares, key)
+        else:
+            shares = [item.encode('utf-8') for item in Shamir().create(min_shares, total_shares, key)]
+        return [(shares.index(item), item) for item in shares]
+
+    @staticmethod
+    def _create_many_shares(scheme, min_shares, total_shares, keys):
+        if scheme == ShareScheme.GF256:
+            created = ShamirGF256().create_many(min_shares, total_shares, keys)
         else:
+            created = [[item.encode('utf-8') for item in shares]
+                       for shares in Shamir().create_many(min_shares, total_shares, keys)]
+        return [list(enumerate(shares)) for shares in created]
+
+    @staticmethod
+    def _combine_shares(mode_field, shares):
+        if CFShare._unpack_mode(mode_field)['scheme'] == ShareScheme.GF256:
+            return ShamirGF256().combine(shares)
+        return Shamir().combine([item.decode('utf-8') for item in shares])
+
+    @staticmethod
+    def _issue_share(mode_field, shares, index):
+        # A new share with the given index on the polynomial of the existing ones
+        if CFShare._unpack_mode(mode_field)['scheme'] == ShareScheme.GF256:
+            return ShamirGF256().issue(shares, index + 1)
+        share = Shamir().issue([item.decode('utf-8') for item in shares])
+        if share is None:
+            raise ValueError("The shares are malformed")
+        return share.encode('utf-8')
+
+    @staticmethod
+    def _pack_mode(mode, container=ContainerFormat.STREAM, segment_size=None, scheme=ShareScheme.PRIME256,
+                   threshold=0, codec=Codec.NONE):
+        # The first byte of the mode field holds the cipher, the following ones describe the container and the
+        # secret sharing scheme, then two bytes hold the minimum number of shares (0 when unknown) and one byte the
+        # compression codec
+        segment_bits = 0 if segment_size is None else segment_size.bit_length() - 1
+        if threshold > 0xffff:
+            threshold = 0
+        return (mode.value | container.value << 8 | segment_bits << 16 | scheme.value << 24 | threshold << 32 |
+                codec.value << 48)
+
+    @staticmethod
+    def _unpack_mode(mode_field):
+        segment_bits = (mode_field >> 16) & 0xff
+        return {'cipher': CipherMode(mode_field & 0xff),
+                'container': ContainerFormat((mode_field >> 8) & 0xff),
+                'segment_size': 1 << segment_bits if segment_bits else None,
+                'scheme': ShareScheme((mode_field >> 24) & 0xff),
+                'threshold': (mode_field >> 32) & 0xffff,
+                'codec': Codec((mode_field >> 48) & 0xff)}
+
+    @staticmethod
+    def _get_cipher_from_mode(mode, key, iv):
+        spec = get_cipher_spec(mode)
+        if spec is None or spec.aead:
             return None
+        return spec.cipher(key, iv)
 
     @staticmethod
     def _get_len_elements_from_mode(mode):
-        if isinstance(mode, int):
-            mode = CipherMode(mode)
-        if mode == CipherMode.AES:
-            return {'incomplete': 1, 'mode': 8, 'share_index': 8, 'share_len': 8, 'iv': 16, 'tag': 32}
-        elif mode == CipherMode.ChaCha20:
-            return {'incomplete': 1, 'mode': 8, 'share_index': 8, 'share_len': 8, 'iv': 16, 'tag': 32}
-        elif mode == CipherMode.Camellia:
-            return {'incomplete': 1, 'mode': 8, 'share_index': 8, 'share_len': 8, 'iv': 16, 'tag': 32}
-        else:
+        spec = get_cipher_spec(mode)
+        if spec is None:
             return None
+        return spec.lens()
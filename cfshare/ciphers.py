@@ -0,0 +1,117 @@
+import enum
+
+
+class CipherMode(enum.Enum):
+    AES = 1
+    ChaCha20 = 2
+    Camellia = 3
+    AESGCM = 4
+    ChaCha20Poly1305 = 5
+
+
+_BASE_LENS = {'layout': 1, 'mode': 8, 'share_index': 8, 'share_len': 8, 'payload_len': 8, 'threshold': 8}
+
+
+class StreamCipher:
+    """A seekable stream cipher, authenticated separately with HMAC-SHA256.
+
+    ``counter_block`` is the number of keystream bytes per counter step and ``byteorder`` the endianness of the
+    counter held by the IV.
+    """
+
+    aead = False
+    segment_tag_len = 32
+
+    def __init__(self, make_cipher, counter_block, byteorder, iv_len=16):
+        self.make_cipher = make_cipher
+        self.counter_block = counter_block
+        self.byteorder = byteorder
+        self.iv_len = iv_len
+
+    def lens(self):
+        return dict(_BASE_LENS, iv=self.iv_len, tag=32)
+
+    def cipher(self, key, iv):
+        return self.make_cipher(key, iv)
+
+    def seek_iv(self, iv, offset):
+        """Return the IV whose keystream starts at byte ``offset`` of the keystream of ``iv``."""
+        counter = (int.from_bytes(iv, self.byteorder) + offset // self.counter_block) % (1 << (8 * self.iv_len))
+        return int.to_bytes(counter, self.iv_len, self.byteorder)
+
+
+class AEADCipher:
+    """A one-pass authenticated cipher, only usable with the segmented container.
+
+    Segment ``i`` is sealed under the IV xor-ed with ``i``, its index being authenticated as associated data.
+    """
+
+    aead = True
+
+    def __init__(self, make_aead, iv_len=12, segment_tag_len=16):
+        self.make_aead = make_aead
+        self.iv_len = iv_len
+        self.segment_tag_len = segment_tag_len
+
+    def lens(self):
+        return dict(_BASE_LENS, iv=self.iv_len, tag=32)
+
+    def aead_for(self, key):
+        return self.make_aead(key)
+
+    def segment_nonce(self, iv, index):
+        return int.to_bytes(int.from_bytes(iv, 'big') ^ index, self.iv_len, 'big')
+
+
+_ciphers = {}
+
+
+def register_cipher(mode, spec):
+    """Make ``spec`` (a ``StreamCipher`` or an ``AEADCipher``) available under ``mode``."""
+    _ciphers[mode] = spec
+
+
+def get_cipher_spec(mode):
+    if isinstance(mode, int):
+        mode = CipherMode(mode & 0xff)
+    return _ciphers.get(mode)
+
+
+# The cipher implementations are imported the first time a key is used, so that importing this module (and the CLI)
+# does not load the cryptography backends
+
+
+def _aes_ctr(key, iv):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend())
+
+
+def _chacha20(key, iv):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    return Cipher(algorithms.ChaCha20(key, iv), mode=None, backend=default_backend())
+
+
+def _camellia_ctr(key, iv):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    return Cipher(algorithms.Camellia(key), modes.CTR(iv), backend=default_backend())
+
+
+def _aes_gcm(key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def _chacha20_poly1305(key):
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    return ChaCha20Poly1305(key)
+
+
+register_cipher(CipherMode.AES, StreamCipher(_aes_ctr, 16, 'big'))
+# The 16 bytes nonce of ChaCha20 starts with the little-endian counter of 64 bytes blocks
+register_cipher(CipherMode.ChaCha20, StreamCipher(_chacha20, 64, 'little'))
+register_cipher(CipherMode.Camellia, StreamCipher(_camellia_ctr, 16, 'big'))
+register_cipher(CipherMode.AESGCM, AEADCipher(_aes_gcm))
+register_cipher(CipherMode.ChaCha20Poly1305, AEADCipher(_chacha20_poly1305))
@@ -0,0 +1,133 @@
+import enum
+import zlib
+
+from cryptography.exceptions import InvalidSignature
+
+from cfshare.metrics import span
+from cfshare.segments import ordered_map
+from cfshare.streams import IterReader
+
+# The compressed payload is a sequence of frames, every block of the input being compressed independently so that
+# blocks are compressed and decompressed in parallel: [compressed length 4][compressed block]
+DEFAULT_BLOCK_SIZE = 1 << 20
+FRAME_LEN_LEN = 4
+
+
+class Codec(enum.Enum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    ZSTD = 3
+
+
+def get_codec(name):
+    """Return the codec called ``name`` (``zlib``, ``lzma``, ``zstd`` or ``none``), or ``None`` if unknown."""
+    try:
+        return Codec[name.upper()]
+    except KeyError:
+        return None
+
+
+def check_codec(codec):
+    """Raise ``ImportError`` if the package required by ``codec`` is not installed."""
+    if codec == Codec.ZSTD:
+        _import_zstd()
+
+
+def compress_reader(reader, codec, block_size=DEFAULT_BLOCK_SIZE, workers=None, level=None, observer=None):
+    """Return a reader over the frames compressing the content of ``reader``, compressed on ``workers`` threads."""
+    if not 0 < block_size < 1 << 31:
+        raise ValueError("The block size must be positive and lower than 2 GiB")
+    compress = _compressor(codec, level)
+
+    def frame(block):
+        with span(observer, 'compress', len(block)):
+            compressed = compress(block)
+        return int.to_bytes(len(compressed), FRAME_LEN_LEN, 'little') + compressed
+
+    blocks = ((block,) for block in iter(lambda: reader.read(block_size), b''))
+    return IterReader(ordered_map(frame, blocks, workers))
+
+
+def decompress_chunks(chunks, codec, workers=None, observer=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield the content of the frames read from the iterable ``chunks``, decompressed on ``workers`` threads.
+
+    ``InvalidSignature`` is raised if a frame is truncated, longer than ``codec`` compresses a block of
+    ``block_size`` bytes to or can't be decompressed, as the payload was then not the one that was split.
+    """
+    decompress = _decompressor(codec)
+
+    def unframe(compressed):
+        with span(observer, 'decompress', len(compressed)):
+            try:
+                return decompress(compressed)
+            except Exception:
+                raise InvalidSignature("The compressed payload is corrupt")
+
+    yield from ordered_map(unframe, _frames(chunks, _max_frame_len(codec, block_size)), workers)
+
+
+def _frames(chunks, max_length):
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        done = 0
+        while len(buffer) - done >= FRAME_LEN_LEN:
+            length = int.from_bytes(buffer[done:done + FRAME_LEN_LEN], 'little')
+            # The payload is decrypted before it is authenticated, a corrupt length must not be buffered
+            if length > max_length:
+                raise InvalidSignature("The compressed payload is corrupt")
+            end = done + FRAME_LEN_LEN + length
+            if len(buffer) < end:
+                break
+            yield (bytes(buffer[done + FRAME_LEN_LEN:end]),)
+            done = end
+        del buffer[:done]
+    if buffer:
+        raise InvalidSignature("The compressed payload is truncated")
+
+
+def _max_frame_len(codec, block_size):
+    # The longest a block can be compressed to, the bound of the library of each codec
+    if codec == Codec.ZLIB:
+        # compressBound
+        return block_size + (block_size >> 12) + (block_size >> 14) + (block_size >> 25) + 13
+    elif codec == Codec.LZMA:
+        # lzma_stream_buffer_bound: 3 bytes for every 64 KiB LZMA2 chunk, and the stream, block and index headers
+        return block_size + 3 * (block_size // (1 << 16) + 1) + (1 << 11)
+    elif codec == Codec.ZSTD:
+        # ZSTD_COMPRESSBOUND
+        return block_size + (block_size >> 8) + (((128 << 10) - block_size) >> 11 if block_size < 128 << 10 else 0)
+    raise ValueError("Unknown codec {}".format(codec))
+
+
+def _compressor(codec, level):
+    if codec == Codec.ZLIB:
+        return lambda data: zlib.compress(data, 6 if level is None else level)
+    elif codec == Codec.LZMA:
+        import lzma
+        return lambda data: lzma.compress(data, preset=level)
+    elif codec == Codec.ZSTD:
+        zstd = _import_zstd()
+        return lambda data: zstd.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError("Unknown codec {}".format(codec))
+
+
+def _decompressor(codec):
+    if codec == Codec.ZLIB:
+        return zlib.decompress
+    elif codec == Codec.LZMA:
+        import lzma
+        return lzma.decompress
+    elif codec == Codec.ZSTD:
+        zstd = _import_zstd()
+        return lambda data: zstd.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown codec {}".format(codec))
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstandard package is required to use zstd compression")
+    return zstandard
@@ -0,0 +1,265 @@
+import hashlib
+import io
+import json
+import math
+import os
+import secrets
+import sys
+import threading
+
+from cryptography.exceptions import InvalidSignature, InvalidTag
+
+from cfshare.cfshare import CFShare, CipherMode, ShareScheme
+from cfshare.ciphers import get_cipher_spec
+from cfshare.segments import ordered_map
+from cfshare.streams import DEFAULT_CHUNK
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy as _fastcdc
+except ImportError:
+    _fastcdc = None
+
+# An incremental split cuts the input into content-defined chunks and stores every distinct chunk once in a chunk
+# store, encrypted under a key derived from its content (convergent encryption), so that the chunks left unchanged by
+# a new version of the input are not written again. A chunk is stored in <store>/<id[:2]>/<id>, where the id is the
+# SHA-256 of its key. Only the manifest of a version is split into shares:
+#   [header length 8][JSON header {"mode", "size", "chunks"}][key 32][length 4]...
+# and the ids of its chunks are listed in <fileout>.chunks, so that unreferenced chunks are pruned without any key.
+DEFAULT_MIN_CHUNK = 1 << 14
+DEFAULT_AVG_CHUNK = 1 << 16
+DEFAULT_MAX_CHUNK = 1 << 18
+HEADER_LEN_LEN = 8
+CHUNK_KEY_LEN = 32
+CHUNK_LEN_LEN = 4
+CHUNKS_SUFFIX = '.chunks'
+# The bounds of the chunk sizes accepted by FastCDC
+MIN_CHUNK_BOUND = 64
+MIN_AVG_CHUNK = 256
+MAX_CHUNK_BOUNDS = (1 << 10, 1 << 30)
+# The gear table of FastCDC, the same as the ``fastcdc`` package, so that both chunkers cut the same chunks
+_GEAR = [0x5c95c078, 0x22408989, 0x2d48a214, 0x12842087, 0x530f8afb, 0x474536b9, 0x2963b4f1, 0x44cb738b,
+         0x4ea7403d, 0x4d606b6e, 0x074ec5d3, 0x3af39d18, 0x726003ca, 0x37a62a74, 0x51a2f58e, 0x7506358e,
+         0x5d4ab128, 0x4d4ae17b, 0x41e85924, 0x470c36f7, 0x4741cbe1, 0x01bb7f30, 0x617c1de3, 0x2b0c3a1f,
+         0x50c48f73, 0x21a82d37, 0x6095ace0, 0x419167a0, 0x3caf49b0, 0x40cea62d, 0x66bc1c66, 0x545e1dad,
+         0x2bfa77cd, 0x6e85da24, 0x5fb0bdc5, 0x652cfc29, 0x3a0ae1ab, 0x2837e0f3, 0x6387b70e, 0x13176012,
+         0x4362c2bb, 0x66d8f4b1, 0x37fce834, 0x2c9cd386, 0x21144296, 0x627268a8, 0x650df537, 0x2805d579,
+         0x3b21ebbd, 0x7357ed34, 0x3f58b583, 0x7150ddca, 0x7362225e, 0x620a6070, 0x2c5ef529, 0x7b522466,
+         0x768b78c0, 0x4b54e51e, 0x75fa07e5, 0x06a35fc6, 0x30b71024, 0x1c8626e1, 0x296ad578, 0x28d7be2e,
+         0x1490a05a, 0x7cee43bd, 0x698b56e3, 0x09dc0126, 0x4ed6df6e, 0x02c1bfc7, 0x2a59ad53, 0x29c0e434,
+         0x7d6c5278, 0x507940a7, 0x5ef6ba93, 0x68b6af1e, 0x46537276, 0x611bc766, 0x155c587d, 0x301ba847,
+         0x2cc9dda7, 0x0a438e2c, 0x0a69d514, 0x744c72d3, 0x4f326b9b, 0x7ef34286, 0x4a0ef8a7, 0x6ae06ebe,
+         0x669c5372, 0x12402dcb, 0x5feae99d, 0x76c7f4a7, 0x6abdb79c, 0x0dfaa038, 0x20e2282c, 0x730ed48b,
+         0x069dac2f, 0x168ecf3e, 0x2610e61f, 0x2c512c8e, 0x15fb8c06, 0x5e62bc76, 0x69555135, 0x0adb864c,
+         0x4268f914, 0x349ab3aa, 0x20edfdb2, 0x51727981, 0x37b4b3d8, 0x5dd17522, 0x6b2cbfe4, 0x5c47cf9f,
+         0x30fa1ccd, 0x23dedb56, 0x13d1f50a, 0x64eddee7, 0x0820b0f7, 0x46e07308, 0x1e2d1dfd, 0x17b06c32,
+         0x250036d8, 0x284dbf34, 0x68292ee0, 0x362ec87c, 0x087cb1eb, 0x76b46720, 0x104130db, 0x71966387,
+         0x482dc43f, 0x2388ef25, 0x524144e1, 0x44bd834e, 0x448e7da3, 0x3fa6eaf9, 0x3cda215c, 0x3a500cf3,
+         0x395cb432, 0x5195129f, 0x43945f87, 0x51862ca4, 0x56ea8ff1, 0x201034dc, 0x4d328ff5, 0x7d73a909,
+         0x6234d379, 0x64cfbf9c, 0x36f6589a, 0x0a2ce98a, 0x5fe4d971, 0x03bc15c5, 0x44021d33, 0x16c1932b,
+         0x37503614, 0x1acaf69d, 0x3f03b779, 0x49e61a03, 0x1f52d7ea, 0x1c6ddd5c, 0x062218ce, 0x07e7a11a,
+         0x1905757a, 0x7ce00a53, 0x49f44f29, 0x4bcc70b5, 0x39feea55, 0x5242cee8, 0x3ce56b85, 0x00b81672,
+         0x46beeccc, 0x3ca0ad56, 0x2396cee8, 0x78547f40, 0x6b08089b, 0x66a56751, 0x781e7e46, 0x1e2cf856,
+         0x3bc13591, 0x494a4202, 0x520494d7, 0x2d87459a, 0x757555b6, 0x42284cc1, 0x1f478507, 0x75c95dff,
+         0x35ff8dd7, 0x4e4757ed, 0x2e11f88c, 0x5e1b5048, 0x420e6699, 0x226b0695, 0x4d1679b4, 0x5a22646f,
+         0x161d1131, 0x125c68d9, 0x1313e32e, 0x4aa85724, 0x21dc7ec1, 0x4ffa29fe, 0x72968382, 0x1ca8eef3,
+         0x3f3b1c28, 0x39c2fb6c, 0x6d76493f, 0x7a22a62e, 0x789b1c2a, 0x16e0cb53, 0x7deceeeb, 0x0dc7e1c6,
+         0x5c75bf3d, 0x52218333, 0x106de4d6, 0x7dc64422, 0x65590ff4, 0x2c02ec30, 0x64a9ac67, 0x59cab2e9,
+         0x4a21d2f3, 0x0f616e57, 0x23b54ee8, 0x02730aaa, 0x2f3c634d, 0x7117fc6c, 0x01ac6f05, 0x5a9ed20c,
+         0x158c4e2a, 0x42b699f0, 0x0c7c14b3, 0x02bd9641, 0x15ad56fc, 0x1c722f60, 0x7da1af91, 0x23e0dbcb,
+         0x0e93e12b, 0x64b2791d, 0x440d2476, 0x588ea8dd, 0x4665a658, 0x7446c418, 0x1877a774, 0x5626407e,
+         0x7f63bd46, 0x32d2dbd8, 0x3c790f4a, 0x772b7239, 0x6f8b2826, 0x677ff609, 0x0dc82c11, 0x23ffe354,
+         0x2eac53a6, 0x16139e09, 0x0afd0dbc, 0x2a4d4237, 0x56a368c7, 0x234325e4, 0x2dce9187, 0x32e8ea7e]
+
+
+def content_chunks(reader, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK, max_size=DEFAULT_MAX_CHUNK):
+    """Yield the content of ``reader`` cut into chunks whose boundaries depend only on the content around them.
+
+    Boundaries are placed by FastCDC: a gear rolling hash is checked against a stricter mask before ``avg_size`` bytes
+    and a looser one after, so that chunks are close to ``avg_size`` bytes long, at least ``min_size`` and at most
+    ``max_size`` bytes. Inserting or removing bytes only changes the chunks around the edit.
+
+    The hash is computed by the native chunker of the ``fastcdc`` package when it is installed. The pure Python
+    fallback cuts the same chunks but only runs at a few MB/s, one byte at a time.
+    """
+    if not (MIN_CHUNK_BOUND <= min_size < avg_size < max_size and avg_size >= MIN_AVG_CHUNK
+            and MAX_CHUNK_BOUNDS[0] <= max_size <= MAX_CHUNK_BOUNDS[1]):
+        raise ValueError("The chunk sizes must satisfy 64 <= min_size < avg_size < max_size, with avg_size >= 256 "
+                         "and 1 KiB <= max_size <= 1 GiB")
+    cut = _native_cut if _fastcdc is not None else _python_cut
+    buffer = bytearray()
+    start = 0
+    eof = False
+    while True:
+        while not eof and len(buffer) - start < max_size:
+            if start:
+                del buffer[:start]
+                start = 0
+            block = reader.read(max(DEFAULT_CHUNK, max_size))
+            if block:
+                buffer += block
+            else:
+                eof = True
+        if start == len(buffer):
+            return
+        window = bytes(buffer[start:start + max_size])
+        end = cut(window, min_size, avg_size, max_size)
+        yield window[:end]
+        start += end
+
+
+def split_version(filein, store, fileout, min_shares, total_shares, mode=CipherMode.AESGCM,
+                  scheme=ShareScheme.PRIME256, workers=None, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK,
+                  max_size=DEFAULT_MAX_CHUNK, **kwargs):
+    """Store the chunks of ``filein`` missing from the chunk store ``store`` and split the manifest of this version
+    into the outputs named after ``fileout``.
+
+    Chunks are encrypted with the AEAD cipher ``mode`` on ``workers`` threads. The remaining arguments are passed to
+    ``CFShare.split_file`` for the manifest. Returns the number of ``chunks`` and ``bytes`` of the input and how many
+    of them were ``new_chunks`` (``new_bytes``) written to the store.
+    """
+    spec = get_cipher_spec(mode)
+    if not spec.aead:
+        print("The chunks must be encrypted with an AEAD cipher (AESGCM or ChaCha20Poly1305)")
+        sys.exit(1)
+    seen = set()
+    lock = threading.Lock()
+
+    def store_chunk(chunk):
+        key = hashlib.sha256(chunk).digest()
+        chunk_id = hashlib.sha256(key).hexdigest()
+        path = _chunk_path(store, chunk_id)
+        with lock:
+            new = chunk_id not in seen and not os.path.exists(path)
+            seen.add(chunk_id)
+        if new:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name, so that a chunk in the store is always complete
+            tmp_path = "{}.{}.tmp".format(path, secrets.token_hex(4))
+            with open(tmp_path, 'wb') as fo:
+                fo.write(spec.aead_for(key).encrypt(bytes(spec.iv_len), chunk, chunk_id.encode('ascii')))
+            os.replace(tmp_path, path)
+        return key, chunk_id, len(chunk), new
+
+    records = bytearray()
+    ids = []
+    summary = {'chunks': 0, 'bytes': 0, 'new_chunks': 0, 'new_bytes': 0}
+    with open(filein, 'rb') as f:
+        chunks = ((chunk,) for chunk in content_chunks(f, min_size, avg_size, max_size))
+        for key, chunk_id, length, new in ordered_map(store_chunk, chunks, workers):
+            records += key + int.to_bytes(length, CHUNK_LEN_LEN, 'little')
+            ids.append(chunk_id)
+            summary['chunks'] += 1
+            summary['bytes'] += length
+            if new:
+                summary['new_chunks'] += 1
+                summary['new_bytes'] += length
+    header = json.dumps({'mode': mode.value, 'size': summary['bytes'], 'chunks': summary['chunks']},
+                        separators=(',', ':')).encode('utf-8')
+    manifest = int.to_bytes(len(header), HEADER_LEN_LEN, 'little') + header + bytes(records)
+    CFShare.split_file(io.BytesIO(manifest), fileout, min_shares, total_shares, mode=mode, scheme=scheme,
+                       workers=workers, length=len(manifest), **kwargs)
+    with open(fileout + CHUNKS_SUFFIX, 'w') as fo:
+        fo.write(''.join(chunk_id + '\n' for chunk_id in ids))
+    return summary
+
+
+def reconstruct_version(filein, store, fileout, fshares=None, workers=None):
+    """Reconstruct the version whose manifest was split into ``filein`` (and ``fshares``) from the chunk store
+    ``store``, reading and decrypting its chunks on ``workers`` threads."""
+    try:
+        manifest = b''.join(CFShare.reconstruct_stream(filein, fshares, workers=workers))
+    except InvalidSignature:
+        print("The shares were incorrect")
+        sys.exit(1)
+    try:
+        header_len = int.from_bytes(manifest[:HEADER_LEN_LEN], 'little')
+        header = json.loads(manifest[HEADER_LEN_LEN:HEADER_LEN_LEN + header_len].decode('utf-8'))
+        spec = get_cipher_spec(CipherMode(header['mode']))
+    except (ValueError, KeyError, TypeError):
+        print("The file is not the manifest of an incremental split")
+        sys.exit(1)
+    record_len = CHUNK_KEY_LEN + CHUNK_LEN_LEN
+    records = manifest[HEADER_LEN_LEN + header_len:]
+
+    def load_chunk(key, length):
+        chunk_id = hashlib.sha256(key).hexdigest()
+        try:
+            with open(_chunk_path(store, chunk_id), 'rb') as fi:
+                chunk = spec.aead_for(key).decrypt(bytes(spec.iv_len), fi.read(), chunk_id.encode('ascii'))
+        except (OSError, InvalidTag):
+            chunk = None
+        if chunk is None or len(chunk) != length:
+            raise InvalidSignature("Chunk {} is missing or corrupt".format(chunk_id))
+        return chunk
+
+    chunks = ((records[i:i + CHUNK_KEY_LEN],
+               int.from_bytes(records[i + CHUNK_KEY_LEN:i + record_len], 'little'))
+              for i in range(0, len(records), record_len))
+    try:
+        with open(fileout, 'wb') as fo:
+            for chunk in ordered_map(load_chunk, chunks, workers):
+                fo.write(chunk)
+            size = fo.tell()
+    except InvalidSignature as e:
+        os.remove(fileout)
+        print(e)
+        sys.exit(1)
+    if size != header['size']:
+        os.remove(fileout)
+        print("The manifest is truncated")
+        sys.exit(1)
+
+
+def prune_store(store, chunk_lists):
+    """Remove the chunks of ``store`` that are not listed in any of the ``.chunks`` files ``chunk_lists``.
+
+    The chunks of a version are only listed once its split is complete, so pruning must not run while a split writes
+    to the same store: the chunks it already stored would be removed. Chunks still being written (``.tmp`` files)
+    are left in place. Returns the number of chunks removed.
+    """
+    keep = set()
+    for path in chunk_lists:
+        with open(path) as fi:
+            keep.update(line.strip() for line in fi if line.strip())
+    removed = 0
+    for dirpath, _, filenames in os.walk(store):
+        for name in filenames:
+            if name not in keep and not name.endswith('.tmp'):
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    return removed
+
+
+def _masks(min_size, avg_size):
+    # The normalized chunking of FastCDC: the hash must match more bits before the average size and fewer after it
+    bits = round(math.log2(avg_size))
+    return avg_size - min(avg_size, min_size + -(-min_size // 2)), (1 << (bits + 1)) - 1, (1 << (bits - 1)) - 1
+
+
+def _native_cut(window, min_size, avg_size, max_size):
+    return next(iter(_fastcdc(window, min_size, avg_size, max_size))).length
+
+
+def _python_cut(window, min_size, avg_size, max_size):
+    center, mask_s, mask_l = _masks(min_size, avg_size)
+    gear = _GEAR
+    h = 0
+    i = min(min_size, len(window))
+    barrier = min(center, len(window))
+    while i < barrier:
+        h = (h >> 1) + gear[window[i]]
+        i += 1
+        if not h & mask_s:
+            return i
+    barrier = min(max_size, len(window))
+    while i < barrier:
+        h = (h >> 1) + gear[window[i]]
+        i += 1
+        if not h & mask_l:
+            return i
+    return i
+
+
+def _chunk_path(store, chunk_id):
+    return os.path.join(store, chunk_id[:2], chunk_id)
+
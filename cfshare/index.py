@@ -0,0 +1,162 @@
+import dbm
+import json
+import os
+import sys
+
+from cfshare.cfshare import CFShare, Layout
+from cfshare.segments import ordered_map
+
+INDEX_NAME = '.cfshare_index'
+MAX_SHARE_LEN = 1 << 16
+
+
+def read_share_header(path, encrypted_files=None):
+    """Parse the header of the share ``path`` without reading its payload.
+
+    Returns a dict with the identity of the encrypted file (its IV and tag in hex), the layout (``None`` for the
+    ``.share`` files of a shares only split), the share index, the minimum number of shares (0 when unknown) and, for
+    ``.share`` files, the path of the encrypted file. Returns ``None`` if ``path`` is not a share.
+
+    The encrypted file of a shares only split starts with its random IV, which can look like a header: it is told
+    apart by the ``.share`` files next to it (``encrypted_files`` is the set of such files in the directory of
+    ``path``, listed if not given) and by checking that the header is consistent with the size of the file.
+    """
+    layout = None
+    try:
+        if not path.endswith('.share'):
+            directory = os.path.dirname(path) or '.'
+            if encrypted_files is None:
+                encrypted_files = _encrypted_files(directory)
+            if os.path.join(directory, os.path.basename(path)) in encrypted_files:
+                return None
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not path.endswith('.share'):
+                layout = Layout(f.read(1)[0])
+            mode = int.from_bytes(f.read(8), 'little')
+            if mode >> 56:
+                # The top byte of the mode field is unused
+                return None
+            params = CFShare._unpack_mode(mode)
+            schema_lens = CFShare._get_len_elements_from_mode(mode)
+            index = int.from_bytes(f.read(schema_lens['share_index']), 'little')
+            len_share = int.from_bytes(f.read(schema_lens['share_len']), 'little')
+            if len_share > MAX_SHARE_LEN or f.tell() + len_share > size:
+                return None
+            f.seek(len_share, os.SEEK_CUR)
+            data = None
+            if layout is None:
+                data = _find_encrypted_file(path, index)
+                if data is None:
+                    return None
+                with open(data, 'rb') as fd:
+                    identity = fd.read(schema_lens['iv'] + schema_lens['tag'])
+            else:
+                identity = f.read(schema_lens['iv'] + schema_lens['tag'])
+            threshold = params['threshold']
+            if layout == Layout.DISPERSED:
+                f.seek(schema_lens['payload_len'], os.SEEK_CUR)
+                threshold = int.from_bytes(f.read(schema_lens['threshold']), 'little')
+            if len(identity) != schema_lens['iv'] + schema_lens['tag'] or (layout is not None and f.tell() > size):
+                return None
+    except (OSError, ValueError, IndexError, TypeError):
+        return None
+    return {'id': identity.hex(), 'layout': layout, 'index': index, 'threshold': threshold, 'data': data}
+
+
+def build_index(root, workers=None):
+    """Scan the headers of every share under ``root`` concurrently and store them in an index at its top.
+
+    Returns the number of encrypted files found.
+    """
+    jobs = []
+    for dirpath, _, filenames in os.walk(root):
+        encrypted_files = _encrypted_files(dirpath, filenames)
+        jobs += [(os.path.join(dirpath, name), encrypted_files) for name in filenames
+                 if not name.startswith(INDEX_NAME)]
+    records = {}
+    for (path, _), header in zip(jobs, ordered_map(read_share_header, jobs, workers)):
+        if header is None:
+            continue
+        record = records.setdefault(header['id'], {'layout': None, 'threshold': 0, 'shares': {}, 'data': None})
+        record['shares'][str(header['index'])] = os.path.relpath(path, root)
+        record['threshold'] = max(record['threshold'], header['threshold'])
+        if header['layout'] is not None:
+            record['layout'] = header['layout'].value
+        if header['data'] is not None:
+            record['data'] = os.path.relpath(header['data'], root)
+    with dbm.open(os.path.join(root, INDEX_NAME), 'n') as db:
+        for identity, record in records.items():
+            db[identity] = json.dumps(record, separators=(',', ':'))
+    return len(records)
+
+
+def select_shares(root, file_id):
+    """Return the ``(filein, fshares)`` arguments of ``CFShare.reconstruct_file`` for the smallest set of shares of
+    ``file_id`` found in the index of ``root``."""
+    try:
+        with dbm.open(os.path.join(root, INDEX_NAME), 'r') as db:
+            record = json.loads(db[file_id])
+    except (dbm.error[0], KeyError):
+        print("No shares of {} were found in the index of {}".format(file_id, root))
+        sys.exit(1)
+    indexes = sorted(int(index) for index in record['shares'])
+    threshold = record['threshold']
+    if record['layout'] == Layout.FRAGMENT.value:
+        # Every fragment holds a different part of the payload
+        chosen = indexes
+        if threshold and indexes != list(range(threshold)):
+            print("Some fragments of {} are missing".format(file_id))
+            sys.exit(1)
+    else:
+        chosen = indexes[:threshold] if threshold else indexes
+        if len(chosen) < threshold:
+            print("At least {} shares are required, {} were found".format(threshold, len(chosen)))
+            sys.exit(1)
+    paths = [os.path.join(root, record['shares'][str(index)]) for index in chosen]
+    if record['data'] is not None:
+        return [os.path.join(root, record['data'])], paths
+    return paths, []
+
+
+def verify_store(root, file_ids=None, **kwargs):
+    """Verify the files of the index of ``root`` (all of them unless ``file_ids`` is given) without writing any
+    plaintext, yielding a ``(file_id, passed)`` pair per file.
+
+    The remaining arguments are passed to ``CFShare.verify``.
+    """
+    if file_ids is None:
+        with dbm.open(os.path.join(root, INDEX_NAME), 'r') as db:
+            file_ids = sorted(key.decode() for key in db.keys())
+    for file_id in file_ids:
+        try:
+            filein, fshares = select_shares(root, file_id)
+            passed = CFShare.verify(filein, fshares, **kwargs)
+        except (SystemExit, OSError, ValueError):
+            passed = False
+        yield file_id, passed
+
+
+def _encrypted_files(directory, names=None):
+    # The files of ``directory`` that may be the encrypted file of a shares only split, named after its .share files
+    result = set()
+    for name in os.listdir(directory) if names is None else names:
+        if not name.endswith('.share'):
+            continue
+        head, _, total = name[:-len('.share')].rpartition('_')
+        if not total.isdigit():
+            continue
+        # The index can't be told apart from digits ending the name of the encrypted file
+        digits = len(head) - len(head.rstrip('0123456789'))
+        result.update(os.path.join(directory, head[:-n]) for n in range(1, digits + 1))
+    return result
+
+
+def _find_encrypted_file(path, index):
+    # A share of a shares only split is named <encrypted file><index + 1>_<total>.share
+    head, _, total = path[:-len('.share')].rpartition('_')
+    suffix = str(index + 1)
+    if not total.isdigit() or not head.endswith(suffix):
+        return None
+    data = head[:-len(suffix)]
+    return data if os.path.isfile(data) else None
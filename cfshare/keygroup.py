@@ -0,0 +1,286 @@
+import collections
+import contextlib
+import json
+import os
+import secrets
+import sys
+import threading
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from cfshare.batch import MANIFEST_NAME, _walk
+from cfshare.cfshare import CFShare, CipherMode, ContainerFormat, ShareScheme
+from cfshare.compression import Codec
+from cfshare.metrics import span
+from cfshare.streams import DEFAULT_CHUNK, open_source
+
+# A key group protects many files with a single set of shares of a group key. Every member file has its own key,
+# derived from the group key and a random salt stored in its header:
+#   share file  <group><i>_<t>.keyshare: [group id][mode][share index][share length][share]
+#   member file: [mode][group id][salt][iv][tag][payload]
+# The group id is a MAC of the group key, so it also tells whether a combined key is correct.
+GROUP_ID_LEN = 16
+SALT_LEN = 16
+SHARE_SUFFIX = '.keyshare'
+DEFAULT_CACHE_SIZE = 64
+
+
+class KeyCache:
+    """Bounded LRU cache of group keys by group id, so that the shares of a group are combined only once."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.keys = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, group_id):
+        with self.lock:
+            key = self.keys.get(group_id)
+            if key is None:
+                self.misses += 1
+                return None
+            self.keys.move_to_end(group_id)
+            self.hits += 1
+            return key
+
+    def put(self, group_id, key):
+        with self.lock:
+            self.keys[group_id] = key
+            self.keys.move_to_end(group_id)
+            while len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+
+key_cache = KeyCache()
+
+
+def create_group(name, min_shares, total_shares, scheme=ShareScheme.PRIME256, cache=key_cache):
+    """Create a group key and write its shares to ``<name><i>_<total_shares>.keyshare``.
+
+    The key is kept in ``cache`` (unless ``None``) and the group id is returned in hex.
+    """
+    if min_shares > total_shares or min_shares < 2:
+        print("The minimum number of shares must be between 2 and the total")
+        sys.exit(1)
+    key = secrets.token_bytes(32)
+    group_id = _group_id(key)
+    mode_field = CFShare._pack_mode(CipherMode.AES, scheme=scheme, threshold=min_shares)
+    schema_lens = CFShare._get_len_elements_from_mode(mode_field)
+    shares = CFShare._create_shares(scheme, min_shares, total_shares, key)
+    for i, share in enumerate(shares):
+        with open(name + "{}_{}".format(i + 1, total_shares) + SHARE_SUFFIX, 'wb') as fo:
+            fo.write(group_id)
+            CFShare._write_share(fo, mode_field, share, schema_lens)
+    if cache is not None:
+        cache.put(group_id, key)
+    return group_id.hex()
+
+
+def group_key(group_shares, cache=key_cache, observer=None):
+    """Return the group id and the group key of the share files ``group_shares``, combining them on a cache miss."""
+    group_id, mode, shares = _read_group_shares(group_shares)
+    key = None if cache is None else cache.get(group_id)
+    if key is not None:
+        return group_id, key
+    threshold = CFShare._unpack_mode(mode)['threshold']
+    if len(shares) < threshold:
+        print("At least {} shares are required".format(threshold))
+        sys.exit(1)
+    try:
+        with span(observer, 'key_combine'):
+            key = CFShare._combine_shares(mode, shares)
+    except ValueError:
+        key = None
+    if key is None or _group_id(key) != group_id:
+        print("The shares were incorrect")
+        sys.exit(1)
+    if cache is not None:
+        cache.put(group_id, key)
+    return group_id, key
+
+
+def split_members(files, group_shares, mode=CipherMode.AES, max_chunk=DEFAULT_CHUNK, segment_size=None, workers=None,
+                  cache=key_cache, observer=None, compression=Codec.NONE):
+    """Encrypt every ``(filein, fileout)`` pair of ``files`` as a member of the group of ``group_shares``.
+
+    The shares are combined at most once, and not at all if the group key is cached.
+    """
+    group_id, key = group_key(group_shares, cache, observer)
+    for filein, fileout in files:
+        _split_member(filein, fileout, group_id, key, mode, max_chunk, segment_size, workers, observer, compression)
+
+
+def split_group(files, name, min_shares, total_shares, scheme=ShareScheme.PRIME256, cache=key_cache, **kwargs):
+    """Create a group named ``name`` and encrypt every ``(filein, fileout)`` pair of ``files`` as its members.
+
+    The remaining arguments are passed to ``split_members``. Returns the group id in hex.
+    """
+    # Keep the new key even without a cache, it is needed for the members
+    local = KeyCache(1) if cache is None else cache
+    group_id = create_group(name, min_shares, total_shares, scheme, local)
+    group_shares = [name + "{}_{}".format(i + 1, total_shares) + SHARE_SUFFIX for i in range(min_shares)]
+    split_members(files, group_shares, cache=local, **kwargs)
+    return group_id
+
+
+def reconstruct_members(files, group_shares=None, max_chunk=DEFAULT_CHUNK, workers=None, cache=key_cache,
+                        observer=None):
+    """Decrypt every ``(filein, fileout)`` pair of ``files``, members of one or more cached groups or of the group of
+    ``group_shares``.
+
+    The shares are combined at most once, and not at all if the group key is cached.
+    """
+    keys = {}
+    for filein, fileout in files:
+        _reconstruct_member(filein, fileout, keys, group_shares, max_chunk, workers, cache, observer)
+
+
+def _reconstruct_member(filein, fileout, keys, group_shares=None, max_chunk=DEFAULT_CHUNK, workers=None,
+                        cache=key_cache, observer=None):
+    # keys holds the group keys already found, by group id
+    header = read_member_header(filein)
+    if header is None:
+        print("{} is not a member of a key group".format(filein))
+        sys.exit(1)
+    key = keys.get(header['group_id'])
+    if key is None and cache is not None:
+        key = cache.get(header['group_id'])
+    if key is None:
+        if group_shares is None:
+            print("The shares of the group are required")
+            sys.exit(1)
+        group_id, key = group_key(group_shares, cache, observer)
+        if group_id != header['group_id']:
+            print("{} is not a member of the group of the shares".format(filein))
+            sys.exit(1)
+    keys[header['group_id']] = key
+    member_key = _member_key(key, header['salt'])
+    sources = [(filein, header['header_len'])]
+    CFShare._decrypt_to_file(header['mode'], member_key, header['iv'], header['tag'], sources, fileout,
+                             max_chunk, workers, observer)
+
+
+def read_member_header(filein):
+    """Parse the header of the member file ``filein``, returning ``None`` if it is not one."""
+    try:
+        with open_source(filein) as f:
+            mode = int.from_bytes(f.read(8), 'little')
+            schema_lens = CFShare._get_len_elements_from_mode(mode)
+            if schema_lens is None:
+                return None
+            group_id, salt, iv, tag = [f.read(x) for x in [GROUP_ID_LEN, SALT_LEN, schema_lens['iv'],
+                                                           schema_lens['tag']]]
+    except ValueError:
+        return None
+    if len(tag) != schema_lens['tag']:
+        return None
+    return {'mode': mode, 'group_id': group_id, 'salt': salt, 'iv': iv, 'tag': tag,
+            'header_len': 8 + GROUP_ID_LEN + SALT_LEN + schema_lens['iv'] + schema_lens['tag']}
+
+
+def split_group_tree(root, outroot, name, min_shares, total_shares, **kwargs):
+    """Encrypt every file under ``root`` as a member of a new group whose shares are written to ``outroot``.
+
+    The members are mirrored under ``outroot`` and listed in its manifest. The remaining arguments are passed to
+    ``split_group``. Returns the group id in hex.
+    """
+    files = sorted(_walk(root))
+    pairs = []
+    for rel, _ in files:
+        fileout = os.path.join(outroot, rel)
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        pairs.append((os.path.join(root, rel), fileout))
+    os.makedirs(outroot, exist_ok=True)
+    group_id = split_group(pairs, os.path.join(outroot, name), min_shares, total_shares, **kwargs)
+    manifest = {'group': name, 'group_id': group_id, 'min_shares': min_shares, 'total_shares': total_shares,
+                'files': [{'path': rel, 'size': size, 'outputs': [rel]} for rel, size in files]}
+    with open(os.path.join(outroot, MANIFEST_NAME), 'w') as fo:
+        json.dump(manifest, fo, indent=1)
+    return group_id
+
+
+def bind_group_tree(root, outroot, group_shares=None, **kwargs):
+    """Decrypt every member listed in the manifest of ``root`` under ``outroot``.
+
+    Without ``group_shares`` the share files of the group found in ``root`` are used, the group key is combined at
+    most once. The remaining arguments are passed to ``reconstruct_members``. The relative paths of the members that
+    could not be decrypted are returned.
+    """
+    with open(os.path.join(root, MANIFEST_NAME)) as fi:
+        manifest = json.load(fi)
+    if 'group' not in manifest:
+        print("{} doesn't hold a key group".format(root))
+        sys.exit(1)
+    if group_shares is None:
+        names = [manifest['group'] + "{}_{}".format(i + 1, manifest['total_shares']) + SHARE_SUFFIX
+                 for i in range(manifest['total_shares'])]
+        group_shares = [os.path.join(root, name) for name in names if os.path.exists(os.path.join(root, name))]
+    keys = {}
+    failed = []
+    for entry in manifest['files']:
+        fileout = os.path.join(outroot, entry['path'])
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        try:
+            _reconstruct_member(os.path.join(root, entry['outputs'][0]), fileout, keys, group_shares, **kwargs)
+        except (SystemExit, Exception) as e:
+            # As in bind_tree, a member that can't be decrypted is reported and the others go on
+            print("{}: {}".format(entry['path'], e if not isinstance(e, SystemExit) else 'failed'))
+            failed.append(entry['path'])
+    return failed
+
+
+def _split_member(filein, fileout, group_id, key, mode, max_chunk, segment_size, workers, observer, compression):
+    CFShare._check_split(0, 0, True, False, mode, segment_size, compression, None)
+    salt = secrets.token_bytes(SALT_LEN)
+    segment_size = CFShare._get_segment_size(mode, segment_size)
+    container = ContainerFormat.STREAM if segment_size is None else ContainerFormat.SEGMENTED
+    mode_field = CFShare._pack_mode(mode, container, segment_size, codec=compression)
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open_source(filein))
+        fo = stack.enter_context(open(fileout, 'wb'))
+        fo.write(int.to_bytes(mode_field, 8, 'little') + group_id + salt)
+        # Encrypted like the data file of a shares only split, without shares
+        CFShare.split_stream(f, [fo], 0, key=_member_key(key, salt), mode=mode, max_chunk=max_chunk,
+                             segment_size=segment_size, workers=workers, shares=[], share_writers=[],
+                             observer=observer, compression=compression)
+
+
+def _read_group_shares(group_shares):
+    group_id = None
+    mode = None
+    shares = {}
+    for path in group_shares:
+        with open_source(path) as fi:
+            found_id = fi.read(GROUP_ID_LEN)
+            mode = int.from_bytes(fi.read(8), 'little')
+            schema_lens = CFShare._get_len_elements_from_mode(mode)
+            index = int.from_bytes(fi.read(schema_lens['share_index']), 'little')
+            len_share = int.from_bytes(fi.read(schema_lens['share_len']), 'little')
+            shares[index] = fi.read(len_share)
+        if group_id is None:
+            group_id = found_id
+        elif group_id != found_id:
+            print('The shares belong to different groups, aborting...')
+            sys.exit(1)
+    if group_id is None:
+        print("You can't reconstruct this file without passing the shares")
+        sys.exit(1)
+    return group_id, mode, [shares[index] for index in sorted(shares)]
+
+
+def _group_id(key):
+    h = hmac.HMAC(key, hashes.SHA256(), default_backend())
+    h.update(b'cfshare key group')
+    return h.finalize()[:GROUP_ID_LEN]
+
+
+def _member_key(key, salt):
+    return HKDF(hashes.SHA256(), 32, salt, b'cfshare key group member', default_backend()).derive(key)
@@ -1,24 +1,49 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 from os.path import abspath
 
-from cfshare.cfshare import CFShare, CipherMode
+from cfshare.ciphers import CipherMode
+
+# The modules doing the work (and the cryptography backends) are imported once the arguments are valid, so that usage
+# and argument errors are reported without loading them
 
 
 def main():
-    if len(sys.argv) < 2 or (sys.argv[1] != 'split' and sys.argv[1] != 'bind'):
+    if len(sys.argv) < 2 or sys.argv[1] not in ('split', 'bind', 'index', 'verify', 'bench', 'pack', 'list', 'extract',
+                                                 'repair', 'serve'):
         usage()
         sys.exit(1)
     mode = sys.argv[1]
     sys.argv.remove(mode)
     parser = getparser(mode)
     args = parser.parse_args()
-    if len(sys.argv) < 6:
+    if mode == 'split':
+        missing = (args.i is None and args.r is None) or None in (args.o, args.m, args.t)
+    elif mode == 'index':
+        missing = args.r is None
+    elif mode == 'verify':
+        missing = not args.i and args.store is None
+    elif mode == 'bench':
+        missing = False
+    elif mode == 'pack':
+        missing = (not args.i and args.r is None) or None in (args.o, args.m, args.t)
+    elif mode == 'list':
+        missing = not args.i
+    elif mode == 'extract':
+        missing = not args.i or args.o is None
+    elif mode == 'repair':
+        missing = None in (args.i, args.t)
+    elif mode == 'serve':
+        missing = args.s is None
+    else:
+        missing = (not args.i and args.r is None and None in (args.id, args.store)) or args.o is None
+    if missing:
         parser.print_help()
         sys.exit(1)
+    from cfshare.cfshare import CFShare
     if mode == 'split':
-        fi = abspath(args.i)
         fo = abspath(args.o)
         m = int(args.m)
         t = int(args.t)
@@ -35,33 +60,331 @@ def main():
         elif len(args.cipher) > 1:
             print('You can choose only one cipher')
             sys.exit(1)
-        CFShare.split_file(fi, fo, m, t, mode=mode, sharesonly=args.sharesonly)
-    elif mode == 'bind':
-        fi = [abspath(item) for item in args.i]
+        options = {'mode': mode, 'sharesonly': args.sharesonly, 'segment_size': get_segment_size(args.segment_size),
+                   'workers': args.workers, 'dispersed': args.dispersed, 'scheme': get_share_scheme(args.scheme),
+                   'compression': get_compression(args.compress)}
+        if args.group is not None:
+            if args.r is None or args.sharesonly or args.dispersed:
+                print('A key group is split from a directory (-r), without --sharesonly or --dispersed')
+                sys.exit(1)
+            from cfshare.keygroup import split_group_tree
+            group_id = split_group_tree(abspath(args.r), fo, args.group, m, t, scheme=options['scheme'], mode=mode,
+                                        segment_size=options['segment_size'], workers=args.workers,
+                                        compression=options['compression'])
+            print("Group {}".format(group_id))
+            return
+        if args.r is not None:
+            failed = CFShare.split_tree(abspath(args.r), fo, m, t, args.jobs, **options)
+            sys.exit(1 if failed else 0)
+        if args.chunk_store is not None:
+            if args.i == '-' or args.resume:
+                print('An incremental split reads a file (not stdin), without --resume')
+                sys.exit(1)
+            if args.cipher is None:
+                options['mode'] = CipherMode.AESGCM
+            summary = CFShare.split_incremental(abspath(args.i), abspath(args.chunk_store), fo, m, t, **options)
+            print("Wrote {} of {} chunks ({} of {} bytes)".format(summary['new_chunks'], summary['chunks'],
+                                                                 summary['new_bytes'], summary['bytes']))
+            return
+        if args.resume:
+            if args.i == '-' or args.dispersed or args.compress.lower() != 'none':
+                print('A resumable split reads a file (not stdin), without --dispersed or --compress')
+                sys.exit(1)
+            stats, observer = get_observer(args)
+            CFShare.split_resumable(abspath(args.i), fo, m, t, mode=mode, sharesonly=args.sharesonly,
+                                    segment_size=options['segment_size'], scheme=options['scheme'],
+                                    workers=args.workers, observer=observer)
+            print_stats(stats)
+            return
+        stats, observer = get_observer(args)
+        CFShare.split_file(get_input(args.i), fo, m, t, observer=observer, **options)
+        print_stats(stats)
+    elif mode == 'index':
+        print("Indexed {} files".format(CFShare.index_store(abspath(args.r), args.workers)))
+    elif mode == 'verify':
+        if args.store is not None:
+            file_ids = None if args.id is None else [args.id]
+            results = CFShare.verify_store(abspath(args.store), file_ids, workers=args.workers)
+        else:
+            fi = [get_input(item) for item in args.i]
+            fs = [get_input(item) for item in args.s]
+            stats, observer = get_observer(args)
+            results = [(' '.join(args.i), CFShare.verify(fi, fshares=fs, workers=args.workers, observer=observer))]
+            print_stats(stats)
+        failed = 0
+        for name, passed in results:
+            print("{}: {}".format(name, 'OK' if passed else 'FAILED'))
+            failed += not passed
+        sys.exit(1 if failed else 0)
+    elif mode == 'bench':
+        run_bench(args)
+    elif mode == 'pack':
+        run_pack(args)
+    elif mode == 'list':
         fs = [abspath(item) for item in args.s]
+        for member in CFShare.list_archive([abspath(item) for item in args.i], fs):
+            print("{:>14} {}".format(member['size'], member['name']))
+    elif mode == 'extract':
+        fs = [abspath(item) for item in args.s]
+        CFShare.extract([abspath(item) for item in args.i], args.name, abspath(args.o), fs)
+    elif mode == 'repair':
+        written = CFShare.repair(abspath(args.i), int(args.t), refresh=args.refresh,
+                                 min_shares=None if args.m is None else int(args.m), verify=args.verify)
+        for path in written:
+            print("Wrote {}".format(path))
+    elif mode == 'serve':
+        from cfshare.server import serve
+        serve(abspath(args.s), args.jobs, args.workers, args.max_queue)
+    elif mode == 'bind':
         fo = abspath(args.o)
-        CFShare.reconstruct_file(fi, fo, fshares=fs)
+        if args.id is not None and args.store is not None:
+            CFShare.reconstruct_from_store(args.id, abspath(args.store), fo, workers=args.workers)
+            return
+        group_shares = None if args.group_shares is None else [abspath(item) for item in args.group_shares]
+        if args.r is not None:
+            if group_shares is not None:
+                from cfshare.keygroup import bind_group_tree
+                failed = bind_group_tree(abspath(args.r), fo, group_shares, workers=args.workers)
+                sys.exit(1 if failed else 0)
+            failed = CFShare.bind_tree(abspath(args.r), fo, args.jobs, workers=args.workers)
+            sys.exit(1 if failed else 0)
+        fi = [get_input(item) for item in args.i]
+        fs = [get_input(item) for item in args.s]
+        stats, observer = get_observer(args)
+        if group_shares is not None:
+            CFShare.reconstruct_group([(fi[0], fo)], group_shares, workers=args.workers, observer=observer)
+            print_stats(stats)
+            return
+        if args.chunk_store is not None:
+            CFShare.reconstruct_incremental(fi, abspath(args.chunk_store), fo, fshares=fs, workers=args.workers)
+        elif args.resume:
+            if args.o == '-' or '-' in args.i:
+                print('A resumable bind reads and writes files (not stdin or stdout)')
+                sys.exit(1)
+            CFShare.reconstruct_resumable(fi, fo, fshares=fs, workers=args.workers, observer=observer)
+        elif args.o == '-':
+            write_stdout(CFShare.reconstruct_stream(fi, fs, workers=args.workers, observer=observer))
+        else:
+            CFShare.reconstruct_file(fi, fo, fshares=fs, workers=args.workers, observer=observer)
+        print_stats(stats)
+
+
+def get_observer(args):
+    from cfshare.metrics import MultiObserver, ProgressObserver, Stats, print_progress
+    observers = []
+    stats = Stats() if args.stats else None
+    if stats is not None:
+        observers.append(stats)
+    if args.progress:
+        observers.append(ProgressObserver(print_progress))
+    if not observers:
+        return None, None
+    return stats, observers[0] if len(observers) == 1 else MultiObserver(observers)
+
+
+def print_stats(stats):
+    # Written to stderr as the output may be stdout
+    if stats is not None:
+        print(stats.format(), file=sys.stderr)
+
+
+def run_bench(args):
+    from cfshare import bench as suite
+    sizes = None if args.sizes is None else [suite.parse_size(item) for item in args.sizes]
+    chunks = None if args.chunk_sizes is None else [suite.parse_size(item) for item in args.chunk_sizes]
+    modes = None if args.cipher is None else [get_cipher_mode(item) for item in args.cipher]
+    if modes is not None and None in modes:
+        print('Unknown cipher')
+        sys.exit(1)
+    results = suite.run(sizes, modes, chunks, repeat=args.repeat, workdir=args.tmp, progress=print_bench_result)
+    if args.o is not None:
+        suite.save(results, args.o)
+    if args.compare is not None:
+        regressions = suite.compare(suite.load(args.compare), results, args.tolerance)
+        for result in regressions:
+            print("Regression: {} ({:.6f}s, was {:.6f}s)".format(
+                format_bench_case(result), result['seconds'], result['baseline_seconds']))
+        sys.exit(1 if regressions else 0)
+
+
+def run_pack(args):
+    from cfshare import archive
+    m = int(args.m)
+    t = int(args.t)
+    if m > t or m < 2:
+        print("The minimum number of shares must be between 2 and the total")
+        sys.exit(1)
+    mode = get_cipher_mode(args.cipher or 'AES')
+    if mode is None:
+        print('Unknown cipher')
+        sys.exit(1)
+    options = {'mode': mode, 'sharesonly': args.sharesonly, 'dispersed': args.dispersed,
+               'scheme': get_share_scheme(args.scheme), 'workers': args.workers}
+    if args.segment_size is not None:
+        options['segment_size'] = get_segment_size(args.segment_size)
+    if args.r is not None:
+        archive.pack_tree(abspath(args.r), abspath(args.o), m, t, **options)
+    else:
+        files = [(abspath(item), item.replace(os.sep, '/')) for item in args.i]
+        archive.pack(files, abspath(args.o), m, t, **options)
+
+
+def format_bench_case(result):
+    return ' '.join("{}={}".format(k, v) for k, v in result.items() if k not in ('seconds', 'mb_s', 'baseline_seconds'))
+
+
+def print_bench_result(result):
+    line = "{} {:.6f}s".format(format_bench_case(result), result['seconds'])
+    if result.get('mb_s') is not None:
+        line += " {} MB/s".format(result['mb_s'])
+    print(line)
+
+
+def get_input(path):
+    if path == '-':
+        return sys.stdin.buffer
+    return abspath(path)
+
+
+def write_stdout(chunks):
+    from cryptography.exceptions import InvalidSignature
+    try:
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    except (InvalidSignature, ValueError):
+        # The plaintext goes to stdout, so errors must not
+        print("The shares were incorrect", file=sys.stderr)
+        sys.exit(1)
+    except BrokenPipeError:
+        # The reader stopped early (e.g. head), the output left unflushed is discarded
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 
 def getparser(mode):
     parser = argparse.ArgumentParser(prog="cfshare " + mode)
     if mode == 'split':
-        parser.add_argument('-i', help='Original file relative path')
-        parser.add_argument('-o', help='Relative path of the output files')
+        parser.add_argument('-i', help='Original file relative path (- for stdin)')
+        parser.add_argument('-r', help='Directory whose files are all split (instead of -i)')
+        parser.add_argument('-o', help='Relative path of the output files (output directory with -r)')
         parser.add_argument('-t', help='Total number of shares')
         parser.add_argument('-m', help='Minimum number of shares required for reconstruction')
         parser.add_argument('-so', '--sharesonly', action='store_true',
                             help='Make output files only contain the share required for decryption')
-        parser.add_argument('-c', '--cipher', help="Chosen cipher[AES|ChaCha20|Camellia] (default: AES)",
+        parser.add_argument('-c', '--cipher',
+                            help="Chosen cipher[AES|ChaCha20|Camellia|AESGCM|ChaCha20Poly1305] (default: AES)",
                             nargs='*')
-    else:
+        parser.add_argument('-d', '--dispersed', action='store_true',
+                            help='Disperse the encrypted content so that every output only holds 1/m of it')
+        parser.add_argument('-k', '--scheme', help="Secret sharing scheme[prime|gf256] (default: prime)",
+                            default='prime')
+        parser.add_argument('-ss', '--segment-size', type=int,
+                            help='Use the segmented container with segments of this size in bytes (power of two)')
+        parser.add_argument('-g', '--group',
+                            help='Encrypt the files of -r under a single set of shares named after this group')
+        parser.add_argument('-z', '--compress', help='Compress before encrypting[zlib|lzma|zstd] (default: none)',
+                            default='none')
+        parser.add_argument('--resume', action='store_true',
+                            help='Checkpoint the progress to .partial outputs, resuming an interrupted split of -i')
+        parser.add_argument('--chunk-store',
+                            help='Store the new chunks of -i in this chunk store and only split its manifest')
+    elif mode == 'index':
+        parser.add_argument('-r', help='Share store whose headers are indexed')
+        parser.add_argument('-w', '--workers', type=int,
+                            help='Number of threads reading the headers (default: number of cores)')
+        return parser
+    elif mode == 'bench':
+        parser.add_argument('-s', '--sizes', nargs='+', help='File sizes, e.g. 1K 1M 2G (default: 1K 1M 64M)')
+        parser.add_argument('-c', '--cipher', nargs='+', help='Ciphers measured (default: all)')
+        parser.add_argument('-cs', '--chunk-sizes', nargs='+', help='Chunk sizes measured (default: 64K 256K 1M 4M)')
+        parser.add_argument('-n', '--repeat', type=int, default=3, help='Runs per case, the best one is kept (default: 3)')
+        parser.add_argument('-o', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON results of a previous run, regressions make the exit status 1')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Slowdown tolerated by --compare (default: 0.1 for 10%%)')
+        parser.add_argument('--tmp', help='Directory where the files are written (default: system temporary directory)')
+        return parser
+    elif mode == 'pack':
+        parser.add_argument('-i', nargs='+', help='Files packed into the archive, named by their relative path')
+        parser.add_argument('-r', help='Directory whose files are all packed (instead of -i)')
+        parser.add_argument('-o', help='Relative path of the output files')
+        parser.add_argument('-t', help='Total number of shares')
+        parser.add_argument('-m', help='Minimum number of shares required for reconstruction')
+        parser.add_argument('-so', '--sharesonly', action='store_true',
+                            help='Make output files only contain the share required for decryption')
+        parser.add_argument('-c', '--cipher',
+                            help="Chosen cipher[AES|ChaCha20|Camellia|AESGCM|ChaCha20Poly1305] (default: AES)")
+        parser.add_argument('-d', '--dispersed', action='store_true',
+                            help='Disperse the encrypted content so that every output only holds 1/m of it')
+        parser.add_argument('-k', '--scheme', help="Secret sharing scheme[prime|gf256] (default: prime)",
+                            default='prime')
+        parser.add_argument('-ss', '--segment-size', type=int,
+                            help='Size of the segments in bytes, a power of two (default: 65536)')
+        parser.add_argument('-w', '--workers', type=int,
+                            help='Number of threads encrypting segments (default: number of cores)')
+        return parser
+    elif mode in ('list', 'extract'):
+        parser.add_argument('-i', nargs='+', help='Encrypted files relative paths of the archive')
+        parser.add_argument('-s', nargs='+', default=[],
+                            help='Share files relative paths (required only if the archive was packed with option --sharesonly)')
+        if mode == 'extract':
+            parser.add_argument('-o', help='Directory where the members are written')
+            parser.add_argument('-n', '--name', nargs='+', help='Members to extract (default: all)')
+        return parser
+    elif mode == 'repair':
+        parser.add_argument('-i', help='Relative path given to split with -o')
+        parser.add_argument('-t', help='Total number of shares')
+        parser.add_argument('--refresh', action='store_true',
+                            help='Replace every share with a new set of shares of the same key')
+        parser.add_argument('-m', help='Minimum number of shares, used by --refresh when the headers do not record it')
+        parser.add_argument('--verify', action='store_true',
+                            help='Authenticate every segment of a segmented file before writing (the root tag is always checked)')
+        return parser
+    elif mode == 'serve':
+        parser.add_argument('-s', help='Path of the Unix socket the jobs are sent to')
+        parser.add_argument('-j', '--jobs', type=int, help='Number of jobs run at once (default: number of cores)')
+        parser.add_argument('-w', '--workers', type=int,
+                            help='Number of threads every job uses for segmented files (default: number of cores)')
+        parser.add_argument('-q', '--max-queue', type=int, default=1024,
+                            help='Number of jobs waiting to run before further jobs are rejected (default: 1024)')
+        return parser
+    elif mode == 'verify':
         parser.add_argument('-i', nargs='+', help='Encrypted files relative paths')
-        parser.add_argument('-o', help='Desired file name/path of the output')
+        parser.add_argument('-s', nargs='+', default=[],
+                            help='Share files relative paths (required only if the file was encrypted with option --sharesonly)')
+        parser.add_argument('--store', help='Share store indexed with cfshare index whose files are all verified (instead of -i)')
+        parser.add_argument('--id', help='Verify only this file of the store')
+        parser.add_argument('-w', '--workers', type=int,
+                            help='Number of threads used for segmented files (default: number of cores)')
+        add_observer_arguments(parser)
+        return parser
+    else:
+        parser.add_argument('-i', nargs='+', help='Encrypted files relative paths (- for stdin)')
+        parser.add_argument('-r', help='Directory of shares produced by split -r (instead of -i)')
+        parser.add_argument('-o', help='Desired file name/path of the output (- for stdout, output directory with -r)')
         parser.add_argument('-s', nargs='+',
                             help='Share files relative paths (required only if the file was encrypted with option --sharesonly)', default=[])
+        parser.add_argument('--id', help='Identity of the file to reconstruct from an indexed store (instead of -i)')
+        parser.add_argument('--store', help='Share store indexed with cfshare index (used with --id)')
+        parser.add_argument('-g', '--group-shares', nargs='+',
+                            help='Share files of the key group of the -i file or of the -r directory')
+        parser.add_argument('--resume', action='store_true',
+                            help='Checkpoint the progress to a .partial output, resuming an interrupted bind')
+        parser.add_argument('--chunk-store', help='Chunk store holding the chunks of the -i manifest')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of threads used for segmented files (default: number of cores)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of processes used with -r (default: number of cores)')
+    add_observer_arguments(parser)
+    return parser
 
 
-    return parser
+def add_observer_arguments(parser):
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time and throughput of every phase to stderr (not with -r or --store)')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show the progress on stderr (not with -r or --store)')
 
 
 def get_cipher_mode(name):
@@ -72,14 +395,62 @@ def get_cipher_mode(name):
         return CipherMode.ChaCha20
     elif name == 'camellia':
         return CipherMode.Camellia
+    elif name == 'aesgcm' or name == 'aes-gcm':
+        return CipherMode.AESGCM
+    elif name == 'chacha20poly1305' or name == 'chacha20-poly1305':
+        return CipherMode.ChaCha20Poly1305
+
+
+def get_share_scheme(name):
+    from cfshare.cfshare import ShareScheme
+    name = name.lower()
+    if name == 'prime':
+        return ShareScheme.PRIME256
+    elif name == 'gf256':
+        return ShareScheme.GF256
+    print("Unknown secret sharing scheme {}".format(name))
+    sys.exit(1)
+
+
+def get_segment_size(segment_size):
+    from cfshare.segments import check_segment_size
+    if segment_size is not None:
+        try:
+            check_segment_size(segment_size)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    return segment_size
+
+
+def get_compression(name):
+    from cfshare.compression import check_codec, get_codec
+    codec = get_codec(name)
+    if codec is None:
+        print("Unknown compression codec {}".format(name))
+        sys.exit(1)
+    try:
+        check_codec(codec)
+    except ImportError as e:
+        print(e)
+        sys.exit(1)
+    return codec
 
 
 def usage():
     print("Usage:")
-    print("  cfshare [split|bind]")
+    print("  cfshare [split|bind|index|verify|bench|pack|list|extract|repair|serve]")
     print("")
     print("Options:")
     print("  split                      Encrypt a file")
     print("  bind                      Decrypt a file")
+    print("  index                     Index the share headers of a store")
+    print("  verify                    Check shares without writing the decrypted file")
+    print("  bench                     Measure the throughput of split and bind")
+    print("  pack                      Encrypt many files into a single archive")
+    print("  list                      List the members of an archive")
+    print("  extract                   Decrypt members of an archive")
+    print("  repair                    Restore missing shares without re-encrypting")
+    print("  serve                     Run split, bind and verify jobs received on a Unix socket")
     print("")
     sys.exit(1)
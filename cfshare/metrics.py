@@ -0,0 +1,210 @@
+import contextlib
+import sys
+import threading
+import time
+
+# Phases reported by split and bind. The stages of a pipeline run concurrently, so the time of the phases adds up to
+# more than the elapsed time: the phase taking the longest is the bottleneck. ``read`` is the time spent waiting for
+# the input, which includes joining fragments and decoding dispersed pieces during bind.
+PHASES = ['key_split', 'key_combine', 'read', 'compress', 'encrypt', 'decrypt', 'mac', 'decompress', 'fan_out_write',
+          'fragment_write', 'disperse_write', 'write']
+
+
+class Observer:
+    """Receives the events of split and bind, every method does nothing unless overridden.
+
+    Methods may be called from several threads at once.
+    """
+
+    def span(self, phase, seconds, nbytes=0):
+        """``phase`` took ``seconds`` to process ``nbytes`` bytes."""
+
+    def progress(self, done, total):
+        """``done`` bytes out of ``total`` (``None`` when unknown) went through split or bind."""
+
+
+class Stats(Observer):
+    """Accumulate the time, bytes and number of calls of every phase."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.started = time.perf_counter()
+
+    def span(self, phase, seconds, nbytes=0):
+        with self.lock:
+            item = self.phases.setdefault(phase, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            item['seconds'] += seconds
+            item['bytes'] += nbytes
+            item['calls'] += 1
+
+    def report(self):
+        """Return the totals of every phase, with its throughput in MB/s, and the elapsed time."""
+        with self.lock:
+            phases = {}
+            for phase, item in self.phases.items():
+                mb_s = item['bytes'] / item['seconds'] / 1e6 if item['seconds'] > 0 and item['bytes'] else None
+                phases[phase] = dict(item, mb_s=mb_s)
+        return {'elapsed': time.perf_counter() - self.started, 'phases': phases}
+
+    def format(self):
+        report = self.report()
+        lines = ["{:<16}{:>10}{:>14}{:>12}".format('phase', 'seconds', 'bytes', 'MB/s')]
+        order = sorted(report['phases'], key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES))
+        for phase in order:
+            item = report['phases'][phase]
+            mb_s = '-' if item['mb_s'] is None else "{:.1f}".format(item['mb_s'])
+            lines.append("{:<16}{:>10.3f}{:>14}{:>12}".format(phase, item['seconds'], item['bytes'], mb_s))
+        lines.append("{:<16}{:>10.3f}".format('elapsed', report['elapsed']))
+        return '\n'.join(lines)
+
+
+class ProgressObserver(Observer):
+    """Call ``callback(done, total)`` at most every ``interval`` seconds, and always for the last update."""
+
+    def __init__(self, callback, interval=0.2):
+        self.callback = callback
+        self.interval = interval
+        self.last = 0.0
+
+    def progress(self, done, total):
+        now = time.perf_counter()
+        if now - self.last >= self.interval or done == total:
+            self.last = now
+            self.callback(done, total)
+
+
+class MultiObserver(Observer):
+    """Forward every event to all the ``observers``."""
+
+    def __init__(self, observers):
+        self.observers = observers
+
+    def span(self, phase, seconds, nbytes=0):
+        for observer in self.observers:
+            observer.span(phase, seconds, nbytes)
+
+    def progress(self, done, total):
+        for observer in self.observers:
+            observer.progress(done, total)
+
+
+class PrometheusObserver(Observer):
+    """Export the phases as Prometheus counters registered in ``registry`` (the default registry if ``None``).
+
+    Requires the ``prometheus_client`` package. The counters are ``<namespace>_phase_seconds_total`` and
+    ``<namespace>_phase_bytes_total``, labelled by phase.
+    """
+
+    def __init__(self, registry=None, namespace='cfshare'):
+        try:
+            from prometheus_client import REGISTRY, Counter
+        except ImportError:
+            raise ImportError("The prometheus_client package is required to export metrics to Prometheus")
+        registry = REGISTRY if registry is None else registry
+        self.seconds = Counter('phase_seconds', 'Time spent in every phase of split and bind', ['phase'],
+                               namespace=namespace, registry=registry)
+        self.bytes = Counter('phase_bytes', 'Bytes processed by every phase of split and bind', ['phase'],
+                             namespace=namespace, registry=registry)
+
+    def span(self, phase, seconds, nbytes=0):
+        self.seconds.labels(phase).inc(seconds)
+        self.bytes.labels(phase).inc(nbytes)
+
+
+def print_progress(done, total, stream=None):
+    """Progress callback drawing a single updating line on ``stream`` (standard error by default)."""
+    stream = sys.stderr if stream is None else stream
+    if total:
+        line = "\r{:6.1%} {}/{} bytes".format(done / total, done, total)
+    else:
+        line = "\r{} bytes".format(done)
+    stream.write(line + ('\n' if done == total else ''))
+    stream.flush()
+
+
+@contextlib.contextmanager
+def span(observer, phase, nbytes=0):
+    """Report the time spent in the ``with`` block to ``observer`` (which may be ``None``)."""
+    if observer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observer.span(phase, time.perf_counter() - start, nbytes)
+
+
+class TimedWriter:
+    """Writer reporting the time and bytes of every write to ``observer``, and the progress when asked to.
+
+    Other attributes are those of the wrapped ``writer``.
+    """
+
+    def __init__(self, writer, observer, phase, total=None, progress=False):
+        self.writer = writer
+        self.observer = observer
+        self.phase = phase
+        self.total = total
+        self.report_progress = progress
+        self.done = 0
+
+    def write(self, b):
+        start = time.perf_counter()
+        n = self.writer.write(b)
+        self.observer.span(self.phase, time.perf_counter() - start, len(b))
+        self.done += len(b)
+        if self.report_progress:
+            self.observer.progress(self.done, self.total)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+class TimedReader:
+    """Reader reporting the time spent waiting for every read to ``observer``, and the progress when asked to.
+
+    Wraps a file object (``readinto`` and ``read``) or an iterable of chunks.
+    """
+
+    def __init__(self, reader, observer, phase='read', total=None, progress=False):
+        self.reader = reader
+        self.observer = observer
+        self.phase = phase
+        self.total = total
+        self.report_progress = progress
+        self.done = 0
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self.reader.readinto(b)
+        self._report(start, n)
+        return n
+
+    def read(self, n=-1):
+        start = time.perf_counter()
+        b = self.reader.read(n)
+        self._report(start, len(b))
+        return b
+
+    def __iter__(self):
+        chunks = iter(self.reader)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            self._report(start, len(chunk))
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def _report(self, start, n):
+        self.observer.span(self.phase, time.perf_counter() - start, n)
+        if n:
+            self.done += n
+            if self.report_progress:
+                self.observer.progress(self.done, self.total)
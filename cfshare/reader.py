@@ -0,0 +1,124 @@
+import hmac as hmac_compare
+import io
+
+from cryptography.exceptions import InvalidSignature
+
+from cfshare.ciphers import get_cipher_spec
+
+
+class _PayloadReader(io.RawIOBase):
+    """Seekable read-only view over the plaintext of a payload.
+
+    Subclasses define ``_decrypt_range(position, n)``, returning the ``n`` bytes of plaintext starting at ``position``.
+    """
+
+    def __init__(self, payload, length):
+        super().__init__()
+        self.payload = payload
+        self.length = length
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            self._at_end()
+            position = self.length + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self.position = position
+        return position
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        n = max(0, min(len(view), self.length - self.position))
+        if n > 0:
+            view[:n] = self._decrypt_range(self.position, n)
+            self.position += n
+        if self.position >= self.length:
+            self._at_end()
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.payload.close()
+        super().close()
+
+    def _at_end(self):
+        pass
+
+
+class SegmentedReader(_PayloadReader):
+    """Random access to a segmented payload, only the segments covering a read are decrypted and authenticated.
+
+    The root tag is checked the first time the end of the file is reached, so a truncated payload is detected.
+    """
+
+    def __init__(self, payload, segmenter, root):
+        self.segmenter = segmenter
+        self.root = root
+        self.block = segmenter.segment_size + segmenter.tag_len
+        full, rest = divmod(payload.size, self.block)
+        if 0 < rest <= segmenter.tag_len:
+            payload.close()
+            raise InvalidSignature("The payload is truncated")
+        self.segments = full + int(rest > 0)
+        self.root_checked = False
+        self.cached = (None, None)
+        super().__init__(payload, payload.size - self.segments * segmenter.tag_len)
+
+    def _segment(self, index):
+        if self.cached[0] != index:
+            block = self.payload.pread(index * self.block, self.block)
+            self.cached = (index, self.segmenter.decrypt(index, block)[0])
+        return self.cached[1]
+
+    def _decrypt_range(self, position, n):
+        result = bytearray()
+        while n > 0:
+            index, skip = divmod(position, self.segmenter.segment_size)
+            pt = self._segment(index)[skip:skip + n]
+            result += pt
+            position += len(pt)
+            n -= len(pt)
+        return result
+
+    def _at_end(self):
+        if self.root_checked:
+            return
+        tags = []
+        for index in range(self.segments):
+            len_segment = min(self.segmenter.segment_size, self.length - index * self.segmenter.segment_size)
+            tags.append(self.payload.pread(index * self.block + len_segment, self.segmenter.tag_len))
+        if not hmac_compare.compare_digest(self.segmenter.root_tag(tags), self.root):
+            raise InvalidSignature("The root tag does not match")
+        self.root_checked = True
+
+
+class StreamReader(_PayloadReader):
+    """Random access to an already authenticated stream payload, seeking the keystream to the requested range."""
+
+    def __init__(self, payload, mode, key, iv):
+        self.spec = get_cipher_spec(mode)
+        self.key = key
+        self.iv = iv
+        super().__init__(payload, payload.size)
+
+    def _decrypt_range(self, position, n):
+        # 64 bytes is a multiple of the counter block of every supported stream cipher
+        aligned = position - position % 64
+        decryptor = self.spec.cipher(self.key, self.spec.seek_iv(self.iv, aligned)).decryptor()
+        return decryptor.update(self.payload.pread(aligned, n + position - aligned))[position - aligned:]
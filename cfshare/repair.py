@@ -0,0 +1,170 @@
+import contextlib
+import hmac as hmac_compare
+import io
+import os
+import shutil
+import sys
+
+from cryptography.exceptions import InvalidSignature
+
+from cfshare.cfshare import CFShare, ContainerFormat, Layout
+from cfshare.segments import make_segmenter
+from cfshare.streams import DispersedPayload
+
+
+def repair(fileout, total_shares, refresh=False, min_shares=None, verify=False):
+    """Restore the missing outputs of the split named after ``fileout`` without re-encrypting its payload.
+
+    New shares are issued on the polynomial of the remaining ones, which stay valid. A missing output gets the
+    payload of a remaining one, copied as is or, when dispersed, re-encoded from the remaining pieces. With
+    ``refresh`` a new set of shares of the same key replaces all of them instead; the minimum number of shares is
+    read from the headers or given by ``min_shares``. Every output is first written under a temporary name, the old
+    ones are only replaced once all of them are complete.
+
+    Fewer shares than the minimum recorded in the headers are refused. The key combined from the remaining shares
+    is authenticated against the tag of the payload before anything is written: from the segment tags of a segmented
+    payload, by a full pass over a payload using the stream container or with ``verify``. Returns the paths written.
+    """
+    names = [fileout + "{}_{}".format(i + 1, total_shares) for i in range(total_shares)]
+    # The outputs of a shares only split are the .share files next to the encrypted file
+    sharesonly = not any(os.path.isfile(name) for name in names) and os.path.isfile(fileout)
+    paths = [name + '.share' for name in names] if sharesonly else names
+    found = {}
+    for i, path in enumerate(paths):
+        if os.path.isfile(path):
+            found[i] = _read_header(path, sharesonly)
+    if not found:
+        print("No shares of {} were found".format(fileout))
+        sys.exit(1)
+    header = next(iter(found.values()))
+    layout = header['layout']
+    if layout == Layout.FRAGMENT and len(found) < total_shares:
+        print("Missing fragments can't be rebuilt, every fragment holds a different part of the payload")
+        sys.exit(1)
+    recorded = _get_threshold(header)
+    if recorded and len(found) < recorded:
+        print("At least {} shares are required, only {} were found".format(recorded, len(found)))
+        sys.exit(1)
+    if sharesonly:
+        filein, fshares = [fileout], [found[i]['path'] for i in sorted(found)]
+    else:
+        filein, fshares = [found[i]['path'] for i in sorted(found)], []
+    mode, key, iv, tag, sources = CFShare._load_sources(filein, fshares)
+    try:
+        _check_key(mode, key, iv, tag, sources, filein, fshares, verify)
+        missing = [i for i in range(total_shares) if i not in found]
+        if refresh:
+            threshold = recorded or min_shares
+            if not threshold:
+                print("The minimum number of shares is not recorded in the headers and must be given")
+                sys.exit(1)
+            scheme = CFShare._unpack_mode(mode)['scheme']
+            new_shares = dict(CFShare._create_shares(scheme, threshold, total_shares, key))
+        else:
+            shares = [found[i]['share'] for i in sorted(found)]
+            new_shares = {i: CFShare._issue_share(mode, shares, i) for i in missing}
+        rewritten = sorted(found) if refresh else []
+        tmp_paths = [paths[i] + '.repair' for i in missing + rewritten]
+        try:
+            _write_missing(tmp_paths, missing, found, new_shares, mode, layout, sources)
+            for tmp_path, i in zip(tmp_paths[len(missing):], rewritten):
+                _rewrite_share(tmp_path, found[i], mode, i, new_shares[i])
+            # Only replaced once every output is complete, an interruption leaves the old set of shares usable
+            for tmp_path, i in zip(tmp_paths, missing + rewritten):
+                os.replace(tmp_path, paths[i])
+        except BaseException:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        written = [paths[i] for i in missing + rewritten]
+    finally:
+        if isinstance(sources, DispersedPayload):
+            sources.close()
+    return written
+
+
+def _read_header(path, sharesonly):
+    with open(path, 'rb') as f:
+        layout = None if sharesonly else Layout(f.read(1)[0])
+        share_offset = f.tell()
+        mode = int.from_bytes(f.read(8), 'little')
+        schema_lens = CFShare._get_len_elements_from_mode(mode)
+        index = int.from_bytes(f.read(schema_lens['share_index']), 'little')
+        len_share = int.from_bytes(f.read(schema_lens['share_len']), 'little')
+        share = f.read(len_share)
+        # The fields following the share are the same in every output
+        trailer = b''
+        if not sharesonly:
+            fields = ['iv', 'tag'] + (['payload_len', 'threshold'] if layout == Layout.DISPERSED else [])
+            trailer = f.read(sum(schema_lens[x] for x in fields))
+        return {'path': path, 'layout': layout, 'mode': mode, 'index': index, 'share': share,
+                'share_offset': share_offset, 'trailer': trailer, 'header_len': f.tell()}
+
+
+def _check_key(mode, key, iv, tag, sources, filein, fshares, verify):
+    params = CFShare._unpack_mode(mode)
+    if verify or params['container'] != ContainerFormat.SEGMENTED:
+        passed = CFShare.verify(filein, fshares)
+    else:
+        # The root tag is keyed with the combined key and covers the tags of every segment
+        segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'])
+        payload = CFShare._open_payload(sources)
+        try:
+            block = segmenter.segment_size + segmenter.tag_len
+            full, rest = divmod(payload.size, block)
+            tags = [payload.pread(index * block + segmenter.segment_size, segmenter.tag_len) for index in range(full)]
+            if rest:
+                tags.append(payload.pread(payload.size - segmenter.tag_len, segmenter.tag_len))
+            passed = hmac_compare.compare_digest(segmenter.root_tag(tags), tag)
+        except InvalidSignature:
+            # Truncated dispersed pieces
+            passed = False
+        finally:
+            payload.close()
+    if not passed:
+        print("The shares were incorrect")
+        sys.exit(1)
+
+
+def _get_threshold(header):
+    # 0 when the split did not record it
+    if header['layout'] == Layout.DISPERSED:
+        return int.from_bytes(header['trailer'][-8:], 'little')
+    return CFShare._unpack_mode(header['mode'])['threshold']
+
+
+def _header(header, mode, index, share):
+    schema_lens = CFShare._get_len_elements_from_mode(mode)
+    fo = io.BytesIO()
+    if header['layout'] is not None:
+        fo.write(int.to_bytes(header['layout'].value, schema_lens['layout'], 'little'))
+    CFShare._write_share(fo, mode, (index, share), schema_lens)
+    fo.write(header['trailer'])
+    return fo.getvalue()
+
+
+def _write_missing(tmp_paths, missing, found, new_shares, mode, layout, sources):
+    source = found[min(found)]
+    with contextlib.ExitStack() as stack:
+        outputs = [stack.enter_context(open(path, 'wb')) for path in tmp_paths[:len(missing)]]
+        for i, fo in zip(missing, outputs):
+            fo.write(_header(source, mode, i, new_shares[i]))
+        if layout == Layout.DISPERSED and missing:
+            for pieces in sources.encode_pieces(missing):
+                for fo, piece in zip(outputs, pieces):
+                    fo.write(piece)
+        elif layout is not None:
+            # Every output holds a copy of the encrypted payload
+            for fo in outputs:
+                with open(source['path'], 'rb') as fi:
+                    fi.seek(source['header_len'])
+                    shutil.copyfileobj(fi, fo, 1 << 20)
+
+
+def _rewrite_share(tmp_path, header, mode, index, share):
+    # The output is copied with its new header, its payload is unchanged
+    with open(tmp_path, 'wb') as fo, open(header['path'], 'rb') as fi:
+        fo.write(_header(header, mode, index, share))
+        fi.seek(header['header_len'])
+        shutil.copyfileobj(fi, fo, 1 << 20)
@@ -0,0 +1,217 @@
+import contextlib
+import hmac as hmac_compare
+import json
+import os
+import secrets
+import sys
+
+from cryptography.exceptions import InvalidSignature
+
+from cfshare.cfshare import CFShare, CipherMode, ContainerFormat, Layout, ShareScheme
+from cfshare.compression import Codec
+from cfshare.segments import DEFAULT_SEGMENT_SIZE, make_segmenter, ordered_map, payload_length
+from cfshare.streams import FanOutWriter, FragmentWriter, PayloadFile
+
+# Resumable split and bind write their outputs to .partial files and record their progress in a journal every
+# ``checkpoint`` segments, once the outputs are synced to disk. Only the segmented container can be resumed: every
+# segment is encrypted and authenticated on its own, so the work resumes at the first segment after the checkpoint
+# and the tags of the segments already written are read back from the outputs to compute the root tag. The journal
+# holds no secret, an interrupted split recovers its key from the shares already written to the partial outputs.
+PARTIAL_SUFFIX = '.partial'
+JOURNAL_SUFFIX = '.cfshare_journal'
+DEFAULT_CHECKPOINT = 64
+
+
+def split_file(filein, fileout, min_shares, total_shares, mode=CipherMode.AES, segment_size=DEFAULT_SEGMENT_SIZE,
+               scheme=ShareScheme.PRIME256, sharesonly=False, workers=None, checkpoint=DEFAULT_CHECKPOINT,
+               observer=None):
+    """Split the file ``filein`` like ``CFShare.split_file``, resuming an interrupted split of the same file.
+
+    The outputs are renamed to their final names once complete. Dispersed shares can't be split resumably.
+    ``observer`` receives the timings of the segments encrypted by this run.
+    """
+    layout = CFShare._get_layout(min_shares, total_shares, sharesonly, False)
+    names = [fileout + "{}_{}".format(i + 1, total_shares) for i in range(total_shares)]
+    share_names = [name + '.share' for name in names] if sharesonly else []
+    outputs = [fileout] if sharesonly else names
+    journal_path = fileout + JOURNAL_SUFFIX
+    st = os.stat(filein)
+    source = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    journal = _load_journal(journal_path)
+    if journal is not None and journal.get('input') != source:
+        print("{} changed since its split was interrupted, remove {} to start over".format(filein, journal_path))
+        sys.exit(1)
+    if journal is None:
+        journal = _start_split(outputs, share_names, layout, min_shares, total_shares, mode, segment_size, scheme)
+        journal['input'] = source
+        _save_journal(journal_path, journal)
+    mode_field = journal['mode']
+    params = CFShare._unpack_mode(mode_field)
+    partials = [name + PARTIAL_SUFFIX for name in outputs]
+    share_partials = [name + PARTIAL_SUFFIX for name in share_names]
+    if sharesonly:
+        loaded = CFShare._load_sources(partials, share_partials)
+    else:
+        loaded = CFShare._load_sources(partials, [])
+    _, key, iv, _, sources = loaded
+    segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'], observer)
+    block = segmenter.segment_size + segmenter.tag_len
+    done = journal['segments']
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(open(path, 'r+b')) for path in partials]
+        for fo, position in zip(writers, journal['positions']):
+            fo.truncate(position)
+            fo.seek(position)
+        tags = _read_tags(sources, segmenter, done)
+        if layout == Layout.FRAGMENT:
+            sink = FragmentWriter(writers, payload_length(source['size'], segmenter.segment_size, segmenter.tag_len))
+            sink.position = done * block
+        else:
+            sink = FanOutWriter(writers)
+        f = stack.enter_context(open(filein, 'rb'))
+        f.seek(done * segmenter.segment_size)
+        blocks = enumerate(iter(lambda: f.read(segmenter.segment_size), b''), done)
+        for ct, tag in ordered_map(segmenter.encrypt, blocks, workers):
+            sink.write(ct)
+            sink.write(tag)
+            tags.append(tag)
+            done += 1
+            if done % checkpoint == 0:
+                _checkpoint(writers, journal_path, dict(journal, segments=done))
+        root = segmenter.root_tag(tags)
+        for fo, offset in zip(writers, journal['tag_offsets']):
+            fo.seek(offset)
+            fo.write(root)
+            _sync(fo)
+    for name in share_names + outputs:
+        os.replace(name + PARTIAL_SUFFIX, name)
+    os.remove(journal_path)
+
+
+def reconstruct_file(filein, fileout, fshares=None, workers=None, checkpoint=DEFAULT_CHECKPOINT, observer=None):
+    """Reconstruct ``fileout`` like ``CFShare.reconstruct_file``, resuming an interrupted bind of the same file.
+
+    Only files split with a segment size (and without compression) can be bound resumably.
+    """
+    loaded = CFShare._load_sources(filein, fshares, observer)
+    if loaded is None:
+        return
+    mode, key, iv, tag, sources = loaded
+    params = CFShare._unpack_mode(mode)
+    if params['container'] != ContainerFormat.SEGMENTED or params['codec'] != Codec.NONE:
+        print("Only files split with a segment size and without compression can be bound resumably")
+        sys.exit(1)
+    segmenter = make_segmenter(params['cipher'], key, iv, params['segment_size'], observer)
+    payload = CFShare._open_payload(sources)
+    partial = fileout + PARTIAL_SUFFIX
+    journal_path = fileout + JOURNAL_SUFFIX
+    identity = (iv + tag).hex()
+    journal = _load_journal(journal_path)
+    if journal is None or journal.get('id') != identity or not os.path.isfile(partial):
+        journal = {'id': identity, 'segments': 0, 'position': 0}
+    block = segmenter.segment_size + segmenter.tag_len
+    full, rest = divmod(payload.size, block)
+    try:
+        if 0 < rest <= segmenter.tag_len:
+            raise InvalidSignature("The payload is truncated")
+        done = journal['segments']
+        tags = _read_tags(payload, segmenter, done)
+        with open(partial, 'r+b' if done else 'wb') as fo:
+            fo.truncate(journal['position'])
+            fo.seek(journal['position'])
+            blocks = ((index, payload.pread(index * block, block)) for index in range(done, full + int(rest > 0)))
+            for pt, segment_tag in ordered_map(segmenter.decrypt, blocks, workers):
+                fo.write(pt)
+                tags.append(segment_tag)
+                done += 1
+                if done % checkpoint == 0:
+                    _checkpoint([fo], journal_path, {'id': identity, 'segments': done})
+            if not hmac_compare.compare_digest(segmenter.root_tag(tags), tag):
+                raise InvalidSignature("The root tag does not match")
+            _sync(fo)
+    except InvalidSignature:
+        print("The shares were incorrect")
+        for path in (partial, journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        sys.exit(1)
+    finally:
+        payload.close()
+    os.replace(partial, fileout)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def _start_split(outputs, share_names, layout, min_shares, total_shares, mode, segment_size, scheme):
+    schema_lens = CFShare._get_len_elements_from_mode(mode)
+    if segment_size is None:
+        segment_size = DEFAULT_SEGMENT_SIZE
+    mode_field = CFShare._pack_mode(mode, ContainerFormat.SEGMENTED, segment_size, scheme, min_shares)
+    key = secrets.token_bytes(32)
+    iv = secrets.token_bytes(schema_lens['iv'])
+    # Fail before writing anything if the segment size is invalid
+    make_segmenter(mode, key, iv, segment_size)
+    shares = CFShare._create_shares(scheme, min_shares, total_shares, key)
+    for name, share in zip(share_names, shares):
+        with open(name + PARTIAL_SUFFIX, 'wb') as fo:
+            CFShare._write_share(fo, mode_field, share, schema_lens)
+            _sync(fo)
+    positions = []
+    tag_offsets = []
+    for index, name in enumerate(outputs):
+        with open(name + PARTIAL_SUFFIX, 'wb') as fo:
+            if not share_names:
+                fo.write(int.to_bytes(layout.value, schema_lens['layout'], 'little'))
+                CFShare._write_share(fo, mode_field, shares[index], schema_lens)
+            tag_offsets.append(fo.tell() + schema_lens['iv'])
+            fo.write(iv + bytes(schema_lens['tag']))
+            positions.append(fo.tell())
+            _sync(fo)
+    return {'mode': mode_field, 'segments': 0, 'positions': positions, 'tag_offsets': tag_offsets}
+
+
+def _read_tags(payload, segmenter, count):
+    # The tags of the segments already written, which are all full
+    if count == 0:
+        return []
+    opened = not hasattr(payload, 'pread')
+    if opened:
+        payload = PayloadFile(payload)
+    try:
+        block = segmenter.segment_size + segmenter.tag_len
+        return [payload.pread(index * block + segmenter.segment_size, segmenter.tag_len) for index in range(count)]
+    finally:
+        if opened:
+            payload.close()
+
+
+def _checkpoint(writers, journal_path, journal):
+    for fo in writers:
+        _sync(fo)
+    if 'positions' in journal:
+        journal['positions'] = [fo.tell() for fo in writers]
+    else:
+        journal['position'] = writers[0].tell()
+    _save_journal(journal_path, journal)
+
+
+def _sync(fo):
+    fo.flush()
+    os.fsync(fo.fileno())
+
+
+def _load_journal(path):
+    try:
+        with open(path) as fi:
+            return json.load(fi)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_journal(path, journal):
+    # Replaced atomically, so an interruption leaves either checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fo:
+        json.dump(journal, fo)
+        _sync(fo)
+    os.replace(tmp_path, path)
@@ -0,0 +1,200 @@
+import collections
+import hmac as hmac_compare
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, hmac
+
+from cfshare.ciphers import get_cipher_spec
+from cfshare.metrics import span
+
+SEGMENT_TAG_LEN = 32
+DEFAULT_SEGMENT_SIZE = 1 << 20
+MIN_SEGMENT_BITS = 6
+
+
+def check_segment_size(segment_size):
+    """Raise ``ValueError`` if ``segment_size`` is not a power of two of at least ``1 << MIN_SEGMENT_BITS``."""
+    if segment_size < (1 << MIN_SEGMENT_BITS) or segment_size & (segment_size - 1):
+        raise ValueError("The segment size must be a power of two not lower than {}".format(1 << MIN_SEGMENT_BITS))
+
+
+class SegmentCipher:
+    """Encrypt and authenticate independent fixed-size segments of a payload.
+
+    Segment ``i`` is encrypted with the keystream starting at byte ``i * segment_size`` and is followed by an
+    HMAC-SHA256 over its index and ciphertext. The root tag is an HMAC over the segment size and all the segment tags.
+    The time spent on every segment is reported to ``observer`` when it is set.
+    """
+
+    observer = None
+
+    def __init__(self, mode, key, iv, segment_size):
+        check_segment_size(segment_size)
+        self.spec = get_cipher_spec(mode)
+        self.key = key
+        self.iv = iv
+        self.segment_size = segment_size
+        self.tag_len = self.spec.segment_tag_len
+
+    def segment_iv(self, index):
+        return self.spec.seek_iv(self.iv, index * self.segment_size)
+
+    def segment_tag(self, index, ct):
+        h = hmac.HMAC(self.key, hashes.SHA256(), default_backend())
+        h.update(int.to_bytes(index, 8, 'little'))
+        h.update(ct)
+        return h.finalize()
+
+    def root_tag(self, tags):
+        h = hmac.HMAC(self.key, hashes.SHA256(), default_backend())
+        h.update(int.to_bytes(self.segment_size, 8, 'little'))
+        for tag in tags:
+            h.update(tag)
+        return h.finalize()
+
+    def encrypt(self, index, pt):
+        with span(self.observer, 'encrypt', len(pt)):
+            encryptor = self.spec.cipher(self.key, self.segment_iv(index)).encryptor()
+            ct = encryptor.update(pt) + encryptor.finalize()
+        with span(self.observer, 'mac', len(ct)):
+            return ct, self.segment_tag(index, ct)
+
+    def verify(self, index, block):
+        """Authenticate a segment without decrypting it and return its tag."""
+        ct, tag = block[:-self.tag_len], block[-self.tag_len:]
+        with span(self.observer, 'mac', len(ct)):
+            if len(tag) != self.tag_len or not hmac_compare.compare_digest(self.segment_tag(index, ct), tag):
+                raise InvalidSignature("Segment {} failed authentication".format(index))
+        return tag
+
+    def decrypt(self, index, block):
+        tag = self.verify(index, block)
+        with span(self.observer, 'decrypt', len(block) - self.tag_len):
+            decryptor = self.spec.cipher(self.key, self.segment_iv(index)).decryptor()
+            return decryptor.update(block[:-self.tag_len]) + decryptor.finalize(), tag
+
+    def encrypt_stream(self, f, sink, workers=None):
+        """Encrypt the file-like object ``f`` into ``sink`` and return the root tag."""
+        tags = []
+        blocks = enumerate(iter(lambda: f.read(self.segment_size), b''))
+        for ct, tag in ordered_map(self.encrypt, blocks, workers):
+            sink.write(ct)
+            sink.write(tag)
+            tags.append(tag)
+        return self.root_tag(tags)
+
+    def decrypt_stream(self, chunks, sink, root, workers=None):
+        """Decrypt the payload read from the iterable ``chunks`` into ``sink``, verifying every segment and the root.
+
+        Raises ``InvalidSignature`` on the first segment that fails authentication.
+        """
+        for pt in self.decrypt_chunks(chunks, root, workers):
+            sink.write(pt)
+
+    def decrypt_chunks(self, chunks, root, workers=None):
+        """Yield the plaintext of every segment of the payload read from the iterable ``chunks``.
+
+        Every segment is authenticated before being yielded, ``InvalidSignature`` is raised on the first one that
+        fails or, after the last one, if the root tag does not match.
+        """
+        tags = []
+        blocks = enumerate(regroup(chunks, self.segment_size + self.tag_len))
+        for pt, tag in ordered_map(self.decrypt, blocks, workers):
+            tags.append(tag)
+            yield pt
+        if not hmac_compare.compare_digest(self.root_tag(tags), root):
+            raise InvalidSignature("The root tag does not match")
+
+    def verify_stream(self, chunks, root, workers=None):
+        """Authenticate the payload read from the iterable ``chunks`` without producing any plaintext.
+
+        Stops at the first segment that fails authentication, raising ``InvalidSignature``.
+        """
+        blocks = enumerate(regroup(chunks, self.segment_size + self.tag_len))
+        tags = list(ordered_map(self.verify, blocks, workers))
+        if not hmac_compare.compare_digest(self.root_tag(tags), root):
+            raise InvalidSignature("The root tag does not match")
+
+
+class AEADSegmentCipher(SegmentCipher):
+    """Segments sealed in one pass by an AEAD cipher, the root tag is still an HMAC over the segment tags."""
+
+    def __init__(self, mode, key, iv, segment_size):
+        super().__init__(mode, key, iv, segment_size)
+        self.aead = self.spec.aead_for(key)
+
+    def encrypt(self, index, pt):
+        # The authentication of an AEAD cipher is reported as part of encrypt and decrypt
+        with span(self.observer, 'encrypt', len(pt)):
+            sealed = self.aead.encrypt(self.spec.segment_nonce(self.iv, index), pt, int.to_bytes(index, 8, 'little'))
+        return sealed[:-self.tag_len], sealed[-self.tag_len:]
+
+    def decrypt(self, index, block):
+        if len(block) < self.tag_len:
+            raise InvalidSignature("Segment {} failed authentication".format(index))
+        try:
+            with span(self.observer, 'decrypt', len(block) - self.tag_len):
+                pt = self.aead.decrypt(self.spec.segment_nonce(self.iv, index), block,
+                                       int.to_bytes(index, 8, 'little'))
+        except InvalidTag:
+            raise InvalidSignature("Segment {} failed authentication".format(index))
+        return pt, block[-self.tag_len:]
+
+    def verify(self, index, block):
+        # The tag of an AEAD cipher can only be checked by decrypting
+        return self.decrypt(index, block)[1]
+
+
+def make_segmenter(mode, key, iv, segment_size, observer=None):
+    if get_cipher_spec(mode).aead:
+        segmenter = AEADSegmentCipher(mode, key, iv, segment_size)
+    else:
+        segmenter = SegmentCipher(mode, key, iv, segment_size)
+    segmenter.observer = observer
+    return segmenter
+
+
+def seek_iv(mode, iv, offset):
+    """Return the IV whose keystream starts at byte ``offset`` of the keystream of ``iv``."""
+    return get_cipher_spec(mode).seek_iv(iv, offset)
+
+
+def payload_length(len_pt, segment_size, tag_len=SEGMENT_TAG_LEN):
+    segments = -(-len_pt // segment_size)
+    return len_pt + segments * tag_len
+
+
+def regroup(chunks, size):
+    """Yield blocks of exactly ``size`` bytes out of the iterable ``chunks``, the last one may be shorter."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def ordered_map(fn, items, workers=None):
+    """Apply ``fn`` to the argument tuples of ``items`` on a thread pool, yielding the results in order.
+
+    At most ``2 * workers`` items are in flight, so memory stays bounded regardless of the input length.
+    """
+    if workers == 1:
+        for item in items:
+            yield fn(*item)
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, *item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,314 @@
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cfshare.cfshare import CFShare, CipherMode, ShareScheme
+from cfshare.compression import Codec
+from cfshare.streams import DEFAULT_CHUNK, IterReader
+
+# Jobs are sent to the server as JSON objects, one per line, and answered by a JSON line. Several jobs can be sent on
+# the same connection, one after the other:
+#   {"op": "split", "filein": path, "fileout": path, "min_shares": m, "total_shares": t, "options": {...}}
+#   {"op": "bind", "filein": [paths], "fshares": [paths], "fileout": path}
+#   {"op": "verify", "filein": [paths], "fshares": [paths]}
+#   {"op": "stats"}
+# Without "filein" a split reads the "length" bytes following the request line. Without "fileout" a bind streams
+# the plaintext back as frames [length 4][data] ended by an empty frame, before its reply line. Paths must be
+# absolute, the working directory of the server is not the one of its clients.
+DEFAULT_MAX_QUEUE = 1024
+MAX_LINE = 1 << 20
+FRAME_LEN_LEN = 4
+
+
+class Server:
+    """Run the jobs received on the Unix socket ``path`` on a pool of ``jobs`` threads (default: number of cores).
+
+    ``workers`` is the number of threads every job uses for segmented files unless the job sets its own. At most
+    ``max_queue`` jobs wait for a thread, further jobs are rejected as busy until the queue drains. The socket is
+    only accessible to the user running the server.
+    """
+
+    def __init__(self, path, jobs=None, workers=None, max_queue=DEFAULT_MAX_QUEUE):
+        self.path = path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(self.jobs)
+        self.lock = threading.Lock()
+        self.metrics = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'queued': 0, 'running': 0,
+                        'queue_seconds': 0.0, 'run_seconds': 0.0}
+        _remove_stale_socket(path)
+        # Created without permissions for other users, who could otherwise run jobs on the files of this one
+        umask = os.umask(0o077)
+        try:
+            self.server = _UnixServer(path, _Handler)
+        finally:
+            os.umask(umask)
+        self.server.owner = self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop accepting jobs, wait for the running ones and remove the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.executor.shutdown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def stats(self):
+        """Return the counters of the jobs and the total time they spent queued and running."""
+        with self.lock:
+            return dict(self.metrics, jobs=self.jobs, max_queue=self.max_queue)
+
+    def submit(self, fn, *args):
+        """Queue ``fn(*args)`` and return its future, or ``None`` if the queue is full.
+
+        The future results in ``(result, queued seconds, run seconds)``.
+        """
+        with self.lock:
+            if self.metrics['queued'] >= self.max_queue:
+                self.metrics['rejected'] += 1
+                return None
+            self.metrics['queued'] += 1
+            self.metrics['submitted'] += 1
+        enqueued = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            with self.lock:
+                self.metrics['queued'] -= 1
+                self.metrics['running'] += 1
+                self.metrics['queue_seconds'] += started - enqueued
+            failed = True
+            try:
+                result = fn(*args)
+                failed = False
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.metrics['running'] -= 1
+                    self.metrics['run_seconds'] += elapsed
+                    self.metrics['failed' if failed else 'completed'] += 1
+            return result, started - enqueued, elapsed
+
+        return self.executor.submit(run)
+
+    def handle(self, message, rfile, wfile):
+        op = message.get('op')
+        if op == 'stats':
+            return {'ok': True, 'result': self.stats()}
+        body = None
+        if op == 'split' and message.get('filein') is None:
+            body = _Body(rfile, int(message.get('length', 0)))
+        streamed = op == 'bind' and message.get('fileout') is None
+        try:
+            if op not in ('split', 'bind', 'verify'):
+                return {'ok': False, 'error': "Unknown operation {}".format(op)}
+            if not _absolute_paths(message):
+                return {'ok': False, 'error': 'Paths must be absolute'}
+            future = self.submit(self._run, op, message, body, wfile if streamed else None)
+            if future is None:
+                return {'ok': False, 'error': 'busy'}
+            try:
+                result, queued, seconds = future.result()
+            except SystemExit:
+                # The error was printed by the server
+                return {'ok': False, 'error': 'failed'}
+            except Exception as e:
+                # Any failure of a job is reported to its client, the server keeps running
+                return {'ok': False, 'error': str(e) or type(e).__name__}
+            return {'ok': True, 'result': result, 'queued': queued, 'seconds': seconds}
+        finally:
+            if body is not None:
+                body.drain()
+            if streamed:
+                _write_frame(wfile, b'')
+
+    def _run(self, op, message, body, wfile):
+        kwargs = {'workers': message.get('options', {}).get('workers', self.workers)}
+        filein = message.get('filein')
+        fshares = message.get('fshares', [])
+        if op == 'split':
+            options = _get_split_options(message.get('options', {}))
+            if body is not None:
+                filein = IterReader(body)
+                options['length'] = body.length
+            CFShare.split_file(filein, message['fileout'], message['min_shares'], message['total_shares'],
+                               **dict(options, **kwargs))
+            return None
+        elif op == 'verify':
+            return CFShare.verify(filein, fshares, **kwargs)
+        elif wfile is not None:
+            for chunk in CFShare.reconstruct_stream(filein, fshares, **kwargs):
+                _write_frame(wfile, chunk)
+            return None
+        CFShare.reconstruct_file(filein, message['fileout'], fshares=fshares, **kwargs)
+        return None
+
+
+class Client:
+    """A connection to a ``Server`` listening on the Unix socket ``path``, sending one job at a time."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, message, data=None, sink=None):
+        """Send the job ``message`` and return the reply.
+
+        ``data`` (bytes) is the content split when the message has no ``filein``. The plaintext streamed back by a
+        bind without ``fileout`` is written to ``sink``.
+        """
+        if data is not None:
+            message = dict(message, length=len(data))
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        if data is not None:
+            self.wfile.write(data)
+        self.wfile.flush()
+        if message.get('op') == 'bind' and message.get('fileout') is None:
+            while True:
+                length = int.from_bytes(_read_exactly(self.rfile, FRAME_LEN_LEN), 'little')
+                if length == 0:
+                    break
+                chunk = _read_exactly(self.rfile, length)
+                if sink is not None:
+                    sink.write(chunk)
+        line = self.rfile.readline(MAX_LINE)
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+def serve(path, jobs=None, workers=None, max_queue=DEFAULT_MAX_QUEUE):
+    """Serve jobs on the Unix socket ``path`` until interrupted, see ``Server``."""
+    server = Server(path, jobs, workers, max_queue)
+    print("Listening on {} with {} jobs".format(path, server.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    owner = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line.strip():
+                return
+            try:
+                message = json.loads(line.decode('utf-8'))
+                if not isinstance(message, dict):
+                    raise ValueError("A job must be a JSON object")
+            except ValueError:
+                self._reply({'ok': False, 'error': 'Invalid request'})
+                return
+            try:
+                reply = self.server.owner.handle(message, self.rfile, self.wfile)
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e) or type(e).__name__}
+            self._reply(reply)
+
+    def _reply(self, reply):
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class _Body:
+    """The ``length`` bytes of content following a request line, yielded in chunks."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.length = length
+        self.remaining = length
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.rfile.read(min(DEFAULT_CHUNK, self.remaining))
+            if not chunk:
+                raise ConnectionError("The content of the request is truncated")
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def drain(self):
+        # The connection stays usable for the next job even if this one did not read its whole content
+        for _ in self:
+            pass
+
+
+def _get_split_options(options):
+    try:
+        return {'mode': CipherMode[options.get('mode', 'AES')],
+                'sharesonly': bool(options.get('sharesonly', False)),
+                'segment_size': options.get('segment_size'),
+                'dispersed': bool(options.get('dispersed', False)),
+                'scheme': ShareScheme[options.get('scheme', 'PRIME256')],
+                'compression': Codec[options.get('compression', 'NONE')]}
+    except KeyError as e:
+        raise ValueError("Unknown option value {}".format(e))
+
+
+def _absolute_paths(message):
+    paths = []
+    for field in ('filein', 'fshares', 'fileout'):
+        value = message.get(field)
+        paths.extend(value if isinstance(value, list) else [] if value is None else [value])
+    return all(isinstance(path, str) and os.path.isabs(path) for path in paths)
+
+
+def _write_frame(wfile, chunk):
+    wfile.write(int.to_bytes(len(chunk), FRAME_LEN_LEN, 'little'))
+    wfile.write(chunk)
+    if not chunk:
+        wfile.flush()
+
+
+def _read_exactly(rfile, n):
+    b = rfile.read(n)
+    if len(b) != n:
+        raise ConnectionError("The server closed the connection")
+    return b
+
+
+def _remove_stale_socket(path):
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except OSError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    print("A server is already listening on {}".format(path))
+    sys.exit(1)
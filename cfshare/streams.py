@@ -0,0 +1,445 @@
+import bisect
+import contextlib
+import os
+import queue
+import threading
+
+from cryptography.exceptions import InvalidSignature
+
+from secret_sharing import gf256
+from secret_sharing.ida import IDA
+
+DEFAULT_CHUNK = 1 << 18
+DISPERSAL_ROW = 1 << 16
+
+
+class FanOutWriter:
+    """Write every chunk of the payload to all the share outputs."""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def write(self, b):
+        for fo in self.outputs:
+            fo.write(b)
+        return len(b)
+
+
+class FragmentWriter:
+    """Route consecutive slices of the payload to the fragment that owns them.
+
+    Every fragment but the last one receives ``total_len // len(outputs)`` bytes, the last one takes the rest.
+    """
+
+    def __init__(self, outputs, total_len):
+        self.outputs = outputs
+        self.limits = fragment_limits(total_len, len(outputs))
+        self.current = 0
+        self.position = 0
+
+    def write(self, b):
+        view = memoryview(b)
+        while len(view) > 0:
+            if self.current < len(self.limits) and self.position >= self.limits[self.current]:
+                self.current += 1
+                continue
+            n = len(view)
+            if self.current < len(self.limits):
+                n = min(n, self.limits[self.current] - self.position)
+            self.outputs[self.current].write(view[:n])
+            self.position += n
+            view = view[n:]
+        return len(b)
+
+
+class DispersalWriter:
+    """Disperse the payload over the share outputs so that any ``minimum`` of them rebuild it.
+
+    The payload is cut into stripes of ``minimum * DISPERSAL_ROW`` bytes and every output receives one encoded row of
+    each stripe, so it stores about ``1 / minimum`` of the payload. ``flush`` must be called after the last write.
+    """
+
+    def __init__(self, outputs, minimum):
+        self.outputs = outputs
+        self.ida = IDA(minimum)
+        self.indexes = list(range(len(outputs)))
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, b):
+        self.buffer += b
+        self.position += len(b)
+        stripe = self.ida.minimum * DISPERSAL_ROW
+        if len(self.buffer) >= stripe:
+            view = memoryview(self.buffer)
+            done = 0
+            while len(self.buffer) - done >= stripe:
+                self._write_stripe(view[done:done + stripe])
+                done += stripe
+            view.release()
+            del self.buffer[:done]
+        return len(b)
+
+    def flush(self):
+        if self.buffer:
+            # The last stripe is padded with zeros, the real payload length is stored in the header
+            self.buffer += bytes(-len(self.buffer) % self.ida.minimum)
+            self._write_stripe(memoryview(self.buffer))
+            self.buffer = bytearray()
+
+    def _write_stripe(self, stripe):
+        row = len(stripe) // self.ida.minimum
+        rows = [bytes(stripe[j * row:(j + 1) * row]) for j in range(self.ida.minimum)]
+        for fo, piece in zip(self.outputs, self.ida.encode(rows, self.indexes)):
+            fo.write(piece)
+
+
+class DiscardWriter:
+    """Sink that only counts the bytes written to it."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, b):
+        self.written += len(b)
+        return len(b)
+
+
+@contextlib.contextmanager
+def open_source(source, offset=0):
+    """Open the path ``source`` for reading at ``offset``.
+
+    A readable file object is used as is, from its current position, and is left open.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            f.seek(offset)
+            yield f
+    else:
+        yield source
+
+
+def fragment_limits(total_len, total_frags):
+    """Return the end offset of every fragment except the last one, which is unbounded."""
+    size = total_len // total_frags
+    return [size * (i + 1) for i in range(total_frags - 1)]
+
+
+class PrefetchReader:
+    """Iterate over the payload of consecutive files while a background thread reads ahead.
+
+    ``sources`` is a list of ``(path, offset)`` pairs, where ``offset`` is the number of header bytes to skip, see
+    ``open_source``.
+    At most ``depth`` chunks are kept in memory at any time.
+    """
+
+    def __init__(self, sources, max_chunk=DEFAULT_CHUNK, depth=8):
+        self.sources = sources
+        self.max_chunk = max_chunk
+        self.depth = depth
+
+    def __iter__(self):
+        chunks = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._read, args=(chunks, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    chunks.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+
+    def _read(self, chunks, stop):
+        try:
+            for path, offset in self.sources:
+                with open_source(path, offset) as fi:
+                    b = fi.read(self.max_chunk)
+                    while b and not stop.is_set():
+                        chunks.put(b)
+                        b = fi.read(self.max_chunk)
+                if stop.is_set():
+                    return
+            chunks.put(_END)
+        except Exception as e:
+            # Handed over to the consumer, which would otherwise wait forever
+            chunks.put(e)
+
+
+class ConcatReader:
+    """File-like object reading the payload of consecutive files as a single stream.
+
+    ``sources`` is a list of ``(path, offset)`` pairs, where ``offset`` is the number of header bytes to skip, see
+    ``open_source``.
+    """
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.current = None
+        self.stack = contextlib.ExitStack()
+
+    def readinto(self, b):
+        view = memoryview(b)
+        filled = 0
+        while filled < len(view):
+            if self.current is None:
+                if not self.sources:
+                    break
+                self.current = self.stack.enter_context(open_source(*self.sources.pop(0)))
+            n = self.current.readinto(view[filled:])
+            if not n:
+                self.stack.close()
+                self.current = None
+            filled += n or 0
+        return filled
+
+    def close(self):
+        self.stack.close()
+        self.current = None
+        self.sources = []
+
+
+class IterReader:
+    """File-like object reading the chunks yielded by an iterable."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readinto(self, b):
+        view = memoryview(b)
+        filled = 0
+        while filled < len(view):
+            if not self.pending:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.pending = memoryview(chunk)
+            n = min(len(view) - filled, len(self.pending))
+            view[filled:filled + n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            filled += n
+        return filled
+
+    def read(self, n):
+        b = bytearray(n)
+        return bytes(memoryview(b)[:self.readinto(b)])
+
+    def close(self):
+        self.pending = memoryview(b'')
+
+
+class Pipeline:
+    """Overlap reading, transforming and writing a stream on three stages.
+
+    A reader thread fills preallocated buffers with ``readinto``, the calling thread transforms them into a second
+    set of preallocated buffers and a writer thread drains those. The stages are connected by queues that are
+    bounded by the number of buffers, so memory use is ``2 * depth * chunk_size`` regardless of the stream length.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK, depth=4):
+        self.chunk_size = chunk_size
+        self.depth = depth
+
+    def run(self, readinto, transform, write):
+        """Pump the stream until ``readinto(buffer)`` returns 0.
+
+        ``transform(view, out)`` writes the transformed ``view`` into the buffer ``out`` and returns the number of
+        bytes it produced, ``write(view)`` must not keep a reference to ``view`` after returning.
+        """
+        free_in = queue.Queue()
+        free_out = queue.Queue()
+        for _ in range(self.depth):
+            free_in.put(bytearray(self.chunk_size))
+            # update_into may need up to a block more than its input
+            free_out.put(bytearray(self.chunk_size + 64))
+        filled = queue.Queue()
+        transformed = queue.Queue()
+        errors = []
+        reader = threading.Thread(target=self._read, args=(readinto, free_in, filled), daemon=True)
+        writer = threading.Thread(target=self._write, args=(write, transformed, free_out, errors), daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            while not errors:
+                buffer, n = filled.get()
+                if isinstance(n, BaseException):
+                    raise n
+                if n == 0:
+                    break
+                out = free_out.get()
+                produced = transform(memoryview(buffer)[:n], out)
+                free_in.put(buffer)
+                transformed.put((out, produced))
+        finally:
+            free_in.put(None)
+            transformed.put(None)
+            reader.join()
+            writer.join()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _read(readinto, free_in, filled):
+        while True:
+            buffer = free_in.get()
+            if buffer is None:
+                return
+            try:
+                n = readinto(memoryview(buffer))
+            except BaseException as e:
+                filled.put((None, e))
+                return
+            filled.put((buffer, n))
+            if n == 0:
+                return
+
+    @staticmethod
+    def _write(write, transformed, free_out, errors):
+        while True:
+            item = transformed.get()
+            if item is None:
+                return
+            out, n = item
+            if not errors:
+                try:
+                    write(memoryview(out)[:n])
+                except BaseException as e:
+                    errors.append(e)
+            # Buffers are always handed back, so the transform stage never blocks on a failed writer
+            free_out.put(out)
+
+
+class PayloadFile:
+    """Random access to a payload spread over consecutive files.
+
+    ``sources`` is a list of ``(path, offset)`` pairs, where ``offset`` is the number of header bytes to skip.
+    """
+
+    def __init__(self, sources):
+        self.files = []
+        self.starts = []
+        self.size = 0
+        try:
+            for path, offset in sources:
+                self.files.append((open(path, 'rb'), offset))
+                self.starts.append(self.size)
+                self.size += os.stat(path).st_size - offset
+        except OSError:
+            self.close()
+            raise
+
+    def pread(self, position, n):
+        """Read up to ``n`` bytes starting at ``position`` of the payload."""
+        result = bytearray()
+        index = bisect.bisect_right(self.starts, position) - 1
+        while n > 0 and 0 <= index < len(self.files) and position < self.size:
+            fi, offset = self.files[index]
+            fi.seek(offset + position - self.starts[index])
+            b = fi.read(n)
+            result += b
+            position += len(b)
+            n -= len(b)
+            index += 1
+        return bytes(result)
+
+    def close(self):
+        for fi, _ in self.files:
+            fi.close()
+        self.files = []
+
+
+class DispersedPayload:
+    """Access to a payload dispersed by ``DispersalWriter``, rebuilt from exactly ``minimum`` pieces.
+
+    ``sources`` holds the ``(path, offset)`` pairs of the pieces (see ``open_source``), ``indexes`` the index of each
+    piece and ``size`` the length of the payload before padding. ``chunks`` reads the pieces sequentially, so they may
+    be streams, while ``pread`` needs them to be paths. Truncated pieces raise ``InvalidSignature``, like a payload
+    that fails authentication.
+    """
+
+    def __init__(self, sources, indexes, minimum, size):
+        self.ida = IDA(minimum)
+        self.decoder = self.ida.decoder(indexes)
+        self.sources = sources
+        self.size = size
+        # The last stripe is only padded to a multiple of minimum, so every piece holds a ceil(size / minimum) row
+        self.piece_size = -(-size // minimum)
+        self.pieces = []
+
+    def _open_pieces(self):
+        if self.pieces:
+            return
+        try:
+            for source in self.sources:
+                self.pieces.append(PayloadFile([source]))
+        except OSError:
+            self.close()
+            raise
+        if any(piece.size < self.piece_size for piece in self.pieces):
+            self.close()
+            raise InvalidSignature("The dispersed pieces are truncated")
+
+    def _row_len(self, stripe):
+        return min(DISPERSAL_ROW, self.piece_size - stripe * DISPERSAL_ROW)
+
+    def pread(self, position, n):
+        """Read up to ``n`` bytes starting at ``position``, decoding only the rows covering the range."""
+        self._open_pieces()
+        result = bytearray()
+        n = min(n, self.size - position)
+        while n > 0:
+            stripe, offset = divmod(position, self.ida.minimum * DISPERSAL_ROW)
+            row_len = self._row_len(stripe)
+            row, skip = divmod(offset, row_len)
+            length = min(n, row_len - skip)
+            pieces = [piece.pread(stripe * DISPERSAL_ROW + skip, length) for piece in self.pieces]
+            result += gf256.linear_combination(self.decoder[row], pieces)
+            position += length
+            n -= length
+        return bytes(result)
+
+    def chunks(self):
+        """Iterate over the whole payload one decoded stripe at a time."""
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open_source(*source)) for source in self.sources]
+            remaining = self.size
+            stripe = 0
+            while remaining > 0:
+                row_len = self._row_len(stripe)
+                pieces = [f.read(row_len) for f in files]
+                if any(len(piece) != row_len for piece in pieces):
+                    raise InvalidSignature("The dispersed pieces are truncated")
+                data = b''.join(self.ida.decode(pieces, None, self.decoder))[:remaining]
+                remaining -= len(data)
+                stripe += 1
+                yield data
+
+    def encode_pieces(self, indexes):
+        """Iterate over the pieces with the given ``indexes``, one stripe at a time, re-encoded from the rows without
+        going through the payload."""
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open_source(*source)) for source in self.sources]
+            for stripe in range(-(-self.piece_size // DISPERSAL_ROW)):
+                row_len = self._row_len(stripe)
+                pieces = [f.read(row_len) for f in files]
+                if any(len(piece) != row_len for piece in pieces):
+                    raise InvalidSignature("The dispersed pieces are truncated")
+                yield self.ida.encode(self.ida.decode(pieces, None, self.decoder), indexes)
+
+    def close(self):
+        for piece in self.pieces:
+            piece.close()
+        self.pieces = []
+
+
+_END = object()
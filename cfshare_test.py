@@ -1,9 +1,29 @@
+import asyncio
 import hashlib
+import io
 import os
+import shutil
+import stat
+import subprocess
+import sys
+import threading
 import unittest
-from os.path import isfile, join
+from os.path import isdir, isfile, join
 
-from cfshare import CFShare, CipherMode
+from cryptography.exceptions import InvalidSignature
+
+from cfshare import CFShare, CipherMode, bench
+from cfshare import archive, compression, dedup, keygroup
+from cfshare.aio import LocalDirSink, MemoryObjectStore, split_to
+from cfshare.compression import Codec
+from cfshare.metrics import MultiObserver, Observer, ProgressObserver, Stats
+from cfshare.cfshare import ShareScheme
+from cfshare.segments import seek_iv
+from cfshare.server import Client, Server
+from cfshare.streams import Pipeline
+from secret_sharing.shamir import Shamir
+from secret_sharing.shamir_gf256 import ShamirGF256
+from secret_sharing.shamir_utils import ShamirUtils
 
 
 class TestCFShare(unittest.TestCase):
@@ -71,6 +91,725 @@ class TestCFShare(unittest.TestCase):
         self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
         _cleanup()
 
+    def test_split_fragments_balanced(self):
+        _write_random_file('unittest_input', 100003)
+        hash_original = _get_sha256_file('unittest_input')
+        CFShare.split_file('unittest_input', 'unittest', 5, 5, mode=CipherMode.AES)
+        sizes = [os.stat('unittest{}_5'.format(i)).st_size for i in range(1, 6)]
+        self.assertEqual(sizes[0], sizes[1])
+        self.assertEqual(sizes[-1] - sizes[0], 100003 % 5)
+        CFShare.reconstruct_file(['unittest{}_5'.format(i) for i in range(1, 6)], 'unittest_rec')
+        self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+        _cleanup()
+
+    def test_split_reconstruct_segmented(self):
+        _write_random_file('unittest_input', 10000)
+        hash_original = _get_sha256_file('unittest_input')
+        for mode in CipherMode:
+            CFShare.split_file('unittest_input', 'unittest', 3, 5, mode=mode, segment_size=1024)
+            CFShare.reconstruct_file(['unittest2_5', 'unittest4_5', 'unittest5_5'], 'unittest_rec', workers=4)
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+
+    def test_split_reconstruct_segmented_frag(self):
+        _write_random_file('unittest_input', 10000)
+        hash_original = _get_sha256_file('unittest_input')
+        CFShare.split_file('unittest_input', 'unittest', 3, 3, segment_size=1024)
+        CFShare.reconstruct_file(['unittest3_3', 'unittest1_3', 'unittest2_3'], 'unittest_rec')
+        self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+        _cleanup()
+
+    def test_split_reconstruct_aead(self):
+        _write_random_file('unittest_input', 10000)
+        with open('unittest_input', 'rb') as f:
+            original = f.read()
+        for mode in [CipherMode.AESGCM, CipherMode.ChaCha20Poly1305]:
+            CFShare.split_file('unittest_input', 'unittest', 3, 3, mode=mode)
+            CFShare.reconstruct_file(['unittest2_3', 'unittest1_3', 'unittest3_3'], 'unittest_rec')
+            with open('unittest_rec', 'rb') as f:
+                self.assertEqual(original, f.read())
+            CFShare.split_file('unittest_input', 'unittest', 2, 3, mode=mode, segment_size=1024)
+            with CFShare.open_reconstructed(['unittest1_3', 'unittest3_3']) as f:
+                f.seek(3000)
+                self.assertEqual(original[3000:4500], f.read(1500))
+            with open('unittest2_3', 'r+b') as f:
+                f.seek(-3000, os.SEEK_END)
+                b = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([b[0] ^ 1]))
+            with self.assertRaises(SystemExit):
+                CFShare.reconstruct_file(['unittest2_3', 'unittest3_3'], 'unittest_rec')
+
+    def test_segmented_tampered(self):
+        _write_random_file('unittest_input', 10000)
+        CFShare.split_file('unittest_input', 'unittest', 2, 3, segment_size=1024)
+        with open('unittest1_3', 'r+b') as f:
+            f.seek(-2000, os.SEEK_END)
+            b = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([b[0] ^ 1]))
+        with self.assertRaises(SystemExit):
+            CFShare.reconstruct_file(['unittest1_3', 'unittest2_3'], 'unittest_rec')
+        self.assertFalse(os.path.exists('unittest_rec'))
+        _cleanup()
+
+    def test_split_reconstruct_dispersed(self):
+        _write_random_file('unittest_input', 300001)
+        hash_original = _get_sha256_file('unittest_input')
+        for segment_size in [None, 4096]:
+            CFShare.split_file('unittest_input', 'unittest', 3, 5, segment_size=segment_size, dispersed=True)
+            self.assertLess(os.stat('unittest1_5').st_size, 300001 // 3 + 4096)
+            CFShare.reconstruct_file(['unittest5_5', 'unittest2_5', 'unittest4_5'], 'unittest_rec')
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+            with open('unittest_input', 'rb') as f, \
+                    CFShare.open_reconstructed(['unittest1_5', 'unittest3_5', 'unittest4_5']) as fr:
+                f.seek(200000)
+                fr.seek(200000)
+                self.assertEqual(f.read(70000), fr.read(70000))
+            # A truncated piece is reported like incorrect shares, without leaving a partial output
+            os.remove('unittest_rec')
+            with open('unittest5_5', 'r+b') as f:
+                f.truncate(os.path.getsize('unittest5_5') - 1000)
+            with self.assertRaises(SystemExit):
+                CFShare.reconstruct_file(['unittest5_5', 'unittest2_5', 'unittest4_5'], 'unittest_rec')
+            self.assertFalse(os.path.exists('unittest_rec'))
+            self.assertFalse(CFShare.verify(['unittest5_5', 'unittest2_5', 'unittest4_5']))
+        with self.assertRaises(SystemExit):
+            CFShare.split_file('unittest_input', 'unittest_many', 3, 256, dispersed=True)
+        self.assertFalse(os.path.exists('unittest_many1_256'))
+
+    def test_split_reconstruct_gf256(self):
+        hash_original = _get_sha256_file('setup.py')
+        CFShare.split_file('setup.py', 'unittest', 3, 5, scheme=ShareScheme.GF256)
+        CFShare.reconstruct_file(['unittest1_5', 'unittest3_5', 'unittest5_5'], 'unittest_rec')
+        self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+        CFShare.split_file('setup.py', 'unittest', 3, 5, scheme=ShareScheme.GF256, sharesonly=True)
+        CFShare.reconstruct_file(['unittest'], 'unittest_rec', fshares=['unittest2_5.share', 'unittest4_5.share',
+                                                                         'unittest5_5.share'])
+        self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+
+    def test_split_bind_tree(self):
+        os.makedirs('unittest_tree/sub/deeper')
+        _write_random_file('unittest_tree/a.bin', 5000)
+        _write_random_file('unittest_tree/sub/b.bin', 100)
+        _write_random_file('unittest_tree/sub/deeper/c.bin', 0)
+        self.assertEqual([], CFShare.split_tree('unittest_tree', 'unittest_shares', 2, 3, jobs=2))
+        os.remove('unittest_shares/sub/b.bin2_3')
+        self.assertEqual([], CFShare.bind_tree('unittest_shares', 'unittest_restored', jobs=2))
+        for rel in ['a.bin', 'sub/b.bin', 'sub/deeper/c.bin']:
+            self.assertEqual(_get_sha256_file(join('unittest_tree', rel)),
+                             _get_sha256_file(join('unittest_restored', rel)))
+        # The encrypted file of a shares only tree can't be replaced by one of its shares
+        self.assertEqual([], CFShare.split_tree('unittest_tree', 'unittest_only', 2, 3, sharesonly=True))
+        os.remove('unittest_only/sub/b.bin')
+        self.assertEqual(['sub/b.bin'], CFShare.bind_tree('unittest_only', 'unittest_only_restored'))
+        self.assertFalse(isfile('unittest_only_restored/sub/b.bin'))
+        self.assertEqual(_get_sha256_file('unittest_tree/a.bin'), _get_sha256_file('unittest_only_restored/a.bin'))
+        # Any error is reported as a failed file
+        failed = CFShare.split_tree('unittest_tree', 'unittest_bad', 2, 3, jobs=2, segment_size='1024')
+        self.assertEqual(['a.bin', 'sub/b.bin', 'sub/deeper/c.bin'], sorted(failed))
+
+    def test_index_store(self):
+        os.makedirs('unittest_store/sub')
+        _write_random_file('unittest_input', 5000)
+        hash_original = _get_sha256_file('unittest_input')
+        CFShare.split_file('unittest_input', 'unittest_store/copy', 2, 3)
+        CFShare.split_file('unittest_input', 'unittest_store/sub/frag', 3, 3, segment_size=1024)
+        CFShare.split_file('unittest_input', 'unittest_store/disp', 2, 4, dispersed=True)
+        CFShare.split_file('unittest_input', 'unittest_store/sub/only', 2, 3, sharesonly=True)
+        os.remove('unittest_store/copy1_3')
+        with open('unittest_store/noise', 'wb') as fo:
+            fo.write(b'\x00' * 10)
+        self.assertEqual(4, CFShare.index_store('unittest_store', workers=2))
+        for name in ['copy2_3', 'sub/frag1_3', 'disp3_4', 'sub/only1_3.share']:
+            file_id = CFShare.share_id(join('unittest_store', name))
+            CFShare.reconstruct_from_store(file_id, 'unittest_store', 'unittest_rec')
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+        self.assertIsNone(CFShare.share_id('unittest_store/noise'))
+        # The encrypted file of a shares only split whose IV looks like the header of an output is not a share
+        CFShare.split_file('unittest_input', 'unittest_store/lookalike', 2, 3, sharesonly=True)
+        with open('unittest_store/copy2_3', 'rb') as fi, open('unittest_store/lookalike', 'r+b') as fo:
+            fo.write(fi.read(200))
+        self.assertIsNotNone(CFShare.share_id('unittest_store/copy2_3'))
+        self.assertIsNone(CFShare.share_id('unittest_store/lookalike'))
+        self.assertEqual(5, CFShare.index_store('unittest_store'))
+        CFShare.reconstruct_from_store(CFShare.share_id('unittest_store/copy2_3'), 'unittest_store', 'unittest_rec')
+        self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+        with self.assertRaises(SystemExit):
+            CFShare.reconstruct_from_store('00' * 48, 'unittest_store', 'unittest_rec')
+
+    def test_verify(self):
+        _write_random_file('unittest_input', 10000)
+        for segment_size, mode in [(None, CipherMode.AES), (1024, CipherMode.ChaCha20), (1024, CipherMode.AESGCM)]:
+            CFShare.split_file('unittest_input', 'unittest', 2, 3, mode=mode, segment_size=segment_size)
+            self.assertTrue(CFShare.verify(['unittest1_3', 'unittest2_3']))
+            with open('unittest2_3', 'r+b') as f:
+                f.seek(-5000, os.SEEK_END)
+                f.write(b'\x00\x00')
+            self.assertTrue(CFShare.verify(['unittest1_3', 'unittest3_3']))
+            self.assertFalse(CFShare.verify(['unittest2_3', 'unittest3_3']))
+            self.assertFalse(os.path.exists('unittest_rec'))
+        os.makedirs('unittest_store')
+        CFShare.split_file('unittest_input', 'unittest_store/a', 2, 2, segment_size=1024)
+        CFShare.split_file('unittest_input', 'unittest_store/b', 2, 3, dispersed=True)
+        with open('unittest_store/b1_3', 'r+b') as f:
+            f.seek(-100, os.SEEK_END)
+            f.write(b'\x00\x00')
+        CFShare.index_store('unittest_store')
+        results = dict(CFShare.verify_store('unittest_store'))
+        self.assertEqual({True, False}, set(results.values()))
+        self.assertTrue(results[CFShare.share_id('unittest_store/a1_2')])
+
+    def test_split_reconstruct_stream(self):
+        original = os.urandom(300001)
+        for options in [{}, {'segment_size': 4096}, {'dispersed': True}, {'mode': CipherMode.ChaCha20Poly1305}]:
+            writers = [io.BytesIO() for _ in range(3)]
+            chunks = (original[i:i + 1000] for i in range(0, len(original), 1000))
+            CFShare.split_stream(chunks, writers, 2, **options)
+            readers = [io.BytesIO(writers[2].getvalue()), io.BytesIO(writers[0].getvalue())]
+            self.assertEqual(original, b''.join(CFShare.reconstruct_stream(readers)))
+        writers = [io.BytesIO() for _ in range(3)]
+        CFShare.split_stream(io.BytesIO(original), writers, 3, length=len(original))
+        self.assertEqual(original, b''.join(CFShare.reconstruct_stream([io.BytesIO(w.getvalue()) for w in writers])))
+        with self.assertRaises(SystemExit):
+            CFShare.split_stream(io.BytesIO(original), [io.BytesIO() for _ in range(3)], 3)
+        data, share_writers = io.BytesIO(), [io.BytesIO() for _ in range(3)]
+        CFShare.split_stream(io.BytesIO(original), [data], 2, share_writers=share_writers)
+        tampered = bytearray(data.getvalue())
+        tampered[-10] ^= 1
+        with self.assertRaises(InvalidSignature):
+            b''.join(CFShare.reconstruct_stream([io.BytesIO(bytes(tampered))],
+                                                [io.BytesIO(w.getvalue()) for w in share_writers[1:]]))
+
+    def test_split_reconstruct_async(self):
+        original = os.urandom(300001)
+
+        async def chunks():
+            for i in range(0, len(original), 7000):
+                yield original[i:i + 7000]
+
+        async def run():
+            store = MemoryObjectStore(part_size=1 << 16)
+            for options in [{}, {'dispersed': True}, {'segment_size': 4096}]:
+                await split_to(store, 'unittest', chunks(), 2, 3, **options)
+                readers = [await store.open_read('unittest3_3'), await store.open_read('unittest1_3')]
+                self.assertEqual(original, b''.join([chunk async for chunk in CFShare.reconstruct_async(readers)]))
+            os.makedirs('unittest_dir')
+            await split_to(LocalDirSink('unittest_dir'), 'unittest', chunks(), 2, 3, sharesonly=True)
+
+            class FailingWriter:
+                async def write(self, data):
+                    raise OSError("Upload failed")
+
+            with self.assertRaises(OSError):
+                await CFShare.split_async(chunks(), [FailingWriter() for _ in range(3)], 2, depth=2)
+            # The errors printed by the worker thread are raised without stopping the event loop
+            with self.assertRaises(ValueError):
+                await CFShare.split_async(chunks(), [await store.open('unittest_bad')], 2,
+                                          share_writers=[await store.open('unittest_bad.share')], dispersed=True)
+            with self.assertRaises(ValueError):
+                [chunk async for chunk in CFShare.reconstruct_async([await store.open_read('unittest1_3')])]
+            readers = [await store.open_read('unittest1_3'), await store.open_read('unittest2_3')]
+            self.assertEqual(original, b''.join([chunk async for chunk in CFShare.reconstruct_async(readers)]))
+
+        asyncio.run(run())
+        CFShare.reconstruct_file(['unittest_dir/unittest'], 'unittest_rec',
+                                 fshares=['unittest_dir/unittest1_3.share', 'unittest_dir/unittest2_3.share'])
+        with open('unittest_rec', 'rb') as f:
+            self.assertEqual(original, f.read())
+
+    def test_observer(self):
+        original = os.urandom(300001)
+        with open('unittest_observer', 'wb') as fo:
+            fo.write(original)
+        for options, phase in [({}, 'fan_out_write'), ({'segment_size': 4096}, 'fan_out_write'),
+                               ({'dispersed': True}, 'disperse_write')]:
+            stats, updates = Stats(), []
+            observer = MultiObserver([stats, ProgressObserver(lambda done, total: updates.append((done, total)))])
+            CFShare.split_file('unittest_observer', 'unittest_observer_out', 2, 3, observer=observer, **options)
+            phases = stats.report()['phases']
+            for name in ['key_split', 'read', 'encrypt', 'mac', phase]:
+                self.assertIn(name, phases)
+            self.assertEqual(len(original), phases['read']['bytes'])
+            self.assertEqual((len(original), len(original)), updates[-1])
+            stats = Stats()
+            CFShare.reconstruct_file(['unittest_observer_out1_3', 'unittest_observer_out3_3'], 'unittest_observer_rec',
+                                     observer=stats)
+            phases = stats.report()['phases']
+            for name in ['key_combine', 'read', 'decrypt', 'mac', 'write']:
+                self.assertIn(name, phases)
+            self.assertEqual(len(original), phases['write']['bytes'])
+            self.assertIn('elapsed', stats.format())
+            with open('unittest_observer_rec', 'rb') as f:
+                self.assertEqual(original, f.read())
+
+    def test_key_group(self):
+        os.makedirs(join('unittest_group', 'sub'))
+        originals = {}
+        for i, rel in enumerate(['a', 'b', join('sub', 'c')]):
+            originals[rel] = os.urandom(1000 * i + 17)
+            with open(join('unittest_group', rel), 'wb') as fo:
+                fo.write(originals[rel])
+        keygroup.split_group_tree('unittest_group', 'unittest_group_out', 'grp', 2, 3)
+        cache = keygroup.KeyCache(2)
+        shares = [join('unittest_group_out', 'grp{}_3.keyshare'.format(i)) for i in (3, 1)]
+        keygroup.bind_group_tree('unittest_group_out', 'unittest_group_rec', shares, cache=cache)
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        for rel, original in originals.items():
+            with open(join('unittest_group_rec', rel), 'rb') as f:
+                self.assertEqual(original, f.read())
+        # A bad member is reported and the others are still decrypted
+        with open(join('unittest_group_out', 'a'), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            b = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([b[0] ^ 1]))
+        self.assertEqual(['a'], CFShare.bind_tree('unittest_group_out', 'unittest_group_rec2'))
+        self.assertFalse(isfile(join('unittest_group_rec2', 'a')))
+        with open(join('unittest_group_rec2', 'sub', 'c'), 'rb') as f:
+            self.assertEqual(originals[join('sub', 'c')], f.read())
+        # The cached key is enough to decrypt a member, without any share
+        keygroup.reconstruct_members([(join('unittest_group_out', 'b'), 'unittest_group_b')], cache=cache)
+        with open('unittest_group_b', 'rb') as f:
+            self.assertEqual(originals['b'], f.read())
+        keygroup.split_members([('unittest_group_b', 'unittest_group_m')], shares[:1], cache=cache,
+                               mode=CipherMode.AESGCM)
+        self.assertEqual(2, cache.hits)
+        with self.assertRaises(SystemExit):
+            keygroup.reconstruct_members([('unittest_group_m', 'unittest_group_r')], shares[:1],
+                                         cache=keygroup.KeyCache())
+        keygroup.reconstruct_members([('unittest_group_m', 'unittest_group_r')], shares, cache=keygroup.KeyCache())
+        with open('unittest_group_r', 'rb') as f:
+            self.assertEqual(originals['b'], f.read())
+        other = keygroup.KeyCache(1)
+        other.put(b'1', b'x')
+        other.put(b'2', b'y')
+        self.assertEqual((None, b'y'), (other.get(b'1'), other.get(b'2')))
+
+    def test_archive(self):
+        os.makedirs(join('unittest_archive', 'sub'))
+        originals = {}
+        for i, name in enumerate(['a', 'b', 'sub/c', 'sub/empty']):
+            originals[name] = os.urandom(70001 * i if name != 'sub/empty' else 0)
+            with open(join('unittest_archive', name), 'wb') as fo:
+                fo.write(originals[name])
+        for options in [{}, {'dispersed': True}, {'mode': CipherMode.AESGCM}]:
+            archive.pack_tree('unittest_archive', 'unittest_pack', 2, 3, **options)
+            filein = ['unittest_pack3_3', 'unittest_pack2_3']
+            members = CFShare.list_archive(filein)
+            self.assertEqual(sorted(originals), [member['name'] for member in members])
+            written = CFShare.extract(filein, ['sub/c'], 'unittest_extract')
+            self.assertEqual([join('unittest_extract', 'sub', 'c')], written)
+            CFShare.extract(filein, None, 'unittest_extract')
+            for name, original in originals.items():
+                with open(join('unittest_extract', name), 'rb') as f:
+                    self.assertEqual(original, f.read())
+            shutil.rmtree('unittest_extract')
+        with self.assertRaises(SystemExit):
+            CFShare.extract(['unittest_pack3_3', 'unittest_pack2_3'], ['missing'], 'unittest_extract')
+
+    def test_repair(self):
+        for options in [{}, {'dispersed': True, 'scheme': ShareScheme.GF256}, {'sharesonly': True},
+                        {'segment_size': 4096}]:
+            for refresh in (False, True):
+                CFShare.split_file('setup.py', 'unittest', 3, 5, **options)
+                suffix = '.share' if options.get('sharesonly') else ''
+                os.remove('unittest2_5' + suffix)
+                os.remove('unittest4_5' + suffix)
+                written = CFShare.repair('unittest', 5, refresh=refresh)
+                self.assertEqual(5 if refresh else 2, len(written))
+                for combination in [(2, 4, 5), (1, 3, 4)]:
+                    names = ['unittest{}_5'.format(i) + suffix for i in combination]
+                    if options.get('sharesonly'):
+                        CFShare.reconstruct_file(['unittest'], 'unittest_rec', fshares=names)
+                    else:
+                        CFShare.reconstruct_file(names, 'unittest_rec')
+                    self.assertEqual(_get_sha256_file('setup.py'), _get_sha256_file('unittest_rec'))
+                _cleanup()
+        CFShare.split_file('setup.py', 'unittest', 3, 3)
+        os.remove('unittest2_3')
+        with self.assertRaises(SystemExit):
+            CFShare.repair('unittest', 3)
+        _cleanup()
+        # Fewer shares than the threshold are refused before anything is written
+        CFShare.split_file('setup.py', 'unittest', 3, 5, scheme=ShareScheme.GF256)
+        for i in (1, 2, 3):
+            os.remove('unittest{}_5'.format(i))
+        hashes = [_get_sha256_file('unittest{}_5'.format(i)) for i in (4, 5)]
+        with self.assertRaises(SystemExit):
+            CFShare.repair('unittest', 5, refresh=True)
+        self.assertEqual(hashes, [_get_sha256_file('unittest{}_5'.format(i)) for i in (4, 5)])
+        self.assertFalse(any(os.path.exists('unittest{}_5'.format(i)) for i in (1, 2, 3)))
+        _cleanup()
+        # A stream container is authenticated by a full pass, a corrupt payload is refused before the refresh
+        CFShare.split_file('setup.py', 'unittest', 2, 3)
+        with open('unittest1_3', 'r+b') as f:
+            f.seek(-10, os.SEEK_END)
+            b = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([b[0] ^ 1]))
+        hashes = [_get_sha256_file('unittest{}_3'.format(i)) for i in (1, 2, 3)]
+        with self.assertRaises(SystemExit):
+            CFShare.repair('unittest', 3, refresh=True)
+        self.assertEqual(hashes, [_get_sha256_file('unittest{}_3'.format(i)) for i in (1, 2, 3)])
+        os.remove('unittest1_3')
+        self.assertEqual(3, len(CFShare.repair('unittest', 3, refresh=True)))
+        self.assertFalse(any(os.path.exists('unittest{}_3.repair'.format(i)) for i in (1, 2, 3)))
+        CFShare.reconstruct_file(['unittest1_3', 'unittest3_3'], 'unittest_rec')
+        self.assertEqual(_get_sha256_file('setup.py'), _get_sha256_file('unittest_rec'))
+
+    def test_lagrange_cache_threads(self):
+        secret = os.urandom(32)
+        shares = Shamir().create(3, 8, secret)
+        shamir = Shamir()
+        util = ShamirUtils()
+        util.lagrange_cache_size = 2
+        shamir.util = util
+        subsets = [[shares[i], shares[(i + 1) % 8], shares[(i + 3) % 8]] for i in range(8)]
+        errors = []
+
+        def combine():
+            try:
+                for _ in range(50):
+                    for subset in subsets:
+                        if shamir.combine(subset) != secret:
+                            errors.append(subset)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=combine) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertLessEqual(len(util.lagrange_cache), 2)
+
+    def test_shamir_issue(self):
+        secret = os.urandom(32)
+        shares = Shamir().create(3, 5, secret)
+        issued = Shamir().issue(shares[1:4])
+        self.assertEqual(secret, Shamir().combine([shares[0], issued, shares[4]]))
+        shares = ShamirGF256().create(3, 5, secret)
+        self.assertEqual(shares[1], ShamirGF256().issue(shares[2:], 2))
+
+    def test_resume(self):
+        with open('unittest_plain', 'wb') as fo:
+            fo.write(os.urandom(50000))
+        hash_original = _get_sha256_file('unittest_plain')
+        for options in [{}, {'mode': CipherMode.AESGCM}, {'sharesonly': True}, {'total_shares': 3}]:
+            total_shares = options.pop('total_shares', 5)
+            with self.assertRaises(_Interrupted):
+                CFShare.split_resumable('unittest_plain', 'unittest', 3, total_shares, segment_size=1024, workers=1,
+                                        checkpoint=4, observer=_InterruptingObserver(18), **options)
+            self.assertTrue(os.path.exists('unittest.cfshare_journal'))
+            self.assertFalse(os.path.exists('unittest1_{}'.format(total_shares)))
+            CFShare.split_resumable('unittest_plain', 'unittest', 3, total_shares, segment_size=1024, workers=1,
+                                    checkpoint=4, **options)
+            self.assertFalse(os.path.exists('unittest.cfshare_journal'))
+            if options.get('sharesonly'):
+                filein, fshares = ['unittest'], ['unittest1_5.share', 'unittest2_5.share', 'unittest4_5.share']
+            else:
+                filein, fshares = ['unittest{}_{}'.format(i + 1, total_shares) for i in range(3)], []
+            with self.assertRaises(_Interrupted):
+                CFShare.reconstruct_resumable(filein, 'unittest_rec', fshares, workers=1, checkpoint=4,
+                                              observer=_InterruptingObserver(30))
+            self.assertTrue(os.path.exists('unittest_rec.partial'))
+            CFShare.reconstruct_resumable(filein, 'unittest_rec', fshares, checkpoint=4)
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+            self.assertFalse(os.path.exists('unittest_rec.partial'))
+            CFShare.reconstruct_file(filein, 'unittest_rec', fshares=fshares)
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+            for name in os.listdir('.'):
+                if name.startswith('unittest') and name != 'unittest_plain':
+                    os.remove(name)
+        with open('unittest_plain', 'ab') as fo:
+            fo.write(b'changed')
+        with self.assertRaises(_Interrupted):
+            CFShare.split_resumable('unittest_plain', 'unittest', 2, 3, segment_size=1024, workers=1, checkpoint=4,
+                                    observer=_InterruptingObserver(5))
+        with open('unittest_plain', 'ab') as fo:
+            fo.write(b'again')
+        with self.assertRaises(SystemExit):
+            CFShare.split_resumable('unittest_plain', 'unittest', 2, 3, segment_size=1024)
+
+    def test_server(self):
+        server = Server(os.path.abspath('unittest.sock'), jobs=2, workers=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(0, stat.S_IMODE(os.stat(server.path).st_mode) & 0o077)
+            with Client(server.path) as client:
+                reply = client.submit({'op': 'split', 'filein': os.path.abspath('setup.py'),
+                                       'fileout': os.path.abspath('unittest'), 'min_shares': 2, 'total_shares': 3,
+                                       'options': {'mode': 'AESGCM'}})
+                self.assertTrue(reply['ok'])
+                self.assertGreaterEqual(reply['queued'], 0)
+                names = [os.path.abspath('unittest{}_3'.format(i)) for i in (1, 3)]
+                self.assertTrue(client.submit({'op': 'verify', 'filein': names})['result'])
+                client.submit({'op': 'bind', 'filein': names, 'fileout': os.path.abspath('unittest_rec')})
+                self.assertEqual(_get_sha256_file('setup.py'), _get_sha256_file('unittest_rec'))
+                with open('setup.py', 'rb') as fi:
+                    original = fi.read()
+                reply = client.submit({'op': 'split', 'fileout': os.path.abspath('unittest_streamed'),
+                                       'min_shares': 2, 'total_shares': 2, 'options': {'segment_size': 256}},
+                                      data=original)
+                self.assertTrue(reply['ok'])
+                sink = io.BytesIO()
+                names = [os.path.abspath('unittest_streamed{}_2'.format(i)) for i in (1, 2)]
+                self.assertTrue(client.submit({'op': 'bind', 'filein': names}, sink=sink)['ok'])
+                self.assertEqual(original, sink.getvalue())
+                reply = client.submit({'op': 'split', 'fileout': os.path.abspath('unittest_bad'), 'min_shares': 2,
+                                       'total_shares': 3, 'options': {'mode': 'DES'}}, data=original)
+                self.assertFalse(reply['ok'])
+                self.assertFalse(client.submit({'op': 'verify', 'filein': names[:1]})['ok'])
+                reply = client.submit({'op': 'verify', 'filein': ['unittest_streamed1_2', names[1]]})
+                self.assertEqual('Paths must be absolute', reply['error'])
+                stats = client.submit({'op': 'stats'})['result']
+                self.assertEqual(5, stats['completed'])
+                self.assertEqual(2, stats['failed'])
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertFalse(os.path.exists('unittest.sock'))
+
+    def test_incremental(self):
+        original = os.urandom(1 << 20)
+        with open('unittest_v1', 'wb') as fo:
+            fo.write(original)
+        with open('unittest_v2', 'wb') as fo:
+            fo.write(original[:300000] + b'inserted' + original[300000:700000] + original[700100:])
+        # Small chunks, so that the two edits change well under half of the bytes whatever the content
+        sizes = {'min_size': 4096, 'avg_size': 16384, 'max_size': 65536}
+        first = CFShare.split_incremental('unittest_v1', 'unittest_store', 'unittest_m1', 2, 3, **sizes)
+        self.assertEqual(first['chunks'], first['new_chunks'])
+        second = CFShare.split_incremental('unittest_v2', 'unittest_store', 'unittest_m2', 2, 3, sharesonly=True,
+                                           **sizes)
+        self.assertLess(second['new_bytes'], second['bytes'] // 2)
+        CFShare.reconstruct_incremental(['unittest_m11_3', 'unittest_m13_3'], 'unittest_store', 'unittest_rec')
+        self.assertEqual(_get_sha256_file('unittest_v1'), _get_sha256_file('unittest_rec'))
+        # A chunk still being written by a split is not pruned
+        with open(join('unittest_store', 'unittest.tmp'), 'wb') as fo:
+            fo.write(b'partial')
+        self.assertEqual(second['new_chunks'], dedup.prune_store('unittest_store', ['unittest_m1.chunks']))
+        self.assertTrue(isfile(join('unittest_store', 'unittest.tmp')))
+        os.remove('unittest_rec')
+        with self.assertRaises(SystemExit):
+            CFShare.reconstruct_incremental(['unittest_m2'], 'unittest_store', 'unittest_rec',
+                                            ['unittest_m21_3.share', 'unittest_m22_3.share'])
+        self.assertFalse(isfile('unittest_rec'))
+        chunks = list(dedup.content_chunks(io.BytesIO(original)))
+        self.assertEqual(original, b''.join(chunks))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), dedup.DEFAULT_MAX_CHUNK)
+        if dedup._fastcdc is not None:
+            # The pure Python fallback cuts the same chunks as the native chunker
+            native, dedup._fastcdc = dedup._fastcdc, None
+            try:
+                self.assertEqual(chunks, list(dedup.content_chunks(io.BytesIO(original))))
+            finally:
+                dedup._fastcdc = native
+
+    def test_bind_stdout(self):
+        _write_random_file('unittest_input', 1 << 20)
+        CFShare.split_file('unittest_input', 'unittest', 3, 4)
+        command = [sys.executable, '-c', 'from cfshare.main import main; main()', 'bind', '-o', '-', '-i']
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        # Errors never go to stdout, which holds the plaintext
+        result = subprocess.run(command + ['unittest1_4', 'unittest2_4'], capture_output=True, cwd=cwd)
+        self.assertEqual(1, result.returncode)
+        self.assertEqual(b'', result.stdout)
+        self.assertIn(b'The shares were incorrect', result.stderr)
+        # A reader closing the pipe early ends the bind without a traceback
+        process = subprocess.Popen(command + ['unittest1_4', 'unittest2_4', 'unittest4_4'], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=cwd)
+        self.assertEqual(10, len(process.stdout.read(10)))
+        process.stdout.close()
+        self.assertEqual(b'', process.stderr.read())
+        process.stderr.close()
+        self.assertEqual(1, process.wait())
+
+    def test_cli_segment_size(self):
+        CFShare.split_file('setup.py', 'unittest', 2, 3)
+        hash_share = _get_sha256_file('unittest1_3')
+        command = [sys.executable, '-c', 'from cfshare.main import main; main()', 'split', '-i', 'setup.py', '-o',
+                   'unittest', '-m', '2', '-t', '3', '-ss', '1000']
+        result = subprocess.run(command, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(1, result.returncode)
+        self.assertIn('power of two', result.stdout)
+        self.assertNotIn('Traceback', result.stderr)
+        self.assertEqual(hash_share, _get_sha256_file('unittest1_3'))
+
+    def test_lazy_import(self):
+        # Importing the package and reporting usage errors don't load the ciphers or the secret sharing schemes
+        code = '\n'.join(["import sys",
+                          "import cfshare",
+                          "print(' '.join(sys.modules))",
+                          "sys.argv = ['cfshare', 'split']",
+                          "try:",
+                          "    cfshare.main()",
+                          "except SystemExit:",
+                          "    print(' '.join(sys.modules))"])
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(0, result.returncode, result.stderr)
+        heavy = ('cryptography', 'secret_sharing', 'cfshare.cfshare', 'cfshare.segments', 'cfshare.streams')
+        loaded = result.stdout.split()
+        self.assertIn('cfshare.main', loaded)
+        for name in loaded:
+            self.assertFalse(name.startswith(heavy), name)
+        namespace = {}
+        exec('from cfshare import *', namespace)
+        self.assertIs(CFShare, namespace['CFShare'])
+        self.assertIs(CipherMode, namespace['CipherMode'])
+
+    def test_compression(self):
+        original = b''.join(hashlib.sha256(str(i).encode()).hexdigest().encode() for i in range(5000))
+        with open('unittest_plain', 'wb') as fo:
+            fo.write(original)
+        for options in [{}, {'dispersed': True}, {'segment_size': 4096}, {'mode': CipherMode.AESGCM},
+                        {'sharesonly': True}]:
+            for codec in [Codec.ZLIB, Codec.LZMA]:
+                CFShare.split_file('unittest_plain', 'unittest', 2, 3, compression=codec, **options)
+                if options.get('sharesonly'):
+                    filein, fshares = ['unittest'], ['unittest1_3.share', 'unittest3_3.share']
+                else:
+                    filein, fshares = ['unittest1_3', 'unittest3_3'], []
+                    self.assertLess(os.path.getsize('unittest1_3'), len(original))
+                CFShare.reconstruct_file(filein, 'unittest_rec', fshares=fshares)
+                with open('unittest_rec', 'rb') as f:
+                    self.assertEqual(original, f.read())
+                readers = [open(name, 'rb') for name in filein]
+                shares = [open(name, 'rb') for name in fshares]
+                self.assertEqual(original, b''.join(CFShare.reconstruct_stream(readers, shares or None, workers=2)))
+                for f in readers + shares:
+                    f.close()
+                self.assertTrue(CFShare.verify(filein, fshares))
+        # Invalid options are refused before the outputs of the previous split are truncated
+        CFShare.split_file('unittest_plain', 'unittest', 3, 3)
+        hashes = [_get_sha256_file('unittest{}_3'.format(i)) for i in (1, 2, 3)]
+        for options in [{'compression': Codec.ZLIB}, {'segment_size': 1000}]:
+            with self.assertRaises((SystemExit, ValueError)):
+                CFShare.split_file('unittest_plain', 'unittest', 3, 3, **options)
+            self.assertEqual(hashes, [_get_sha256_file('unittest{}_3'.format(i)) for i in (1, 2, 3)])
+        # A corrupt frame length is refused at once instead of buffering the rest of the payload
+        frames = compression.compress_reader(io.BytesIO(original), Codec.ZLIB, block_size=4096).read(len(original))
+        chunks = iter([int.to_bytes(1 << 30, compression.FRAME_LEN_LEN, 'little') + frames, frames, frames])
+        with self.assertRaises(InvalidSignature):
+            list(compression.decompress_chunks(chunks, Codec.ZLIB, block_size=4096))
+        self.assertEqual(2, len(list(chunks)))
+        chunks = iter([frames[:100], frames[100:]])
+        self.assertEqual(original, b''.join(compression.decompress_chunks(chunks, Codec.ZLIB, block_size=4096)))
+
+    def test_bench(self):
+        results = bench.run(sizes=[4096], modes=[CipherMode.AES, CipherMode.AESGCM], chunks=[1 << 16],
+                            layouts=['sharesonly', 'fragment'], shares=[(2, 3)], shamir=[(2, 3, 32)], repeat=1,
+                            workdir='.')
+        benches = [(result['bench'], result.get('mode'), result.get('layout')) for result in results['results']]
+        for case in [('split', 'AESGCM', 'copy'), ('bind', 'AES', 'fragment'), ('bind', 'AES', 'sharesonly')]:
+            self.assertIn(case, benches)
+        self.assertEqual(6, len([item for item in benches if item[0].startswith('shamir')]))
+        self.assertIn(('shamir_combine_cold', None, None), benches)
+        self.assertEqual([], [name for name in os.listdir('.') if name.startswith('cfshare_bench')])
+        slower = {'results': [dict(result, seconds=result['seconds'] * 2 + 1) for result in results['results']]}
+        self.assertEqual([], bench.compare(results, results))
+        self.assertEqual(len(results['results']), len(bench.compare(results, slower)))
+        self.assertEqual(3 << 30, bench.parse_size('3G'))
+
+    def test_shamir_combine_large_threshold(self):
+        secret = os.urandom(96)
+        shares = Shamir().create(12, 15, secret)
+        self.assertEqual(secret, Shamir().combine(shares[3:]))
+        self.assertEqual(secret, Shamir().combine(shares[:12]))
+        util = ShamirUtils()
+        numbers = [util.random() for _ in range(10)]
+        self.assertEqual([util.mod_inverse(n) for n in numbers], util.batch_inverse(numbers))
+
+    def test_split_many(self):
+        _write_random_file('unittest_input', 5000)
+        hash_original = _get_sha256_file('unittest_input')
+        for scheme in ShareScheme:
+            files = [('unittest_input', 'unittest_a'), ('setup.py', 'unittest_b')]
+            all_shares = CFShare.split_many(files, 2, 3, scheme=scheme)
+            self.assertEqual(2, len(all_shares))
+            CFShare.reconstruct_file(['unittest_a1_3', 'unittest_a3_3'], 'unittest_rec')
+            self.assertEqual(hash_original, _get_sha256_file('unittest_rec'))
+            CFShare.reconstruct_file(['unittest_b2_3', 'unittest_b3_3'], 'unittest_rec')
+            self.assertEqual(_get_sha256_file('setup.py'), _get_sha256_file('unittest_rec'))
+
+    def test_shamir_create_many(self):
+        secrets = [os.urandom(33) for _ in range(20)]
+        for secret, shares in zip(secrets, Shamir().create_many(3, 6, secrets)):
+            self.assertEqual(secret, Shamir().combine([shares[5], shares[1], shares[2]]))
+
+    def test_shamir_gf256(self):
+        secret = os.urandom(1000)
+        shares = ShamirGF256().create(4, 7, secret)
+        self.assertEqual(1001, len(shares[0]))
+        self.assertEqual(secret, ShamirGF256().combine([shares[6], shares[0], shares[3], shares[2]]))
+        self.assertNotEqual(secret, ShamirGF256().combine(shares[:3]))
+
+    def test_pipeline(self):
+        data = os.urandom(100000)
+        source = io.BytesIO(data)
+        out = io.BytesIO()
+
+        def transform(view, buffer):
+            buffer[:len(view)] = bytes(view)[::-1]
+            return len(view)
+
+        Pipeline(chunk_size=1000, depth=3).run(source.readinto, transform, out.write)
+        self.assertEqual(b''.join(data[i:i + 1000][::-1] for i in range(0, len(data), 1000)), out.getvalue())
+
+        def failing_write(view):
+            raise OSError("disk full")
+
+        with self.assertRaises(OSError):
+            Pipeline(chunk_size=1000).run(io.BytesIO(data).readinto, transform, failing_write)
+
+    def test_seek_iv_matches_stream(self):
+        key = os.urandom(32)
+        data = os.urandom(4096)
+        for mode in [CipherMode.AES, CipherMode.ChaCha20]:
+            iv = os.urandom(16)
+            stream = CFShare._get_cipher_from_mode(mode, key, iv).encryptor().update(data)
+            seeked = CFShare._get_cipher_from_mode(mode, key, seek_iv(mode, iv, 1024)).encryptor().update(data[1024:])
+            self.assertEqual(stream[1024:], seeked)
+
+    def test_open_reconstructed(self):
+        _write_random_file('unittest_input', 10000)
+        with open('unittest_input', 'rb') as f:
+            original = f.read()
+        for segment_size in [None, 1024]:
+            CFShare.split_file('unittest_input', 'unittest', 3, 3, segment_size=segment_size)
+            with CFShare.open_reconstructed(['unittest1_3', 'unittest2_3', 'unittest3_3']) as f:
+                f.seek(5000)
+                self.assertEqual(original[5000:5100], f.read(100))
+                f.seek(-10, os.SEEK_END)
+                self.assertEqual(original[-10:], f.read())
+                f.seek(1000)
+                self.assertEqual(original[1000:], f.read())
+
+    def test_open_reconstructed_tampered(self):
+        _write_random_file('unittest_input', 10000)
+        CFShare.split_file('unittest_input', 'unittest', 2, 3, segment_size=1024)
+        with open('unittest1_3', 'r+b') as f:
+            f.seek(-2000, os.SEEK_END)
+            f.write(b'\x00' * 8)
+        with CFShare.open_reconstructed(['unittest1_3', 'unittest2_3']) as f:
+            self.assertEqual(100, len(f.read(100)))
+            f.seek(7500)
+            with self.assertRaises(InvalidSignature):
+                f.read(100)
+
+    def tearDown(self):
+        _cleanup()
+
+
+def _write_random_file(file, size):
+    with open(file, 'wb') as f:
+        f.write(os.urandom(size))
+
+
 def _get_sha256_file(file):
     with open(file, "rb") as f:
         bytes = f.read()  # read entire file as bytes
@@ -78,11 +817,31 @@ def _get_sha256_file(file):
         return readable_hash
 
 
+class _Interrupted(Exception):
+    pass
+
+
+class _InterruptingObserver(Observer):
+    # Interrupts split or bind after ``limit`` segments
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+
+    def span(self, phase, seconds, nbytes=0):
+        if phase in ('encrypt', 'decrypt'):
+            self.count += 1
+            if self.count > self.limit:
+                raise _Interrupted()
+
+
 def _cleanup():
     pdir = os.path.dirname(os.path.abspath(__file__))
     files = [f for f in os.listdir(pdir) if isfile(join(pdir, f)) and f.startswith('unittest')]
     for f in files:
         os.remove(f)
+    for d in [f for f in os.listdir(pdir) if isdir(join(pdir, f)) and f.startswith('unittest')]:
+        shutil.rmtree(d)
 
 
 if __name__ == '__main__':
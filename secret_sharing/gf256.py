@@ -0,0 +1,78 @@
+"""Arithmetic over GF(2^8) with the AES reduction polynomial x^8 + x^4 + x^3 + x + 1.
+
+Multiplying a whole byte string by a constant goes through ``bytes.translate`` and sums are computed as XOR of big
+integers, so linear combinations of long rows run at C speed without any third party dependency.
+"""
+
+EXP = [0] * 512
+LOG = [0] * 256
+
+_value = 1
+for _power in range(255):
+    EXP[_power] = _value
+    LOG[_value] = _power
+    _value ^= (_value << 1) ^ (0x11b if _value & 0x80 else 0)
+for _power in range(255, 512):
+    EXP[_power] = EXP[_power - 255]
+
+
+def mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+def power(a, n):
+    if n == 0:
+        return 1
+    if a == 0:
+        return 0
+    return EXP[(LOG[a] * n) % 255]
+
+
+MUL_TABLES = [bytes(mul(c, x) for x in range(256)) for c in range(256)]
+
+
+def scale(c, data):
+    """Multiply every byte of ``data`` by ``c``."""
+    return data.translate(MUL_TABLES[c])
+
+
+def linear_combination(coefficients, rows):
+    """Return the sum of ``coefficients[i] * rows[i]``, all the rows must have the same length."""
+    length = len(rows[0])
+    acc = 0
+    for c, row in zip(coefficients, rows):
+        if c == 1:
+            acc ^= int.from_bytes(row, 'little')
+        elif c:
+            acc ^= int.from_bytes(row.translate(MUL_TABLES[c]), 'little')
+    return acc.to_bytes(length, 'little')
+
+
+def vandermonde(xs, columns):
+    return [[power(x, j) for j in range(columns)] for x in xs]
+
+
+def invert_matrix(matrix):
+    """Invert a square matrix by Gauss-Jordan elimination, raising ``ValueError`` if it is singular."""
+    n = len(matrix)
+    work = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if work[r][col]), None)
+        if pivot is None:
+            raise ValueError("The matrix is singular")
+        work[col], work[pivot] = work[pivot], work[col]
+        factor = inv(work[col][col])
+        work[col] = [mul(factor, v) for v in work[col]]
+        for r in range(n):
+            if r != col and work[r][col]:
+                f = work[r][col]
+                work[r] = [v ^ mul(f, p) for v, p in zip(work[r], work[col])]
+    return [row[n:] for row in work]
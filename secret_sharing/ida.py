@@ -0,0 +1,29 @@
+from secret_sharing import gf256
+
+
+class IDA:
+    """Rabin's information dispersal over GF(256).
+
+    ``minimum`` rows of equal length are turned into up to 255 pieces of the same length, any ``minimum`` of which
+    rebuild the rows. Piece ``i`` is the evaluation at ``x = i + 1`` of the polynomial whose coefficients are the rows.
+    """
+
+    def __init__(self, minimum):
+        if not 0 < minimum < 256:
+            raise ValueError("The minimum number of pieces must be between 1 and 255")
+        self.minimum = minimum
+
+    def encode(self, rows, indexes):
+        matrix = gf256.vandermonde([index + 1 for index in indexes], self.minimum)
+        return [gf256.linear_combination(coefficients, rows) for coefficients in matrix]
+
+    def decoder(self, indexes):
+        """Return the matrix rebuilding the rows from the pieces with the given indexes."""
+        if len(indexes) != self.minimum:
+            raise ValueError("Exactly {} pieces are required".format(self.minimum))
+        return gf256.invert_matrix(gf256.vandermonde([index + 1 for index in indexes], self.minimum))
+
+    def decode(self, pieces, indexes, decoder=None):
+        if decoder is None:
+            decoder = self.decoder(indexes)
+        return [gf256.linear_combination(coefficients, pieces) for coefficients in decoder]
@@ -16,7 +16,7 @@ class Shamir:
             raise ValueError("Raw must a bytes-like object is required, not 'str'")
 
         secret = self.util.split_ints(raw)
-        numbers = [0]
+        numbers = {0}
         polynomial = []
         for i in range(0, len(secret)):
             polynomial.append([secret[i]])
@@ -24,7 +24,7 @@ class Shamir:
                 value = self.util.random()
                 while value in numbers:
                     value = self.util.random()
-                numbers.append(value)
+                numbers.add(value)
 
                 polynomial[i].append(value)
 
@@ -35,7 +35,7 @@ class Shamir:
                 value = self.util.random()
                 while value in numbers:
                     value = self.util.random()
-                numbers.append(value)
+                numbers.add(value)
 
                 y = self.util.evaluate_polynomial(polynomial[j], value)
 
@@ -44,7 +44,77 @@ class Shamir:
 
         return result
 
+    def create_many(self, minimum, shares, secrets):
+        """Split every secret of ``secrets``, returning one list of shares (as returned by ``create``) per secret.
+
+        Randomness is drawn in bulk and the x-coordinate of share ``i`` is the same for every part of every secret of
+        the batch, so combining any of them reuses a single Lagrange basis.
+        """
+        if shares < minimum:
+            return
+        raws = []
+        for raw in secrets:
+            if not isinstance(raw, (bytes, bytearray)):
+                raise ValueError("Raw must a bytes-like object is required, not 'str'")
+            raws.append(self.util.split_ints(binascii.hexlify(raw)))
+
+        xs = []
+        used = {0}
+        while len(xs) < shares:
+            for value in self.util.random_many(shares - len(xs)):
+                if value not in used:
+                    used.add(value)
+                    xs.append(value)
+        powers = [[pow(x, j, self.util.prime) for j in range(minimum)] for x in xs]
+        encoded_xs = [self.util.to_base64(x) for x in xs]
+
+        coefficients = iter(self.util.random_many((minimum - 1) * sum(len(parts) for parts in raws)))
+        results = []
+        for parts in raws:
+            result = [[] for _ in range(shares)]
+            for part in parts:
+                polynomial = [part] + [next(coefficients) for _ in range(1, minimum)]
+                for i in range(shares):
+                    y = sum(c * p for c, p in zip(polynomial, powers[i])) % self.util.prime
+                    result[i].append(encoded_xs[i])
+                    result[i].append(self.util.to_base64(y))
+            results.append([''.join(item) for item in result])
+        return results
+
     def combine(self, shares):
+        parts = self._parts(shares)
+        if parts is None:
+            return
+
+        # The Lagrange basis only depends on the x-coordinates of each part, compute it once per set of them
+        coefficients = self.util.lagrange_at_zero([[point[0] for point in part] for part in parts])
+        secret = [sum(point[1] * coefficient for point, coefficient in zip(part, part_coefficients)) % self.util.prime
+                  for part, part_coefficients in zip(parts, coefficients)]
+
+        return binascii.unhexlify(self.util.merge_ints(secret))
+
+    def issue(self, shares):
+        """Return a new share on the polynomials of ``shares``, which must hold at least the minimum number of shares.
+
+        Every part of the new share gets a fresh random x-coordinate, so the existing shares stay valid.
+        """
+        parts = self._parts(shares)
+        if parts is None:
+            return
+        result = ""
+        for part in parts:
+            xs = [point[0] for point in part]
+            x = self.util.random()
+            while x in xs or x == 0:
+                x = self.util.random()
+            coefficients = self.util.lagrange_at(xs, x)
+            y = sum(point[1] * coefficient for point, coefficient in zip(part, coefficients)) % self.util.prime
+            result += self.util.to_base64(x)
+            result += self.util.to_base64(y)
+        return result
+
+    def _parts(self, shares):
+        # parts[j] holds the (x, y) point of every share for part j of the secret
         secrets = []
 
         for index, share in enumerate(shares):
@@ -58,21 +128,4 @@ class Shamir:
                 cshare = share[i * 88:(i + 1) * 88]
                 secrets[index].append([self.util.from_base64(cshare[0:44]), self.util.from_base64(cshare[44:88])])
 
-        secret = [0] * len(secrets[0])
-
-        for part_index, part in enumerate(secret):
-            for share_index, share in enumerate(secrets):
-                origin = share[part_index][0]
-                originy = share[part_index][1]
-                numerator = 1
-                denominator = 1
-                for product_index, product in enumerate(secrets):
-                    if product_index != share_index:
-                        current = product[part_index][0]
-                        numerator = (numerator * (-1 * current)) % self.util.prime
-                        denominator = (denominator * (origin - current)) % self.util.prime
-
-                working = ((originy * numerator * self.util.mod_inverse(denominator)) + self.util.prime)
-                secret[part_index] = (secret[part_index] + working) % self.util.prime
-
-        return binascii.unhexlify(self.util.merge_ints(secret))
+        return [[share[part_index] for share in secrets] for part_index in range(len(secrets[0]))]
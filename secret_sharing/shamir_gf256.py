@@ -0,0 +1,74 @@
+import os
+
+from secret_sharing import gf256
+
+
+class ShamirGF256:
+    """Shamir secret sharing over GF(256), one polynomial per byte of the secret.
+
+    A share is the raw byte string ``x || y`` where ``x`` is a non-zero byte and ``y`` has the length of the secret,
+    so any secret length is supported and at most 255 shares can be created.
+    """
+
+    def create(self, minimum, shares, raw):
+        if shares < minimum:
+            return
+        if not isinstance(raw, (bytes, bytearray)):
+            raise ValueError("Raw must a bytes-like object is required, not 'str'")
+        if not 0 < shares < 256:
+            raise ValueError("At most 255 shares can be created over GF(256)")
+        raw = bytes(raw)
+        # Row j holds the coefficient of x^j of every byte polynomial, the constant term being the secret itself
+        random = os.urandom((minimum - 1) * len(raw))
+        rows = [raw] + [random[j * len(raw):(j + 1) * len(raw)] for j in range(minimum - 1)]
+        result = []
+        for x in range(1, shares + 1):
+            y = gf256.linear_combination([gf256.power(x, j) for j in range(minimum)], rows)
+            result.append(bytes([x]) + y)
+        return result
+
+    def create_many(self, minimum, shares, secrets):
+        """Split every secret of ``secrets`` with a single evaluation over their concatenation."""
+        secrets = [bytes(raw) for raw in secrets]
+        created = self.create(minimum, shares, b''.join(secrets))
+        if created is None:
+            return
+        results = []
+        offset = 1
+        for raw in secrets:
+            results.append([share[:1] + share[offset:offset + len(raw)] for share in created])
+            offset += len(raw)
+        return results
+
+    def combine(self, shares):
+        xs = [share[0] for share in shares]
+        if len(set(xs)) != len(xs) or 0 in xs or len(set(len(share) for share in shares)) != 1:
+            raise ValueError("The shares are malformed")
+        return gf256.linear_combination(lagrange_at_zero(xs), [bytes(share[1:]) for share in shares])
+
+    def issue(self, shares, x):
+        """Return the share at ``x`` of the polynomials of ``shares``, which must hold at least the minimum number of
+        shares."""
+        xs = [share[0] for share in shares]
+        if len(set(xs)) != len(xs) or 0 in xs or x in xs or not 0 < x < 256:
+            raise ValueError("The shares are malformed")
+        return bytes([x]) + gf256.linear_combination(lagrange_at(xs, x), [bytes(share[1:]) for share in shares])
+
+
+def lagrange_at_zero(xs):
+    """Return the Lagrange basis coefficients evaluated at ``x = 0`` for the given points."""
+    return lagrange_at(xs, 0)
+
+
+def lagrange_at(xs, value):
+    """Return the Lagrange basis coefficients evaluated at ``x = value`` for the given points."""
+    coefficients = []
+    for i, xi in enumerate(xs):
+        numerator = 1
+        denominator = 1
+        for j, xj in enumerate(xs):
+            if i != j:
+                numerator = gf256.mul(numerator, value ^ xj)
+                denominator = gf256.mul(denominator, xi ^ xj)
+        coefficients.append(gf256.mul(numerator, gf256.inv(denominator)))
+    return coefficients
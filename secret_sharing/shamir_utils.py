@@ -1,7 +1,8 @@
 import base64
 import codecs
-import math
+import os
 import secrets
+import threading
 
 class ShamirUtils:
     prime = 0
@@ -9,10 +10,26 @@ class ShamirUtils:
     def __init__(self, prime=115792089237316195423570985008687907853269984665640564039457584007913129639747):
         self.prime = prime
         self.system_rnd = secrets.SystemRandom()
+        self.lagrange_cache = {}
+        self.lagrange_cache_size = 4096
+        # The cache is shared by every thread combining shares
+        self.lagrange_lock = threading.Lock()
 
     def random(self):
         return self.system_rnd.randrange(self.prime)
 
+    def random_many(self, count):
+        """Return ``count`` uniform numbers modulo the prime, drawn from a single ``os.urandom`` buffer."""
+        size = (self.prime.bit_length() + 7) // 8
+        result = []
+        while len(result) < count:
+            buffer = os.urandom(size * (count - len(result)))
+            for i in range(0, len(buffer), size):
+                value = int.from_bytes(buffer[i:i + size], 'big')
+                if value < self.prime:
+                    result.append(value)
+        return result
+
     def split_ints(self, secret):
         result = []
 
@@ -45,55 +62,79 @@ class ShamirUtils:
         return result
 
     def to_base64(self, number):
-        tmp = hex(number)[2:].replace("L", "")
-        tmp = "0" * (64 - len(tmp)) + tmp
-
-        try:
-            tmp = bytes(tmp, "utf8")
-        except:
-            tmp = bytes(tmp)
-
-        result = str(
-            base64.urlsafe_b64encode(b'\00' * (64 - len(tmp)) + codecs.decode(tmp, 'hex_codec')).decode('utf8'))
-
-        if len(result) != 44:
-            print("error: result, tmp, number")
-            print(result)
-            print(len(result))
-            print(tmp)
-            print(len(tmp))
-            print(number)
-            print(hex(number))
-            print(hex(codecs.decode(tmp, 'hex_codec')))
-        return result
+        return base64.urlsafe_b64encode(number.to_bytes(32, 'big')).decode('utf8')
 
     def from_base64(self, number):
-        byte_number = number
-        try:
-            byte_number = bytes(byte_number, "utf8")
-        except:
-            byte_number = bytes(byte_number)
-
-        tmp = base64.urlsafe_b64decode(byte_number)
-
-        try:
-            tmp = bytes(tmp, "utf8")
-        except:
-            tmp = bytes(tmp)
-
-        return int(codecs.encode(tmp, 'hex_codec'), 16)
-
-    def gcd(self, a, b):
-        if b == 0:
-            return [a, 1, 0]
-        else:
-            n = int(math.floor(a * 1.0 / b))
-            c = a % b
-            r = self.gcd(b, c)
-            return [r[0], r[2], r[1] - r[2] * n]
+        if isinstance(number, str):
+            number = number.encode('utf8')
+        return int.from_bytes(base64.urlsafe_b64decode(number), 'big')
 
     def mod_inverse(self, number):
-        remainder = (self.gcd(self.prime, number % self.prime))[2]
-        if number < 0:
-            remainder *= -1
-        return (self.prime + remainder) % self.prime
+        return pow(number % self.prime, -1, self.prime)
+
+    def batch_inverse(self, numbers):
+        """Invert all the numbers with a single modular inversion (Montgomery's trick)."""
+        prefix = [1] * (len(numbers) + 1)
+        for i, number in enumerate(numbers):
+            prefix[i + 1] = (prefix[i] * number) % self.prime
+        inverse = self.mod_inverse(prefix[-1])
+        result = [0] * len(numbers)
+        for i in range(len(numbers) - 1, -1, -1):
+            result[i] = (inverse * prefix[i]) % self.prime
+            inverse = (inverse * numbers[i]) % self.prime
+        return result
+
+    def lagrange_at_zero(self, xs_list):
+        """Return the Lagrange basis coefficients at x=0 for every list of x-coordinates in ``xs_list``.
+
+        Coefficients are cached per set of x-coordinates and the denominators of all the uncached sets share one
+        batch inversion. The cache may be used by several threads at once.
+        """
+        keys = dict.fromkeys(tuple(xs) for xs in xs_list)
+        with self.lagrange_lock:
+            found = {xs: self.lagrange_cache[xs] for xs in keys if xs in self.lagrange_cache}
+        missing = [xs for xs in keys if xs not in found]
+        numerators = []
+        denominators = []
+        for xs in missing:
+            # numerators[i] is the product of -x_j for every j != i, built from prefix and suffix products
+            prefix = [1] * (len(xs) + 1)
+            for i, x in enumerate(xs):
+                prefix[i + 1] = (prefix[i] * -x) % self.prime
+            suffix = 1
+            part = [0] * len(xs)
+            for i in range(len(xs) - 1, -1, -1):
+                part[i] = (prefix[i] * suffix) % self.prime
+                suffix = (suffix * -xs[i]) % self.prime
+            numerators.append(part)
+            for i, xi in enumerate(xs):
+                denominator = 1
+                for j, xj in enumerate(xs):
+                    if i != j:
+                        denominator = (denominator * (xi - xj)) % self.prime
+                denominators.append(denominator)
+        inverses = iter(self.batch_inverse(denominators))
+        for xs, part in zip(missing, numerators):
+            found[xs] = [(numerator * next(inverses)) % self.prime for numerator in part]
+        with self.lagrange_lock:
+            for xs in missing:
+                if xs not in self.lagrange_cache and len(self.lagrange_cache) >= self.lagrange_cache_size:
+                    self.lagrange_cache.pop(next(iter(self.lagrange_cache)))
+                self.lagrange_cache[xs] = found[xs]
+        return [found[tuple(xs)] for xs in xs_list]
+
+    def lagrange_at(self, xs, value):
+        """Return the Lagrange basis coefficients for the x-coordinates ``xs`` evaluated at ``value``."""
+        numerators = []
+        denominators = []
+        for i, xi in enumerate(xs):
+            numerator = 1
+            denominator = 1
+            for j, xj in enumerate(xs):
+                if i != j:
+                    numerator = (numerator * (value - xj)) % self.prime
+                    denominator = (denominator * (xi - xj)) % self.prime
+            numerators.append(numerator)
+            denominators.append(denominator)
+        return [(numerator * inverse) % self.prime
+                for numerator, inverse in zip(numerators, self.batch_inverse(denominators))]